@@ -20,6 +20,10 @@ SECRET_KEY = "aaaaaaiuhlciakycbkaybciluabufchnlhaullbnubn1111u;h;uoho;h3uoh3;oun
 
 def create_access_token(db: Session, personal_id: str, expires_delta: timedelta):
     user = db.query(User).filter(User.personal_id == personal_id).first()
+    return create_user_access_token(user, expires_delta)
+
+# 取得済みのユーザー情報からアクセストークンを作成（非同期のセッションで取得した場合など）
+def create_user_access_token(user: User, expires_delta: timedelta):
     expires = datetime.now() + expires_delta
     payload = {"id": user.id, 
                "company_id": user.company_id, 
@@ -1,10 +1,17 @@
 from azure.storage.fileshare import ShareServiceClient
+from azure.core.pipeline.transport import RequestsTransport
 from fastapi import HTTPException, status
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from tempfile import NamedTemporaryFile
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+import requests
+import threading
 import os
 import time
+import uuid
 
 # .envファイルを読み込む
 load_dotenv()
@@ -13,14 +20,112 @@ load_dotenv()
 AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 AZURE_SHARE_CLIENT_NAME = os.getenv('share_client_name')
 
-if AZURE_STORAGE_CONNECTION_STRING is None:
-    raise ValueError("AZURE_STORAGE_CONNECTION_STRING is not set. Please check your .env file.")
+# 接続文字列を取得（Azureを使用しない構成でもimportできるよう、使用時に確認する）
+def get_azure_connection_string() -> str:
+    if AZURE_STORAGE_CONNECTION_STRING is None:
+        raise ValueError("AZURE_STORAGE_CONNECTION_STRING is not set. Please check your .env file.")
+    return AZURE_STORAGE_CONNECTION_STRING
+
+# クライアントキャッシュの上限数とHTTPコネクションプールのサイズ
+AZURE_CLIENT_CACHE_SIZE = int(os.getenv('AZURE_CLIENT_CACHE_SIZE', '256'))
+AZURE_CONNECTION_POOL_SIZE = int(os.getenv('AZURE_CONNECTION_POOL_SIZE', '32'))
+
+# ダウンロード時のチャンクサイズと先読みするチャンク数
+AZURE_DOWNLOAD_CHUNK_SIZE = int(os.getenv('AZURE_DOWNLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))
+AZURE_DOWNLOAD_READ_AHEAD = int(os.getenv('AZURE_DOWNLOAD_READ_AHEAD', '4'))
+
+# アップロード時のチャンクサイズ（Azure Filesのupload_rangeは1回あたり最大4MiB）
+AZURE_UPLOAD_CHUNK_SIZE = min(int(os.getenv('AZURE_UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024))), 4 * 1024 * 1024)
+
+# 大容量ファイルを並列アップロードする際の同時実行数と、並列アップロードに切り替えるサイズ
+AZURE_UPLOAD_CONCURRENCY = int(os.getenv('AZURE_UPLOAD_CONCURRENCY', '8'))
+AZURE_UPLOAD_PARALLEL_THRESHOLD = int(os.getenv('AZURE_UPLOAD_PARALLEL_THRESHOLD', str(32 * 1024 * 1024)))
+
+# フォルダ削除時に同時に実行するAzureへのリクエスト数
+AZURE_DELETE_CONCURRENCY = int(os.getenv('AZURE_DELETE_CONCURRENCY', '16'))
+
+# コピーでリネームする場合の同時コピー数と、コピー完了を待つ最大秒数
+AZURE_COPY_CONCURRENCY = int(os.getenv('AZURE_COPY_CONCURRENCY', '16'))
+AZURE_COPY_TIMEOUT = int(os.getenv('AZURE_COPY_TIMEOUT', '300'))
+
+# サーバー側のリネームに対応していない場合（古いAPIバージョン・エミュレーターなど）に返されるエラーコード
+# これ以外のエラー（スロットリング・5xx・認証・ロックの競合など）ではコピーに切り替えず、そのまま例外を送出する
+AZURE_RENAME_UNSUPPORTED_ERRORS = frozenset({
+    'NotImplemented',
+    'UnsupportedHeader',
+    'UnsupportedQueryParameter',
+    'UnsupportedHttpVerb',
+    'InvalidQueryParameterValue',
+    'InvalidHeaderValue',
+    'FeatureVersionMismatch',
+})
+
+_client_lock = threading.Lock()
+_service_client = None
+_share_clients = OrderedDict()
+_directory_clients = OrderedDict()
+
+# Keep-Aliveを維持する共有トランスポートを作成
+def _create_azure_transport() -> RequestsTransport:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=AZURE_CONNECTION_POOL_SIZE,
+        pool_maxsize=AZURE_CONNECTION_POOL_SIZE
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+# プロセスで1つのShareServiceClientを取得
+def get_azure_service_client() -> ShareServiceClient:
+    global _service_client
+    if _service_client is None:
+        with _client_lock:
+            if _service_client is None:
+                _service_client = ShareServiceClient.from_connection_string(
+                    get_azure_connection_string(),
+                    transport=_create_azure_transport(),
+                    max_single_get_size=AZURE_DOWNLOAD_CHUNK_SIZE,
+                    max_chunk_get_size=AZURE_DOWNLOAD_CHUNK_SIZE
+                )
+    return _service_client
+
+# LRUキャッシュからクライアントを取得（なければ作成して登録）
+def _get_cached_client(cache: OrderedDict, key, factory):
+    with _client_lock:
+        client = cache.get(key)
+        if client is not None:
+            cache.move_to_end(key)
+            return client
+
+    client = factory()
+
+    with _client_lock:
+        cache[key] = client
+        cache.move_to_end(key)
+        while len(cache) > AZURE_CLIENT_CACHE_SIZE:
+            cache.popitem(last=False)
+    return client
+
+# storage_nameごとのShareClientを取得
+def get_azure_share_client(azure_share_client_name: str):
+    return _get_cached_client(
+        _share_clients,
+        azure_share_client_name,
+        lambda: get_azure_service_client().get_share_client(azure_share_client_name)
+    )
+
+# 共有が削除された場合にキャッシュからクライアントを取り除く
+def _evict_azure_share_client(azure_share_client_name: str):
+    with _client_lock:
+        _share_clients.pop(azure_share_client_name, None)
+        for key in [key for key in _directory_clients if key[0] == azure_share_client_name]:
+            del _directory_clients[key]
 
 # Azure Storageのshare_clientを作成
 def add_azure_share_client(azure_share_client_name: str):
     try:
-        service_client = ShareServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        share_client = service_client.get_share_client(azure_share_client_name)
+        share_client = get_azure_share_client(azure_share_client_name)
         share_client.create_share()
         print(f"Share client URL: {share_client.url}") #デバッグログ
     except ResourceExistsError:
@@ -34,9 +139,9 @@ def add_azure_share_client(azure_share_client_name: str):
 # Azure Storageのshare_clientを削除
 def delete_azure_share_client(azure_share_client_name: str):
     try:
-        service_client = ShareServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        share_client = service_client.get_share_client(azure_share_client_name)
+        share_client = get_azure_share_client(azure_share_client_name)
         share_client.delete_share()
+        _evict_azure_share_client(azure_share_client_name)
     except ResourceNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -51,42 +156,85 @@ def delete_azure_share_client(azure_share_client_name: str):
 # Azure Storageのディレクトリクライアントを取得
 def get_azure_directory_client(directory_path: str, azure_share_client_name: str):
     try:
-        service_client = ShareServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        share_client = service_client.get_share_client(azure_share_client_name)
-        directory_client = share_client.get_directory_client(directory_path)
-        print(f"Directory client URL: {directory_client.url}")  # デバッグログ
-        return directory_client
+        return _get_cached_client(
+            _directory_clients,
+            (azure_share_client_name, directory_path),
+            lambda: get_azure_share_client(azure_share_client_name).get_directory_client(directory_path)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get directory client: {repr(e)}"
         )
 
-# Azure Storageからファイルをダウンロード
-def download_file_from_azure_to_stream(storage_name: str, directory_path: str, file_name: str):
+# 別スレッドでイテレータを先読みし、最大depth個のチャンクをバッファする
+def _read_ahead(iterator, depth: int):
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for chunk in iterator:
+                if not put(chunk):
+                    return
+            put(end)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            try:
+                item = queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # クライアントが切断した場合も先読みスレッドを停止する
+        stop.set()
+
+# Azure Storageのファイルプロパティを取得
+def get_azure_file_properties(storage_name: str, directory_path: str, file_name: str):
+    file_client = get_azure_directory_client(directory_path, storage_name).get_file_client(file_name)
+    try:
+        return file_client.get_file_properties()
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File '{file_name}' not found"
+        )
+
+# Azure Storageからファイルをストリームでダウンロード
+# offset/lengthを指定した場合はその範囲のみを取得し、(取得サイズ, ファイルプロパティ, チャンクのイテレータ)を返す
+def download_file_from_azure_to_stream(storage_name: str, directory_path: str, file_name: str, offset: int = None, length: int = None):
     # ファイルクライアントを取得
     file_client = get_azure_directory_client(directory_path, storage_name).get_file_client(file_name)
 
-    # ファイルの存在確認    
-    if not file_client.exists():
+    # ダウンロードを開始（ファイルが存在しない場合はここでエラーになる）
+    try:
+        downloader = file_client.download_file(offset=offset, length=length)
+    except ResourceNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"File '{file_name}' not found"
         )
-    
-    # 一時ファイルを作成
-    temp_file = NamedTemporaryFile(delete=False)
-    temp_file.close()  # ファイルを閉じてからファイルクライアントに渡す
-
-    # ファイルをダウンロードして一時ファイルに書き込む
-    with open(temp_file.name, 'wb') as file_handle:
-        downloader = file_client.download_file()
-        downloader.readinto(file_handle)
-    
-    return temp_file.name
-    
-    # stream = file_client.download_file()
-    # return stream.chunks()
+
+    return downloader.size, downloader.properties, _read_ahead(downloader.chunks(), AZURE_DOWNLOAD_READ_AHEAD)
 
 # Azure Storageのフォルダを作成
 def create_azure_folder(directory_name: str, parent_path: str, storage_name: str) -> str:    
@@ -98,49 +246,104 @@ def create_azure_folder(directory_name: str, parent_path: str, storage_name: str
     except ResourceExistsError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のフォルダが存在しています")
 
-def delete_azure_folder(directory_path: str, storage_name: str):
-    directory_client = get_azure_directory_client(directory_path, storage_name)
-    
-    # ディレクトリ内のすべてのファイルとサブディレクトリを再帰的に削除
-    for item in directory_client.list_directories_and_files():
-        item_path = os.path.join(directory_path, item['name'])
-        if item['is_directory']:
-            delete_azure_folder(item_path, storage_name)
-        else:
-            file_client = directory_client.get_file_client(item['name'])
-            file_client.delete_file()
+# 親パスと名前を結合してAzure上のパスを作成
+def _join_azure_path(parent_path: str, name: str) -> str:
+    return f"{parent_path.rstrip('/')}/{name}" if parent_path else name
+
+# アップロード中の一時ファイル名（同じディレクトリに作成し、完了後に置き換える）
+AZURE_UPLOAD_TEMP_SUFFIX = '.uploading'
 
-    # 最後にディレクトリ自体を削除
+def _upload_temp_name(file_name: str) -> str:
+    return f"{file_name}.{uuid.uuid4().hex}{AZURE_UPLOAD_TEMP_SUFFIX}"
+
+def _is_upload_temp_name(name: str) -> bool:
+    return name.endswith(AZURE_UPLOAD_TEMP_SUFFIX)
+
+# フォルダ配下を幅優先で列挙し、ファイルを並列に削除した後、ディレクトリを深い階層から順に削除する
+# 戻り値は削除件数と削除に失敗した項目の一覧
+def _delete_azure_tree(directory_path: str, storage_name: str, concurrency: int = AZURE_DELETE_CONCURRENCY) -> dict:
+    errors = []
+
+    def list_directory(path: str):
+        try:
+            return list(get_azure_directory_client(path, storage_name).list_directories_and_files())
+        except Exception as e:
+            return e
+
+    def delete_file(item) -> bool:
+        path, name = item
+        try:
+            get_azure_directory_client(path, storage_name).get_file_client(name).delete_file()
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            errors.append({"path": _join_azure_path(path, name), "is_directory": False, "error": repr(e)})
+            return False
+        return True
+
+    def delete_directory(path: str) -> bool:
+        # 共有のルートは削除しない
+        if not path:
+            return False
+        try:
+            get_azure_directory_client(path, storage_name).delete_directory()
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            errors.append({"path": path, "is_directory": True, "error": repr(e)})
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        # 階層ごとにディレクトリを並列に列挙する
+        levels = []
+        files = []
+        current_level = [directory_path]
+        while current_level:
+            levels.append(current_level)
+            next_level = []
+            for path, result in zip(current_level, executor.map(list_directory, current_level)):
+                if isinstance(result, Exception):
+                    if path == directory_path and isinstance(result, ResourceNotFoundError):
+                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+                    errors.append({"path": path, "is_directory": True, "error": repr(result)})
+                    continue
+                for item in result:
+                    if item['is_directory']:
+                        next_level.append(_join_azure_path(path, item['name']))
+                    else:
+                        files.append((path, item['name']))
+            current_level = next_level
+
+        # ファイルを並列に削除
+        deleted_files = sum(executor.map(delete_file, files))
+
+        # ディレクトリを深い階層から順に削除
+        deleted_directories = 0
+        for level in reversed(levels):
+            deleted_directories += sum(executor.map(delete_directory, level))
+
+    return {"deleted_files": deleted_files, "deleted_directories": deleted_directories, "errors": errors}
+
+def delete_azure_folder(directory_path: str, storage_name: str) -> dict:
     try:
-        directory_client.delete_directory()
-    except ResourceNotFoundError:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="変更対象のディレクトリが存在しません")
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"フォルダの削除に失敗しました: {str(e)}")
+        report = _delete_azure_tree(directory_path, storage_name)
+    except HTTPException as e:
+        if e.status_code == status.HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="変更対象のディレクトリが存在しません")
+        raise
+
+    if report["errors"]:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"message": "フォルダの削除に失敗しました", **report})
+    return report
 
 # Azure Storageのフォルダを再帰的に削除
-def delete_azure_folder_recursive(directory_path: str, storage_name: str):
-    directory_client = get_azure_directory_client(directory_path, storage_name)
-    
-    try:
-        # ディレクトリ内のアイテムを取得
-        items = directory_client.list_directories_and_files()
-        
-        # ディレクトリ内のすべてのファイルとサブディレクトリを削除
-        for item in items:
-            item_path = os.path.join(directory_path, item['name'])
-            if item['is_directory']:
-                delete_azure_folder_recursive(item_path, storage_name)  # 再帰的にサブディレクトリを削除
-            else:
-                file_client = directory_client.get_file_client(item['name'])
-                file_client.delete_file()  # ファイルを削除
-
-        # 最後にディレクトリ自体を削除
-        directory_client.delete_directory()
-    except ResourceNotFoundError:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+# ファイルは並列に削除し、失敗した項目がある場合は削除結果の一覧を含めてエラーを返す
+def delete_azure_folder_recursive(directory_path: str, storage_name: str, concurrency: int = AZURE_DELETE_CONCURRENCY) -> dict:
+    report = _delete_azure_tree(directory_path, storage_name, concurrency)
+    if report["errors"]:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=report)
+    return report
 
 # Azure Storageのフォルダが存在するか確認
 def check_azure_folder_exists(directory_path: str) -> bool:
@@ -151,11 +354,58 @@ def check_azure_folder_exists(directory_path: str) -> bool:
     except ResourceNotFoundError:
         return False
 
-# Azure Storageのファイルをリネーム
+# サーバー側のリネームに対応していないことを示すエラーか
+def _is_rename_unsupported(error: HttpResponseError) -> bool:
+    error_code = getattr(error, 'error_code', None)
+    if error_code is None and error.response is not None:
+        error_code = error.response.headers.get('x-ms-error-code')
+    return error.status_code == 501 or error_code in AZURE_RENAME_UNSUPPORTED_ERRORS
+
+# コピーの完了をポーリングで待つ（待機間隔は徐々に延ばす）
+def _wait_for_azure_copy(file_client, timeout: int = AZURE_COPY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    delay = 0.2
+    while True:
+        properties = file_client.get_file_properties()
+        copy_status = properties.copy.status
+        if copy_status == "success":
+            return
+        if copy_status != "pending":
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"ファイルのコピーに失敗しました: {copy_status}"
+            )
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="ファイルのコピーがタイムアウトしました"
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+
+# Azure Storageのフォルダをリネーム
+# Azure Filesのサーバー側リネームを使用し、使用できない場合のみコピーと削除で移動する
 def rename_azure_folder(old_directory_path: str, new_directory_path: str, storage_name: str):
     if not old_directory_path or not new_directory_path:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both old and new directory paths are required")
-    
+
+    old_directory_client = get_azure_directory_client(old_directory_path, storage_name)
+    try:
+        old_directory_client.rename_directory(new_directory_path.rstrip('/'))
+        return
+    except ResourceNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    _copy_rename_azure_folder(old_directory_path, new_directory_path, storage_name)
+
+# サーバー側のリネームが使用できない場合に、コピーと削除でフォルダを移動する
+# 元のフォルダは配下の全てのファイルのコピーが完了してから削除する
+def _copy_rename_azure_folder(old_directory_path: str, new_directory_path: str, storage_name: str):
     old_directory_client = get_azure_directory_client(old_directory_path, storage_name)
     new_directory_client = get_azure_directory_client(new_directory_path, storage_name)
 
@@ -164,24 +414,31 @@ def rename_azure_folder(old_directory_path: str, new_directory_path: str, storag
     print(f"New directory URL: {new_directory_client.url}")
     
     try:
-        # 新しいディレクトリが存在しない場合のみ作成
-        try:
-            new_directory_client.create_directory()
-        except ResourceExistsError:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
-
-        for item in old_directory_client.list_directories_and_files():
-            if item['is_directory']:
-                rename_azure_folder(os.path.join(old_directory_path, item['name']), os.path.join(new_directory_path, item['name']), storage_name)
-            else:
-                old_file_client = old_directory_client.get_file_client(item['name'])
-                new_file_client = new_directory_client.get_file_client(item['name'])
-                new_file_client.start_copy_from_url(old_file_client.url)
-        
+        _copy_azure_folder(old_directory_path, new_directory_path, storage_name)
         delete_azure_folder(old_directory_path, storage_name)
     except ResourceNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
 
+# フォルダ配下を新しいフォルダへコピーする（各ファイルのコピーの完了を待ってから次へ進む）
+def _copy_azure_folder(old_directory_path: str, new_directory_path: str, storage_name: str):
+    old_directory_client = get_azure_directory_client(old_directory_path, storage_name)
+    new_directory_client = get_azure_directory_client(new_directory_path, storage_name)
+
+    # 新しいディレクトリが存在しない場合のみ作成
+    try:
+        new_directory_client.create_directory()
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+
+    for item in old_directory_client.list_directories_and_files():
+        if item['is_directory']:
+            _copy_azure_folder(_join_azure_path(old_directory_path, item['name']), _join_azure_path(new_directory_path, item['name']), storage_name)
+        else:
+            old_file_client = old_directory_client.get_file_client(item['name'])
+            new_file_client = new_directory_client.get_file_client(item['name'])
+            new_file_client.start_copy_from_url(old_file_client.url)
+            _wait_for_azure_copy(new_file_client)
+
 
 # Azure Storageにファイルをアップロード
 def upload_file_to_azure(file_path: str, directory_path: str, storage_name: str) -> str:
@@ -201,8 +458,117 @@ def upload_file_to_azure(file_path: str, directory_path: str, storage_name: str)
 
     return file_client.url
 
+# ソースから読み込んだ範囲をupload_rangeで書き込み、書き込んだバイト数を返す
+# concurrencyが2以上の場合はワーカープールで並列に書き込む（メモリ使用量は最大でpart_size×concurrency）
+def _upload_ranges(file_client, source, file_size: int, part_size: int, concurrency: int, progress=None) -> int:
+    progress_lock = threading.Lock()
+    uploaded_size = 0
+
+    def upload_part(offset: int, chunk: bytes):
+        nonlocal uploaded_size
+        file_client.upload_range(chunk, offset=offset, length=len(chunk))
+        with progress_lock:
+            uploaded_size += len(chunk)
+            if progress:
+                progress(uploaded_size, file_size)
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        pending = set()
+        offset = 0
+        while True:
+            chunk = source.read(part_size)
+            if not chunk:
+                break
+            if offset + len(chunk) > file_size:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズを超えています")
+
+            pending.add(executor.submit(upload_part, offset, chunk))
+            offset += len(chunk)
+
+            # 同時実行数に達したらいずれかの完了を待つ
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+        for future in wait(pending)[0]:
+            future.result()
+
+    return offset
+
+# ストリームからAzure Storageへチャンク単位でアップロード
+# ファイル全体をメモリや一時ファイルに保持せず、読み込んだバイト数がfile_sizeを超えた時点で中断する
+# 大容量ファイルは最終サイズでファイルを作成した後、固定サイズの範囲を並列にアップロードする
+# 同じディレクトリの一時ファイルに書き込み、全て書き込めた場合のみ置き換えるため、失敗しても上書き前のファイルは残る
+def upload_stream_to_azure(source, file_size: int, file_name: str, directory_path: str, storage_name: str,
+                           part_size: int = AZURE_UPLOAD_CHUNK_SIZE, concurrency: int = None, progress=None) -> str:
+    directory_client = get_azure_directory_client(directory_path, storage_name)
+    file_client = directory_client.get_file_client(file_name)
+    temp_file_client = directory_client.get_file_client(_upload_temp_name(file_name))
+
+    part_size = min(part_size, 4 * 1024 * 1024)
+    if concurrency is None:
+        concurrency = AZURE_UPLOAD_CONCURRENCY if file_size >= AZURE_UPLOAD_PARALLEL_THRESHOLD else 1
+
+    try:
+        temp_file_client.create_file(size=file_size)
+
+        uploaded_size = _upload_ranges(temp_file_client, source, file_size, part_size, concurrency, progress)
+
+        if uploaded_size != file_size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズと一致しません")
+
+        _replace_azure_file(temp_file_client, file_client, directory_path, file_name)
+    except Exception as e:
+        # 途中まで書き込まれた一時ファイルを残さない
+        try:
+            temp_file_client.delete_file()
+        except Exception:
+            pass
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"ファイルのアップロードに失敗しました: {repr(e)}"
+        )
+
+    return file_client.url
+
+# 一時ファイルを対象のファイルに置き換える（サーバー側のリネームが使用できない場合はコピーしてから一時ファイルを削除）
+def _replace_azure_file(temp_file_client, file_client, directory_path: str, file_name: str):
+    try:
+        temp_file_client.rename_file(_join_azure_path(directory_path, file_name), overwrite=True)
+        return
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    file_client.start_copy_from_url(temp_file_client.url)
+    _wait_for_azure_copy(file_client)
+    temp_file_client.delete_file()
+
 # Azure Storageのファイルをリネーム
+# Azure Filesのサーバー側リネームを使用し、使用できない場合のみコピーと削除で移動する
 def rename_azure_file(storage_name: str, directory_path: str, old_file_name: str, new_file_name: str):
+    old_file_client = get_azure_directory_client(directory_path, storage_name).get_file_client(old_file_name)
+    try:
+        old_file_client.rename_file(_join_azure_path(directory_path, new_file_name))
+        return
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Old file '{old_file_name}' does not exist"
+        )
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のファイルが存在しています")
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    _copy_rename_azure_file(storage_name, directory_path, old_file_name, new_file_name)
+
+# サーバー側のリネームが使用できない場合に、コピーと削除でファイルをリネームする
+def _copy_rename_azure_file(storage_name: str, directory_path: str, old_file_name: str, new_file_name: str):
     try:
         directory_client = get_azure_directory_client(directory_path, storage_name)
         old_file_client = directory_client.get_file_client(old_file_name)
@@ -223,30 +589,12 @@ def rename_azure_file(storage_name: str, directory_path: str, old_file_name: str
         new_file_client.start_copy_from_url(old_file_client.url)
 
         # コピーが完了するまで待つ
-        max_retries = 10
-        retries = 0
-        while retries < max_retries:
-            properties = new_file_client.get_file_properties()
-            copy_status = properties.copy.status
-            if copy_status == "success":
-                break
-            elif copy_status == "pending":
-                time.sleep(1)  # 1秒待機
-                retries += 1
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"ファイルのコピーに失敗しました: {copy_status}"
-                )
-
-        if copy_status != "success":
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="ファイルのコピーに失敗しました"
-            )
+        _wait_for_azure_copy(new_file_client)
 
         # 元のファイルを削除
         old_file_client.delete_file()
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -275,8 +623,7 @@ def delete_azure_file(storage_name: str, directory_path: str, file_name: str):
 # Azure ファイル共有に保存されている全てのディレクトリリストを取得
 def get_azure_directory_list(storage_name: str):
     try:
-        service_client = ShareServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        share_client = service_client.get_share_client(storage_name)
+        share_client = get_azure_share_client(storage_name)
         return [item['name'] for item in share_client.list_directories_and_files()]
     except Exception as e:
         raise HTTPException(
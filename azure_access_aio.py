@@ -0,0 +1,555 @@
+# azure_access.pyの非同期版（azure.storage.fileshare.aioを使用）
+# ルーターからはこちらをawaitして使用し、スクリプトからは同期版のazure_access.pyを使用する
+from azure.storage.fileshare.aio import ShareServiceClient
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from fastapi import HTTPException, status
+from collections import OrderedDict
+from azure_access import (
+    get_azure_connection_string,
+    AZURE_CLIENT_CACHE_SIZE,
+    AZURE_CONNECTION_POOL_SIZE,
+    AZURE_DOWNLOAD_CHUNK_SIZE,
+    AZURE_DOWNLOAD_READ_AHEAD,
+    AZURE_UPLOAD_CHUNK_SIZE,
+    AZURE_UPLOAD_CONCURRENCY,
+    AZURE_UPLOAD_PARALLEL_THRESHOLD,
+    AZURE_DELETE_CONCURRENCY,
+    AZURE_COPY_CONCURRENCY,
+    AZURE_COPY_TIMEOUT,
+    _is_rename_unsupported,
+    _join_azure_path,
+    _upload_temp_name,
+    _is_upload_temp_name,
+)
+import aiohttp
+import asyncio
+import os
+
+_service_client = None
+_http_session = None
+_share_clients = OrderedDict()
+_directory_clients = OrderedDict()
+
+# プロセスで1つのShareServiceClientを取得（イベントループ内から呼び出すこと）
+def get_azure_service_client() -> ShareServiceClient:
+    global _service_client, _http_session
+    if _service_client is None:
+        connection_string = get_azure_connection_string()
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=AZURE_CONNECTION_POOL_SIZE, keepalive_timeout=60)
+        )
+        _service_client = ShareServiceClient.from_connection_string(
+            connection_string,
+            transport=AioHttpTransport(session=_http_session, session_owner=False),
+            max_single_get_size=AZURE_DOWNLOAD_CHUNK_SIZE,
+            max_chunk_get_size=AZURE_DOWNLOAD_CHUNK_SIZE
+        )
+    return _service_client
+
+# アプリケーション終了時にクライアントとHTTPセッションを閉じる
+async def close_azure_clients():
+    global _service_client, _http_session
+    if _service_client is None:
+        return
+    await _service_client.close()
+    await _http_session.close()
+    _service_client = None
+    _http_session = None
+    _share_clients.clear()
+    _directory_clients.clear()
+
+# LRUキャッシュからクライアントを取得（なければ作成して登録）
+# イベントループのスレッドからのみ呼び出されるためロックは不要
+def _get_cached_client(cache: OrderedDict, key, factory):
+    client = cache.get(key)
+    if client is not None:
+        cache.move_to_end(key)
+        return client
+
+    client = factory()
+    cache[key] = client
+    while len(cache) > AZURE_CLIENT_CACHE_SIZE:
+        cache.popitem(last=False)
+    return client
+
+# storage_nameごとのShareClientを取得
+def get_azure_share_client(azure_share_client_name: str):
+    return _get_cached_client(
+        _share_clients,
+        azure_share_client_name,
+        lambda: get_azure_service_client().get_share_client(azure_share_client_name)
+    )
+
+# 共有が削除された場合にキャッシュからクライアントを取り除く
+def _evict_azure_share_client(azure_share_client_name: str):
+    _share_clients.pop(azure_share_client_name, None)
+    for key in [key for key in _directory_clients if key[0] == azure_share_client_name]:
+        del _directory_clients[key]
+
+# Azure Storageのshare_clientを作成
+async def add_azure_share_client(azure_share_client_name: str):
+    try:
+        share_client = get_azure_share_client(azure_share_client_name)
+        await share_client.create_share()
+        print(f"Share client URL: {share_client.url}") #デバッグログ
+    except ResourceExistsError:
+        print("Share client already exists")  #デバッグ
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to create share client: {repr(e)}"
+        )
+
+# Azure Storageのshare_clientを削除
+async def delete_azure_share_client(azure_share_client_name: str):
+    try:
+        share_client = get_azure_share_client(azure_share_client_name)
+        await share_client.delete_share()
+        _evict_azure_share_client(azure_share_client_name)
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Share client '{azure_share_client_name}' not found"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete share client: {repr(e)}"
+        )
+
+# Azure Storageのディレクトリクライアントを取得
+def get_azure_directory_client(directory_path: str, azure_share_client_name: str):
+    try:
+        return _get_cached_client(
+            _directory_clients,
+            (azure_share_client_name, directory_path),
+            lambda: get_azure_share_client(azure_share_client_name).get_directory_client(directory_path)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get directory client: {repr(e)}"
+        )
+
+# 別タスクで非同期イテレータを先読みし、最大depth個のチャンクをバッファする
+async def _read_ahead(chunks, depth: int):
+    queue = asyncio.Queue(maxsize=depth)
+    end = object()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+            await queue.put(end)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(produce())
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # クライアントが切断した場合も先読みタスクを停止する
+        task.cancel()
+
+# Azure Storageのファイルプロパティを取得
+async def get_azure_file_properties(storage_name: str, directory_path: str, file_name: str):
+    file_client = get_azure_directory_client(directory_path, storage_name).get_file_client(file_name)
+    try:
+        return await file_client.get_file_properties()
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File '{file_name}' not found"
+        )
+
+# Azure Storageからファイルをストリームでダウンロード
+# offset/lengthを指定した場合はその範囲のみを取得し、(取得サイズ, ファイルプロパティ, チャンクの非同期イテレータ)を返す
+# read_aheadが0の場合は先読みせず、読み込まれた時に次のチャンクを取得する
+async def download_file_from_azure_to_stream(storage_name: str, directory_path: str, file_name: str, offset: int = None, length: int = None,
+                                             read_ahead: int = AZURE_DOWNLOAD_READ_AHEAD):
+    # ファイルクライアントを取得
+    file_client = get_azure_directory_client(directory_path, storage_name).get_file_client(file_name)
+
+    # ダウンロードを開始（ファイルが存在しない場合はここでエラーになる）
+    try:
+        downloader = await file_client.download_file(offset=offset, length=length)
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File '{file_name}' not found"
+        )
+
+    chunks = downloader.chunks()
+    if read_ahead > 0:
+        chunks = _read_ahead(chunks, read_ahead)
+    return downloader.size, downloader.properties, chunks
+
+# Azure Storageのフォルダを作成
+async def create_azure_folder(directory_name: str, parent_path: str, storage_name: str):
+    full_path = os.path.join(parent_path, directory_name) if parent_path else directory_name
+    directory_client = get_azure_directory_client(full_path, storage_name)
+
+    try:
+        await directory_client.create_directory()
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のフォルダが存在しています")
+
+# フォルダ配下を幅優先で列挙し、ファイルを並列に削除した後、ディレクトリを深い階層から順に削除する
+# 戻り値は削除件数と削除に失敗した項目の一覧
+async def _delete_azure_tree(directory_path: str, storage_name: str, concurrency: int = AZURE_DELETE_CONCURRENCY) -> dict:
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    errors = []
+
+    async def list_directory(path: str):
+        async with semaphore:
+            try:
+                directory_client = get_azure_directory_client(path, storage_name)
+                return [item async for item in directory_client.list_directories_and_files()]
+            except Exception as e:
+                return e
+
+    async def delete_file(path: str, name: str) -> bool:
+        async with semaphore:
+            try:
+                await get_azure_directory_client(path, storage_name).get_file_client(name).delete_file()
+            except ResourceNotFoundError:
+                pass
+            except Exception as e:
+                errors.append({"path": _join_azure_path(path, name), "is_directory": False, "error": repr(e)})
+                return False
+            return True
+
+    async def delete_directory(path: str) -> bool:
+        # 共有のルートは削除しない
+        if not path:
+            return False
+        async with semaphore:
+            try:
+                await get_azure_directory_client(path, storage_name).delete_directory()
+            except ResourceNotFoundError:
+                pass
+            except Exception as e:
+                errors.append({"path": path, "is_directory": True, "error": repr(e)})
+                return False
+            return True
+
+    # 階層ごとにディレクトリを並列に列挙する
+    levels = []
+    files = []
+    current_level = [directory_path]
+    while current_level:
+        levels.append(current_level)
+        next_level = []
+        results = await asyncio.gather(*[list_directory(path) for path in current_level])
+        for path, result in zip(current_level, results):
+            if isinstance(result, Exception):
+                if path == directory_path and isinstance(result, ResourceNotFoundError):
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+                errors.append({"path": path, "is_directory": True, "error": repr(result)})
+                continue
+            for item in result:
+                if item['is_directory']:
+                    next_level.append(_join_azure_path(path, item['name']))
+                else:
+                    files.append((path, item['name']))
+        current_level = next_level
+
+    # ファイルを並列に削除
+    deleted_files = sum(await asyncio.gather(*[delete_file(path, name) for path, name in files]))
+
+    # ディレクトリを深い階層から順に削除
+    deleted_directories = 0
+    for level in reversed(levels):
+        deleted_directories += sum(await asyncio.gather(*[delete_directory(path) for path in level]))
+
+    return {"deleted_files": deleted_files, "deleted_directories": deleted_directories, "errors": errors}
+
+async def delete_azure_folder(directory_path: str, storage_name: str) -> dict:
+    try:
+        report = await _delete_azure_tree(directory_path, storage_name)
+    except HTTPException as e:
+        if e.status_code == status.HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="変更対象のディレクトリが存在しません")
+        raise
+
+    if report["errors"]:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"message": "フォルダの削除に失敗しました", **report})
+    return report
+
+# Azure Storageのフォルダを再帰的に削除
+# ファイルは並列に削除し、失敗した項目がある場合は削除結果の一覧を含めてエラーを返す
+async def delete_azure_folder_recursive(directory_path: str, storage_name: str, concurrency: int = AZURE_DELETE_CONCURRENCY) -> dict:
+    report = await _delete_azure_tree(directory_path, storage_name, concurrency)
+    if report["errors"]:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=report)
+    return report
+
+# Azure Storageのフォルダが存在するか確認
+async def check_azure_folder_exists(directory_path: str, storage_name: str) -> bool:
+    directory_client = get_azure_directory_client(directory_path, storage_name)
+    try:
+        await directory_client.get_directory_properties()
+        return True
+    except ResourceNotFoundError:
+        return False
+
+# コピーの完了をポーリングで待つ（待機間隔は徐々に延ばし、イベントループはブロックしない）
+async def _wait_for_azure_copy(file_client, timeout: int = AZURE_COPY_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = 0.2
+    while True:
+        properties = await file_client.get_file_properties()
+        copy_status = properties.copy.status
+        if copy_status == "success":
+            return
+        if copy_status != "pending":
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"ファイルのコピーに失敗しました: {copy_status}"
+            )
+        if loop.time() >= deadline:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="ファイルのコピーがタイムアウトしました"
+            )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 2)
+
+# サーバー側のリネームが使用できない場合に、フォルダ配下を並列にコピーしてから元のフォルダを削除する
+async def _copy_rename_azure_folder(old_directory_path: str, new_directory_path: str, storage_name: str,
+                                    concurrency: int = AZURE_COPY_CONCURRENCY):
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def copy_file(old_path: str, new_path: str, name: str):
+        async with semaphore:
+            old_file_client = get_azure_directory_client(old_path, storage_name).get_file_client(name)
+            new_file_client = get_azure_directory_client(new_path, storage_name).get_file_client(name)
+            await new_file_client.start_copy_from_url(old_file_client.url)
+            await _wait_for_azure_copy(new_file_client)
+
+    async def copy_directory(old_path: str, new_path: str):
+        async with semaphore:
+            await get_azure_directory_client(new_path, storage_name).create_directory()
+            return [item async for item in get_azure_directory_client(old_path, storage_name).list_directories_and_files()]
+
+    try:
+        # 階層ごとにディレクトリを作成し、その階層のファイルを並列にコピーする
+        current_level = [(old_directory_path, new_directory_path)]
+        while current_level:
+            results = await asyncio.gather(*[copy_directory(old_path, new_path) for old_path, new_path in current_level])
+            next_level = []
+            copies = []
+            for (old_path, new_path), items in zip(current_level, results):
+                for item in items:
+                    if item['is_directory']:
+                        next_level.append((_join_azure_path(old_path, item['name']), _join_azure_path(new_path, item['name'])))
+                    else:
+                        copies.append(copy_file(old_path, new_path, item['name']))
+            await asyncio.gather(*copies)
+            current_level = next_level
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+    except ResourceNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+
+    await delete_azure_folder(old_directory_path, storage_name)
+
+# Azure Storageのフォルダをリネーム
+# Azure Filesのサーバー側リネームを使用し、データ量によらずメタデータの変更のみで完了させる
+async def rename_azure_folder(old_directory_path: str, new_directory_path: str, storage_name: str):
+    if not old_directory_path or not new_directory_path:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both old and new directory paths are required")
+
+    old_directory_client = get_azure_directory_client(old_directory_path, storage_name)
+    try:
+        await old_directory_client.rename_directory(new_directory_path.rstrip('/'))
+        return
+    except ResourceNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    await _copy_rename_azure_folder(old_directory_path, new_directory_path, storage_name)
+
+# ソースから読み込んだ範囲をupload_rangeで書き込み、書き込んだバイト数を返す
+# sourceは await source.read(size) で読み込めるオブジェクト（UploadFileなど）
+# concurrencyが2以上の場合は複数のタスクで並列に書き込む（メモリ使用量は最大でpart_size×concurrency）
+async def _upload_ranges(file_client, source, file_size: int, part_size: int, concurrency: int, progress=None) -> int:
+    uploaded_size = 0
+
+    async def upload_part(offset: int, chunk: bytes):
+        nonlocal uploaded_size
+        await file_client.upload_range(chunk, offset=offset, length=len(chunk))
+        uploaded_size += len(chunk)
+        if progress:
+            progress(uploaded_size, file_size)
+
+    pending = set()
+    offset = 0
+    try:
+        while True:
+            chunk = await source.read(part_size)
+            if not chunk:
+                break
+            if offset + len(chunk) > file_size:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズを超えています")
+
+            pending.add(asyncio.create_task(upload_part(offset, chunk)))
+            offset += len(chunk)
+
+            # 同時実行数に達したらいずれかの完了を待つ
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            for task in done:
+                task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return offset
+
+# ストリームからAzure Storageへチャンク単位でアップロード
+# ファイル全体をメモリや一時ファイルに保持せず、読み込んだバイト数がfile_sizeを超えた時点で中断する
+# 大容量ファイルは最終サイズでファイルを作成した後、固定サイズの範囲を並列にアップロードする
+# 同じディレクトリの一時ファイルに書き込み、全て書き込めた場合のみ置き換えるため、失敗しても上書き前のファイルは残る
+async def upload_stream_to_azure(source, file_size: int, file_name: str, directory_path: str, storage_name: str,
+                                 part_size: int = AZURE_UPLOAD_CHUNK_SIZE, concurrency: int = None, progress=None) -> str:
+    directory_client = get_azure_directory_client(directory_path, storage_name)
+    file_client = directory_client.get_file_client(file_name)
+    temp_file_client = directory_client.get_file_client(_upload_temp_name(file_name))
+
+    part_size = min(part_size, 4 * 1024 * 1024)
+    if concurrency is None:
+        concurrency = AZURE_UPLOAD_CONCURRENCY if file_size >= AZURE_UPLOAD_PARALLEL_THRESHOLD else 1
+
+    try:
+        await temp_file_client.create_file(size=file_size)
+
+        uploaded_size = await _upload_ranges(temp_file_client, source, file_size, part_size, concurrency, progress)
+
+        if uploaded_size != file_size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズと一致しません")
+
+        await _replace_azure_file(temp_file_client, file_client, directory_path, file_name)
+    except Exception as e:
+        # 途中まで書き込まれた一時ファイルを残さない
+        try:
+            await temp_file_client.delete_file()
+        except Exception:
+            pass
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"ファイルのアップロードに失敗しました: {repr(e)}"
+        )
+
+    return file_client.url
+
+# 一時ファイルを対象のファイルに置き換える（サーバー側のリネームが使用できない場合はコピーしてから一時ファイルを削除）
+async def _replace_azure_file(temp_file_client, file_client, directory_path: str, file_name: str):
+    try:
+        await temp_file_client.rename_file(_join_azure_path(directory_path, file_name), overwrite=True)
+        return
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    await file_client.start_copy_from_url(temp_file_client.url)
+    await _wait_for_azure_copy(file_client)
+    await temp_file_client.delete_file()
+
+# Azure Storageのファイルをリネーム
+# Azure Filesのサーバー側リネームを使用し、使用できない場合のみコピーと削除で移動する
+async def rename_azure_file(storage_name: str, directory_path: str, old_file_name: str, new_file_name: str):
+    directory_client = get_azure_directory_client(directory_path, storage_name)
+    old_file_client = directory_client.get_file_client(old_file_name)
+    new_file_client = directory_client.get_file_client(new_file_name)
+
+    try:
+        await old_file_client.rename_file(_join_azure_path(directory_path, new_file_name))
+        return
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Old file '{old_file_name}' does not exist"
+        )
+    except ResourceExistsError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のファイルが存在しています")
+    except HttpResponseError as e:
+        if not _is_rename_unsupported(e):
+            raise
+
+    try:
+        # ファイルをコピーし、完了を待ってから元のファイルを削除
+        await new_file_client.start_copy_from_url(old_file_client.url)
+        await _wait_for_azure_copy(new_file_client)
+        await old_file_client.delete_file()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"ファイルのリネームに失敗しました: {repr(e)}"
+        )
+
+# Azure Storageのファイルを削除
+async def delete_azure_file(storage_name: str, directory_path: str, file_name: str):
+    try:
+        directory_client = get_azure_directory_client(directory_path, storage_name)
+        file_client = directory_client.get_file_client(file_name)
+        await file_client.delete_file()
+    except ResourceNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File '{file_name}' not found"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete file: {repr(e)}"
+        )
+
+# Azure ファイル共有に保存されている全てのディレクトリリストを取得
+async def get_azure_directory_list(storage_name: str):
+    try:
+        share_client = get_azure_share_client(storage_name)
+        return [item['name'] async for item in share_client.list_directories_and_files()]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get directory list: {repr(e)}"
+        )
+
+# Azure Storageのディレクトリ直下の項目名の一覧を取得
+async def list_azure_directory(storage_name: str, directory_path: str):
+    try:
+        directory_client = get_azure_directory_client(directory_path or '', storage_name)
+        return [
+            item['name'] async for item in directory_client.list_directories_and_files()
+            if not _is_upload_temp_name(item['name'])
+        ]
+    except ResourceNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get directory list: {repr(e)}"
+        )
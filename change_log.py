@@ -0,0 +1,111 @@
+# ディレクトリ・ファイルの変更履歴（cd_changes）を記録・取得する
+# クライアントは前回受け取ったカーソル（変更履歴のid）より後の変更だけを取得して同期する
+# 同じ会社の変更は会社ごとのロックで1つずつコミットするため、小さいidが後からコミットされてカーソルを追い越されることはない
+# 変更履歴は一定期間で削除し、削除済みの範囲より前のカーソルには全件の再取得を求める
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+from models import Change, ChangeLock
+from db import SessionLocal
+import asyncio
+import os
+
+# .envファイルを読み込む
+load_dotenv()
+
+CHANGE_ENTITY_DIRECTORY = 'directory'
+CHANGE_ENTITY_FILE = 'file'
+
+CHANGE_ACTION_CREATE = 'create'
+CHANGE_ACTION_UPDATE = 'update'
+CHANGE_ACTION_RENAME = 'rename'
+CHANGE_ACTION_DELETE = 'delete'
+
+# 変更履歴の保存期間（日）と、古い変更履歴を削除する間隔（秒）
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', '30'))
+CHANGE_LOG_COMPACT_INTERVAL = int(os.getenv('CHANGE_LOG_COMPACT_INTERVAL', str(60 * 60)))
+
+# 会社の変更履歴のロックを取得する（行がなければ作成し、コミットまで保持する）
+# ロックせずに並行して記録すると、先に採番されたidが後からコミットされることがあり、
+# その間にカーソルを進めたクライアントはその変更を取得できなくなる
+def _lock_change_log(db: Session, company_id: int):
+    statement = mysql_insert(ChangeLock).values(company_id=company_id, update_at=datetime.now())
+    statement = statement.on_duplicate_key_update(update_at=statement.inserted.update_at)
+    db.execute(statement)
+
+# 変更を記録（ディレクトリ・ファイルの更新と同じトランザクションで呼び、コミットは呼び出し側で行う）
+# ロックはコミットまで保持されるため、更新の最後（コミットの直前）に呼ぶ
+# ディレクトリの名前変更・削除は配下にも及ぶため、配下の分は記録せずクライアント側で反映する
+def record_change(db: Session, company_id: int, entity_type: str, entity_id: int, action: str,
+                  directory_id: Optional[int], name: Optional[str], user_id: Optional[int]):
+    # 保留中の更新を先に書き込み、ロックを保持する間の処理を変更履歴の追加だけにする
+    db.flush()
+    _lock_change_log(db, company_id)
+    db.add(Change(
+        company_id=company_id,
+        entity_type=entity_type,
+        entity_id=entity_id,
+        action=action,
+        directory_id=directory_id,
+        name=name,
+        create_at=datetime.now(),
+        create_acc=user_id
+    ))
+
+# 最新の変更履歴のid（変更がない場合は0）
+def get_latest_change_id(db: Session) -> int:
+    return db.query(func.max(Change.id)).scalar() or 0
+
+# カーソルより後の変更をlimit件まで取得し、（変更のリスト, 全件の再取得が必要か）を返す
+# カーソルが0の場合と、カーソルより後の変更履歴が既に削除されている場合は全件の再取得が必要
+def get_changes(db: Session, company_id: int, cursor: int, limit: int) -> Tuple[List[Change], bool]:
+    if cursor <= 0:
+        return [], True
+
+    oldest_id = db.query(func.min(Change.id)).scalar()
+    if oldest_id is not None and cursor < oldest_id - 1:
+        return [], True
+
+    changes = db.query(Change)\
+        .filter(
+            Change.company_id == company_id,
+            Change.id > cursor
+        )\
+        .order_by(Change.id)\
+        .limit(limit)\
+        .all()
+    return changes, False
+
+# 保存期間を過ぎた変更履歴を削除し、削除した件数を返す
+# 削除済みの範囲を判定できるよう、最新の変更履歴は期間を過ぎても残す
+def compact_changes(db: Session, retention_days: int = CHANGE_LOG_RETENTION_DAYS) -> int:
+    latest_id = get_latest_change_id(db)
+    deleted = db.query(Change)\
+        .filter(
+            Change.create_at < datetime.now() - timedelta(days=retention_days),
+            Change.id < latest_id
+        )\
+        .delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+# 古い変更履歴を定期的に削除する（アプリケーションの起動時にタスクとして開始する）
+async def run_change_log_compactor(interval: int = CHANGE_LOG_COMPACT_INTERVAL):
+    def compact():
+        db = SessionLocal()
+        try:
+            return compact_changes(db)
+        finally:
+            db.close()
+
+    while True:
+        try:
+            deleted = await asyncio.to_thread(compact)
+            if deleted:
+                print(f"deleted {deleted} old change log entries")
+        except Exception as e:
+            print(f"Failed to compact the change log: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,114 @@
+# 頻繁に実行するクエリがインデックスを使用しているかをEXPLAINで確認する
+# migrations.pyを適用したDB（できれば本番に近い件数のデータがあるもの）に対して実行し、使用されていないクエリがあれば終了コード1で終了する
+# 件数が少ないテーブルではオプティマイザが全件走査を選ぶことがあるため、その場合はpossible_keysに含まれているかも確認する
+from typing import List, NamedTuple, Optional
+from sqlalchemy import select
+from models import Directory, DirectoryClosure, File, Favorite, Permission, User, SearchEntry, Change
+from db import ENGINE
+import sys
+
+class IndexCheck(NamedTuple):
+    name: str
+    statement: object
+    index: str
+
+# 確認するクエリと、使用されるべきインデックス（値はEXPLAIN用の例）
+INDEX_CHECKS: List[IndexCheck] = [
+    IndexCheck(
+        'file listing',
+        select(File.id, File.file_name).where(File.directory_id == 1, File.delete_flg == False).order_by(File.file_name),
+        'ix_cd_files_directory_listing'
+    ),
+    IndexCheck(
+        'storage usage by user',
+        select(File.id).where(File.user_id == 1, File.delete_flg == False),
+        'ix_cd_files_user_id_delete_flg'
+    ),
+    IndexCheck(
+        'directory by company and path',
+        select(Directory.id).where(
+            Directory.company_id == 1,
+            Directory.path == 'a/',
+            Directory.delete_flg == False,
+            Directory.open_flg == False
+        ),
+        'ix_cd_directories_company_path'
+    ),
+    IndexCheck(
+        'child directories',
+        select(Directory.id).where(Directory.parent_id == 1, Directory.delete_flg == False),
+        'ix_cd_directories_parent_id'
+    ),
+    IndexCheck(
+        'directory ancestors',
+        select(DirectoryClosure.ancestor_id).where(DirectoryClosure.descendant_id == 1),
+        'ix_cd_directory_closures_descendant'
+    ),
+    IndexCheck(
+        'permission check',
+        select(Permission.id).where(Permission.directory_id == 1, Permission.user_id == 1),
+        'uq_cd_permissions_directory_user'
+    ),
+    IndexCheck(
+        'favorite name check',
+        select(Favorite.id).where(Favorite.user_id == 1, Favorite.favorite_name == 'a'),
+        'uq_cd_favorites_user_name'
+    ),
+    IndexCheck(
+        'login',
+        select(User.id).where(User.personal_id == 'a', User.delete_flg == False),
+        'ix_users_personal_id'
+    ),
+    IndexCheck(
+        'name search prefix',
+        select(SearchEntry.id).where(SearchEntry.company_id == 1, SearchEntry.normalized_name.like('a%')),
+        'ix_cd_search_entries_company_id_name'
+    ),
+    IndexCheck(
+        'change feed',
+        select(Change.id).where(Change.company_id == 1, Change.id > 1).order_by(Change.id),
+        'ix_cd_changes_company_id_id'
+    ),
+]
+
+# EXPLAINの結果から、対象テーブルの行を返す
+def _explain(connection, check: IndexCheck) -> Optional[dict]:
+    compiled = check.statement.compile(dialect=connection.dialect)
+    table_name = check.statement.get_final_froms()[0].name
+    for row in connection.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params).mappings().all():
+        if row['table'] == table_name:
+            return dict(row)
+    return None
+
+# 全てのクエリを確認し、インデックスを使用していないクエリの数を返す
+def check_indexes(engine=ENGINE) -> int:
+    failures = 0
+    with engine.connect() as connection:
+        for check in INDEX_CHECKS:
+            plan = _explain(connection, check)
+            if plan is None:
+                print(f"NG   {check.name}: no plan row")
+                failures += 1
+                continue
+
+            possible_keys = (plan.get('possible_keys') or '').split(',')
+            if plan.get('key') == check.index:
+                result = 'OK'
+            elif check.index in possible_keys:
+                # インデックスは使用可能だが、件数が少ないなどの理由で選ばれていない
+                result = 'WARN'
+            else:
+                result = 'NG'
+                failures += 1
+            print(f"{result:4} {check.name}: key={plan.get('key')} type={plan.get('type')} rows={plan.get('rows')} expected={check.index}")
+    return failures
+
+def main():
+    failures = check_indexes()
+    if failures:
+        print(f"{failures} queries do not use their index")
+        sys.exit(1)
+    print("all checked queries can use their index")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 # DBへの接続設定
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from fastapi import Request
 from dotenv import load_dotenv
+from db_pool import InstrumentedQueuePool, InstrumentedAsyncQueuePool, instrument_pool, enable_sql_log
+import contextvars
 import os
+import ssl
+import time
 
 # .envから環境変数を読み込む
 load_dotenv()
@@ -15,8 +21,31 @@ PASSWORD = os.getenv('password')
 HOST = os.getenv('host')
 DATABASE_NAME = os.getenv('database_name')
 
-# 接続URLの作成
-DATABASE_URL = f'mysql+pymysql://{USER_NAME}:{PASSWORD}@{HOST}/{DATABASE_NAME}?charset=utf8'
+# 読み取り専用のレプリカのホスト（未設定の場合は読み取りもプライマリで行う）
+READ_HOST = os.getenv('read_host')
+
+# 接続プールの設定（ワーカープロセスごとの値）
+# DB_POOL_SIZE: 常に保持する接続数、DB_MAX_OVERFLOW: 混雑時に追加で作成する接続数
+# DB_POOL_TIMEOUT: 接続が空くまで待つ秒数、DB_POOL_RECYCLE: 接続を作り直すまでの秒数（サーバー側で切断される前に作り直す）
+# DB_POOL_PRE_PING: 貸し出す前に接続が切れていないか確認する
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+# 実行するSQLをログに出力する割合（0で出力しない、1で全件）
+DB_SQL_LOG_SAMPLE_RATE = float(os.getenv('DB_SQL_LOG_SAMPLE_RATE', '0'))
+
+# 書き込んだ後、読み取りもプライマリで行う秒数（レプリカへの反映の遅れより長くする）
+DB_PRIMARY_PIN_SECONDS = float(os.getenv('DB_PRIMARY_PIN_SECONDS', '5'))
+
+# 接続URLの作成（非同期用はaiomysqlで接続する）
+def database_url(driver: str, host: str) -> str:
+    return f'mysql+{driver}://{USER_NAME}:{PASSWORD}@{host}/{DATABASE_NAME}?charset=utf8'
+
+DATABASE_URL = database_url('pymysql', HOST)
+ASYNC_DATABASE_URL = database_url('aiomysql', HOST)
 
 # SSLオプションの追加
 ssl_args = {
@@ -25,24 +54,108 @@ ssl_args = {
     }
 }
 
-# DBとの接続
-ENGINE = create_engine(
-    DATABASE_URL,
-    connect_args=ssl_args,
-    encoding="utf-8",
-    echo=True
-)
+def _pool_options(name: str) -> dict:
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_logging_name": name,
+    }
+
+# DBとの接続（nameはプールの集計値の名前）
+def _create_engine(host: str, name: str):
+    engine = create_engine(
+        database_url('pymysql', host),
+        connect_args=ssl_args,
+        encoding="utf-8",
+        poolclass=InstrumentedQueuePool,
+        **_pool_options(name)
+    )
+    instrument_pool(engine.pool, name)
+    enable_sql_log(engine, DB_SQL_LOG_SAMPLE_RATE)
+    return engine
+
+# 非同期の接続（DBの応答を待つ間にイベントループで他のリクエストを処理する）
+# プールは同期の接続とは別に、同じ設定で作成する
+# aiomysqlのSSLオプションはSSLContextで指定する
+def _create_async_engine(host: str, name: str):
+    engine = create_async_engine(
+        database_url('aiomysql', host),
+        connect_args={"ssl": ssl.create_default_context(cafile=ssl_args["ssl"]["ca"])},
+        poolclass=InstrumentedAsyncQueuePool,
+        **_pool_options(name)
+    )
+    instrument_pool(engine.sync_engine.pool, name)
+    enable_sql_log(engine.sync_engine, DB_SQL_LOG_SAMPLE_RATE)
+    return engine
+
+ENGINE = _create_engine(HOST, 'primary')
+ASYNC_ENGINE = _create_async_engine(HOST, 'primary_async')
+
+# 読み取り専用の接続（レプリカを設定していない場合はプライマリと同じ）
+if READ_HOST:
+    READ_ENGINE = _create_engine(READ_HOST, 'replica')
+    ASYNC_READ_ENGINE = _create_async_engine(READ_HOST, 'replica_async')
+else:
+    READ_ENGINE = ENGINE
+    ASYNC_READ_ENGINE = ASYNC_ENGINE
 
 # modelで使用する
 Base = declarative_base()
 
 #SQL接続
 SessionLocal = sessionmaker(autocommit=False,autoflush=False,bind=ENGINE)
-Base = declarative_base()
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
-    
+
+# 非同期のSQL接続（コミット後に属性を読み直さないよう、expire_on_commitは無効にする）
+AsyncSessionLocal = sessionmaker(ASYNC_ENGINE, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# 読み取り専用のSQL接続（一覧の取得など、書き込みをしないAPIで使用する）
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=READ_ENGINE)
+AsyncReadSessionLocal = sessionmaker(ASYNC_READ_ENGINE, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# 書き込んだ後にプライマリで読み取る期限（UNIX時間）を保持するCookie
+PRIMARY_PIN_COOKIE = 'db_primary_until'
+
+# 直前に書き込んだクライアントは、レプリカに反映されるまで読み取りもプライマリで行う（自分の書き込みが一覧に出るようにする）
+def is_primary_pinned(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(PRIMARY_PIN_COOKIE, '0')) > time.time()
+    except ValueError:
+        return False
+
+def get_read_db(request: Request):
+    db = SessionLocal() if READ_ENGINE is ENGINE or is_primary_pinned(request) else ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(request: Request):
+    session_factory = AsyncSessionLocal if ASYNC_READ_ENGINE is ASYNC_ENGINE or is_primary_pinned(request) else AsyncReadSessionLocal
+    async with session_factory() as db:
+        yield db
+
+# リクエスト中にプライマリへコミットしたかを記録する（ミドルウェアでtrack_primary_writes()を呼んでから処理する）
+_primary_writes = contextvars.ContextVar('primary_writes', default=None)
+
+def track_primary_writes() -> list:
+    writes = [False]
+    _primary_writes.set(writes)
+    return writes
+
+@event.listens_for(Session, 'after_commit')
+def _record_primary_write(session):
+    writes = _primary_writes.get()
+    if writes is not None:
+        writes[0] = True
@@ -0,0 +1,178 @@
+# DBの接続プールの計測と、SQLのログ出力を行う
+# プールのイベント（接続・貸し出し・返却・切断）で、待ち時間・使用中の接続数・上限超過・接続の寿命を集計する
+# 集計値はワーカープロセスごとの値のため、プールのサイズはワーカー1つあたりの値として決める
+from typing import Dict, Optional
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+# プールの集計値
+class PoolMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_wait_total = 0.0
+            self.checkout_wait_max = 0.0
+            self.checkout_timeouts = 0
+            self.in_use = 0
+            self.in_use_max = 0
+            self.overflow_hits = 0
+            self.connections_opened = 0
+            self.connections_closed = 0
+            self.connection_lifetime_total = 0.0
+            self.connection_lifetime_max = 0.0
+
+    # 接続の取得を待った時間（overflowがTrueの場合はプールのサイズを超えて接続を作成した）
+    def record_wait(self, wait: float, overflow: bool):
+        with self._lock:
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+            if overflow:
+                self.overflow_hits += 1
+
+    def record_timeout(self, wait: float):
+        with self._lock:
+            self.checkout_timeouts += 1
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.in_use_max = max(self.in_use_max, self.in_use)
+
+    def record_checkin(self):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def record_connect(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def record_close(self, lifetime: Optional[float]):
+        with self._lock:
+            self.connections_closed += 1
+            if lifetime is not None:
+                self.connection_lifetime_total += lifetime
+                self.connection_lifetime_max = max(self.connection_lifetime_max, lifetime)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "checkouts": self.checkouts,
+                "checkout_wait_avg_ms": self.checkout_wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                "checkout_wait_max_ms": self.checkout_wait_max * 1000,
+                "checkout_timeouts": self.checkout_timeouts,
+                "in_use": self.in_use,
+                "in_use_max": self.in_use_max,
+                "overflow_hits": self.overflow_hits,
+                "connections_opened": self.connections_opened,
+                "connections_closed": self.connections_closed,
+                "connection_lifetime_avg_s": self.connection_lifetime_total / self.connections_closed if self.connections_closed else 0.0,
+                "connection_lifetime_max_s": self.connection_lifetime_max,
+            }
+
+_pool_metrics = {}
+_pool_metrics_lock = threading.Lock()
+
+# プールの名前（create_engineのpool_logging_name）ごとの集計値
+def get_pool_metrics(name: str) -> PoolMetrics:
+    with _pool_metrics_lock:
+        return _pool_metrics.setdefault(name, PoolMetrics())
+
+# このプロセスの全てのプールの集計値
+def pool_metrics_snapshot() -> Dict[str, dict]:
+    with _pool_metrics_lock:
+        metrics = dict(_pool_metrics)
+    return {name: pool.snapshot() for name, pool in metrics.items()}
+
+# 接続の取得にかかった時間を計測するプール
+# 待ち時間はプールのイベントでは分からないため、貸し出し処理（connect）を計測する
+# プールを作り直した場合（dispose後など）もイベントと名前は引き継がれる
+class InstrumentedQueuePool(QueuePool):
+
+    @property
+    def metrics(self) -> PoolMetrics:
+        return get_pool_metrics(self._orig_logging_name or 'default')
+
+    def connect(self):
+        overflow = self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.metrics.record_timeout(time.perf_counter() - start)
+            raise
+        # 取得中にプールのサイズを超えて新しい接続を作成した場合は上限超過として数える
+        self.metrics.record_wait(time.perf_counter() - start, self.overflow() > max(overflow, 0))
+        return connection
+
+# 非同期エンジン（create_async_engine）用のプール
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+# プールのイベントで、使用中の接続数と接続の寿命を集計する
+def instrument_pool(pool, name: str):
+    metrics = get_pool_metrics(name)
+
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['connected_at'] = time.monotonic()
+        metrics.record_connect()
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.record_checkout()
+
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.record_checkin()
+
+    def on_close(dbapi_connection, connection_record):
+        connected_at = connection_record.info.get('connected_at')
+        metrics.record_close(time.monotonic() - connected_at if connected_at is not None else None)
+
+    event.listen(pool, 'connect', on_connect)
+    event.listen(pool, 'checkout', on_checkout)
+    event.listen(pool, 'checkin', on_checkin)
+    event.listen(pool, 'close', on_close)
+
+# SQLのログ（ログの書き出しは別スレッドで行い、リクエストの処理を待たせない）
+sql_logger = logging.getLogger('db.sql')
+_sql_log_listener = None
+
+def _start_sql_log_listener():
+    global _sql_log_listener
+    if _sql_log_listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    _sql_log_listener = logging.handlers.QueueListener(log_queue, handler)
+    _sql_log_listener.start()
+
+    sql_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    sql_logger.setLevel(logging.INFO)
+    sql_logger.propagate = False
+
+# 実行するSQLのうちsample_rateの割合だけログに出力する（1.0で全件）
+def enable_sql_log(engine, sample_rate: float):
+    if sample_rate <= 0:
+        return
+    _start_sql_log_listener()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def log_statement(conn, cursor, statement, parameters, context, executemany):
+        if sample_rate >= 1 or random.random() < sample_rate:
+            sql_logger.info("%s %r", statement, parameters)
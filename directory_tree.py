@@ -0,0 +1,372 @@
+# ディレクトリの階層（parent_idと祖先・子孫のクロージャテーブル）を管理する
+# 子ディレクトリはparent_id、配下のディレクトリはcd_directory_closuresのインデックスで取得する
+# pathはストレージ上のパスとして引き続き保持する
+from datetime import datetime
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+from sqlalchemy import func, insert, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+from models import Directory, DirectoryClosure, File, Permission
+from db import ENGINE, ASYNC_ENGINE, SessionLocal, AsyncSessionLocal
+import os
+import time
+
+# .envファイルを読み込む
+load_dotenv()
+
+# 一括登録する行数
+DIRECTORY_TREE_BATCH_SIZE = 1000
+
+# ディレクトリツリーのキャッシュの有効期間（秒）
+# 同じプロセス内の変更はバージョンで即時に反映し、他のプロセスでの変更はこの期間が過ぎてから反映される
+DIRECTORY_TREE_CACHE_TTL = float(os.getenv('DIRECTORY_TREE_CACHE_TTL', '60'))
+
+# ストレージ上のディレクトリのパス（ルートは空文字、それ以外は「親/名前/」）
+def directory_storage_path(directory) -> str:
+    if directory.directory_class == 0:
+        return ''
+    return (directory.path or '') + directory.directory_name + '/'
+
+# 子ディレクトリに設定するpath（ルート直下はnull）
+def child_directory_path(directory) -> Optional[str]:
+    return directory_storage_path(directory) or None
+
+# 配下のディレクトリIDを取得するサブクエリ（include_selfがFalseの場合は自分自身を含まない）
+def descendant_ids(directory_id: int, include_self: bool = True):
+    query = select(DirectoryClosure.descendant_id).where(DirectoryClosure.ancestor_id == directory_id)
+    if not include_self:
+        query = query.where(DirectoryClosure.depth > 0)
+    return query
+
+# 作成したディレクトリを階層に追加（親の祖先全てと自分自身を祖先として登録）
+# コミットは呼び出し側で行う
+def add_directory_to_tree(db: Session, directory_id: int, parent_id: Optional[int]):
+    if parent_id is not None:
+        db.execute(
+            insert(DirectoryClosure).from_select(
+                ['ancestor_id', 'descendant_id', 'depth'],
+                select(
+                    DirectoryClosure.ancestor_id,
+                    literal(directory_id),
+                    DirectoryClosure.depth + 1
+                ).where(DirectoryClosure.descendant_id == parent_id)
+            )
+        )
+    db.execute(insert(DirectoryClosure).values(ancestor_id=directory_id, descendant_id=directory_id, depth=0))
+
+# ファイルの追加・上書き・削除に合わせて、格納先のディレクトリと全ての祖先の合計サイズ（KB）・ファイル数を増減させる
+# UPDATE ... SET total_size = total_size + deltaのため同時に実行しても値が失われない。コミットは呼び出し側で行う
+def add_directory_size(db: Session, directory_id: int, size_delta: int, files_delta: int = 0):
+    if not size_delta and not files_delta:
+        return
+    db.query(Directory)\
+        .filter(Directory.id.in_(
+            select(DirectoryClosure.ancestor_id).where(DirectoryClosure.descendant_id == directory_id)
+        ))\
+        .update(
+            {
+                Directory.total_size: Directory.total_size + size_delta,
+                Directory.total_files: Directory.total_files + files_delta
+            },
+            synchronize_session=False
+        )
+
+# ディレクトリを削除する前に、配下のファイルの分を親より上の祖先から減らす（subtree_idsは削除するディレクトリIDのサブクエリ）
+# 削除するディレクトリの集計値ではなくファイルから集計するため、集計値がずれていても祖先の値は正しく減る
+def remove_subtree_size(db: Session, parent_id: Optional[int], subtree_ids):
+    if parent_id is None:
+        return
+    total = db.query(func.coalesce(func.sum(File.file_size), 0), func.count(File.id))\
+        .filter(
+            File.directory_id.in_(subtree_ids),
+            File.delete_flg == False
+        )\
+        .one()
+    add_directory_size(db, parent_id, -int(total[0]), -int(total[1]))
+
+# キャッシュするディレクトリの情報
+# 合計サイズ・ファイル数はファイルの更新時にDirectoryTreeCache.add_size()でキャッシュにも反映する
+class DirectoryNode(NamedTuple):
+    id: int
+    parent_id: Optional[int]
+    directory_name: Optional[str]
+    path: Optional[str]
+    directory_class: int
+    open_flg: bool
+    update_at: Optional[datetime]
+    total_size: int
+    total_files: int
+
+# 会社の削除されていないディレクトリと、非公開ディレクトリのアクセス権を持つユーザー
+# nodesはDBの照合順序での名前順に並べて渡す（一覧はキャッシュ前のクエリと同じ順序で返す）
+class DirectoryTree:
+
+    def __init__(self, version: int, nodes: Dict[int, DirectoryNode], permitted_users: Dict[int, FrozenSet[int]]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.nodes = nodes
+        self.permitted_users = permitted_users
+        self.children = {}  # 親ディレクトリID -> 直下のディレクトリIDのリスト（名前順）
+        for node in nodes.values():
+            if node.parent_id is not None:
+                self.children.setdefault(node.parent_id, []).append(node.id)
+
+    def get(self, directory_id: int) -> Optional[DirectoryNode]:
+        return self.nodes.get(directory_id)
+
+    # 直下のディレクトリ（名前順）
+    def get_children(self, directory_id: int) -> List[DirectoryNode]:
+        return [self.nodes[child_id] for child_id in self.children.get(directory_id, [])]
+
+    # ディレクトリとその祖先の合計サイズ・ファイル数を増減
+    def add_size(self, directory_id: int, size_delta: int, files_delta: int = 0):
+        node = self.nodes.get(directory_id)
+        while node is not None:
+            self.nodes[node.id] = node._replace(
+                total_size=node.total_size + size_delta,
+                total_files=node.total_files + files_delta
+            )
+            node = self.nodes.get(node.parent_id) if node.parent_id is not None else None
+
+    # 公開ディレクトリか、ユーザーがアクセス権を持つディレクトリの場合True
+    def is_visible(self, node: DirectoryNode, user_id: int) -> bool:
+        return not node.open_flg or user_id in self.permitted_users.get(node.id, frozenset())
+
+    # ユーザーが参照できるルート以外の全てのディレクトリ（名前順）
+    def visible_directories(self, user_id: int) -> List[DirectoryNode]:
+        return [
+            node for node in self.nodes.values()
+            if node.directory_class != 0 and self.is_visible(node, user_id)
+        ]
+
+# 会社ごとのディレクトリツリーをプロセス内に保持するキャッシュ
+# ディレクトリを変更したらinvalidate()でバージョンを上げ、次の参照時に読み直す
+# 非同期のセッションからはget_async()で参照する（読み込み中もイベントループを止めない）
+# ツリーはプロセス内の全てのリクエストで共有するため、レプリカのセッションで参照した場合もプライマリから読み込む
+# （反映が遅れたレプリカから読み込んだツリーを、書き込んだ直後のクライアントに返さないようにする）
+class DirectoryTreeCache:
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._trees = {}
+        self._versions = {}
+
+    # 有効なキャッシュがあれば返す（なければNoneと読み込み前のバージョン）
+    def _cached(self, company_id: int):
+        version = self._versions.get(company_id, 0)
+        tree = self._trees.get(company_id)
+        if tree is None or tree.version != version or time.monotonic() - tree.loaded_at >= self.ttl:
+            return None, version
+        return tree, version
+
+    def get(self, db: Session, company_id: int) -> DirectoryTree:
+        tree, version = self._cached(company_id)
+        if tree is not None:
+            return tree
+
+        # 読み込み中にバージョンが上がった場合は、次の参照時に読み直す
+        if db.get_bind() is ENGINE:
+            tree = self._load(db, version, company_id)
+        else:
+            with SessionLocal() as primary_db:
+                tree = self._load(primary_db, version, company_id)
+        self._trees[company_id] = tree
+        return tree
+
+    async def get_async(self, db: AsyncSession, company_id: int) -> DirectoryTree:
+        tree, version = self._cached(company_id)
+        if tree is not None:
+            return tree
+
+        if db.bind is ASYNC_ENGINE:
+            tree = await self._load_async(db, version, company_id)
+        else:
+            async with AsyncSessionLocal() as primary_db:
+                tree = await self._load_async(primary_db, version, company_id)
+        self._trees[company_id] = tree
+        return tree
+
+    def invalidate(self, company_id: int):
+        self._versions[company_id] = self._versions.get(company_id, 0) + 1
+        self._trees.pop(company_id, None)
+
+    # ファイルの追加・上書き・削除による合計サイズ・ファイル数の増減を、キャッシュしたツリーに反映する（コミット後に呼ぶ）
+    # ディレクトリの構成は変わらないため、ツリー全体は読み直さない
+    # 有効なツリーがない場合は、読み込み中のツリーに反映されないことがあるため無効にする
+    def add_size(self, company_id: int, directory_id: int, size_delta: int, files_delta: int = 0):
+        tree, _ = self._cached(company_id)
+        if tree is None:
+            self.invalidate(company_id)
+            return
+        tree.add_size(directory_id, size_delta, files_delta)
+
+    # 会社の削除されていないディレクトリと、非公開ディレクトリのアクセス権を取得するクエリ
+    @staticmethod
+    def _queries(company_id: int):
+        directory_query = select(
+                Directory.id,
+                Directory.parent_id,
+                Directory.directory_name,
+                Directory.path,
+                Directory.directory_class,
+                Directory.open_flg,
+                Directory.update_at,
+                Directory.total_size,
+                Directory.total_files
+            )\
+            .where(
+                Directory.company_id == company_id,
+                Directory.delete_flg == False
+            )\
+            .order_by(Directory.directory_name, Directory.id)
+        permission_query = select(Permission.directory_id, Permission.user_id)\
+            .join(Directory, Directory.id == Permission.directory_id)\
+            .where(
+                Directory.company_id == company_id,
+                Directory.delete_flg == False,
+                Directory.open_flg == True
+            )
+        return directory_query, permission_query
+
+    def _load(self, db: Session, version: int, company_id: int) -> DirectoryTree:
+        directory_query, permission_query = self._queries(company_id)
+        return self._build(version, db.execute(directory_query).all(), db.execute(permission_query).all())
+
+    async def _load_async(self, db: AsyncSession, version: int, company_id: int) -> DirectoryTree:
+        directory_query, permission_query = self._queries(company_id)
+        directory_rows = (await db.execute(directory_query)).all()
+        permission_rows = (await db.execute(permission_query)).all()
+        return self._build(version, directory_rows, permission_rows)
+
+    @staticmethod
+    def _build(version: int, directory_rows, permission_rows) -> DirectoryTree:
+        nodes = {row.id: DirectoryNode(*row) for row in directory_rows}
+
+        permitted_users = {}
+        for row in permission_rows:
+            permitted_users.setdefault(row.directory_id, set()).add(row.user_id)
+
+        return DirectoryTree(
+            version,
+            nodes,
+            {directory_id: frozenset(user_ids) for directory_id, user_ids in permitted_users.items()}
+        )
+
+_directory_tree_cache = DirectoryTreeCache(DIRECTORY_TREE_CACHE_TTL)
+
+# プロセスで共有するディレクトリツリーのキャッシュ
+def get_directory_tree_cache() -> DirectoryTreeCache:
+    return _directory_tree_cache
+
+# 既存のpathからparent_idとクロージャテーブルを作成し直す（company_idを指定した場合はその会社のみ）
+# 同じパスのディレクトリが複数ある場合（削除済みのものなど）は削除されていないものを親とする
+def backfill_directory_tree(db: Session, company_id: Optional[int] = None) -> int:
+    query = db.query(
+        Directory.id,
+        Directory.company_id,
+        Directory.path,
+        Directory.directory_name,
+        Directory.directory_class,
+        Directory.delete_flg
+    )
+    if company_id is not None:
+        query = query.filter(Directory.company_id == company_id)
+    directories = query.order_by(Directory.delete_flg, Directory.id).all()
+
+    roots = {}
+    directory_by_path = {}
+    for directory in directories:
+        if directory.directory_class == 0:
+            roots.setdefault(directory.company_id, directory.id)
+        else:
+            directory_by_path.setdefault((directory.company_id, directory_storage_path(directory)), directory.id)
+
+    parent_ids = {}
+    for directory in directories:
+        if directory.directory_class == 0:
+            parent_ids[directory.id] = None
+        elif not directory.path:
+            parent_ids[directory.id] = roots.get(directory.company_id)
+        else:
+            parent_ids[directory.id] = directory_by_path.get((directory.company_id, directory.path))
+
+    # 親をたどって祖先を求める（親が見つからないディレクトリはそこで打ち切る）
+    closure_rows = []
+    for directory_id in parent_ids:
+        ancestor_id = directory_id
+        depth = 0
+        visited = set()
+        while ancestor_id is not None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            closure_rows.append({"ancestor_id": ancestor_id, "descendant_id": directory_id, "depth": depth})
+            ancestor_id = parent_ids.get(ancestor_id)
+            depth += 1
+
+    directory_ids = list(parent_ids)
+    for start in range(0, len(directory_ids), DIRECTORY_TREE_BATCH_SIZE):
+        batch = directory_ids[start:start + DIRECTORY_TREE_BATCH_SIZE]
+        db.query(DirectoryClosure)\
+            .filter(DirectoryClosure.descendant_id.in_(batch))\
+            .delete(synchronize_session=False)
+
+    db.bulk_update_mappings(Directory, [
+        {"id": directory_id, "parent_id": parent_id} for directory_id, parent_id in parent_ids.items()
+    ])
+    for start in range(0, len(closure_rows), DIRECTORY_TREE_BATCH_SIZE):
+        db.execute(insert(DirectoryClosure), closure_rows[start:start + DIRECTORY_TREE_BATCH_SIZE])
+
+    return len(directory_ids)
+
+# 全てのディレクトリの合計サイズ・ファイル数を、配下の削除されていないファイルから集計し直す（company_idを指定した場合はその会社のみ）
+# 集計値と実際のファイルがずれた場合に実行する（クロージャテーブルを作成した後に実行すること）
+def reconcile_directory_sizes(db: Session, company_id: Optional[int] = None) -> int:
+    total_query = db.query(
+            DirectoryClosure.ancestor_id,
+            func.coalesce(func.sum(File.file_size), 0).label('total_size'),
+            func.count(File.id).label('total_files')
+        )\
+        .join(File, File.directory_id == DirectoryClosure.descendant_id)\
+        .join(Directory, Directory.id == DirectoryClosure.descendant_id)\
+        .filter(
+            File.delete_flg == False,
+            Directory.delete_flg == False
+        )
+    directory_query = db.query(Directory.id)
+    if company_id is not None:
+        total_query = total_query.filter(Directory.company_id == company_id)
+        directory_query = directory_query.filter(Directory.company_id == company_id)
+
+    totals = {
+        row.ancestor_id: (int(row.total_size), int(row.total_files))
+        for row in total_query.group_by(DirectoryClosure.ancestor_id).all()
+    }
+
+    # ファイルがないディレクトリは0に戻す
+    directory_ids = [row.id for row in directory_query.all()]
+    for start in range(0, len(directory_ids), DIRECTORY_TREE_BATCH_SIZE):
+        db.bulk_update_mappings(Directory, [
+            {
+                "id": directory_id,
+                "total_size": totals.get(directory_id, (0, 0))[0],
+                "total_files": totals.get(directory_id, (0, 0))[1]
+            }
+            for directory_id in directory_ids[start:start + DIRECTORY_TREE_BATCH_SIZE]
+        ])
+    return len(directory_ids)
+
+def main():
+    # 全てのディレクトリの階層と合計サイズ・ファイル数を作成し直す（列・テーブルはmigrations.pyで作成する）
+    db = SessionLocal()
+    try:
+        count = backfill_directory_tree(db)
+        db.commit()
+        print(f"backfilled directory tree for {count} directories")
+        count = reconcile_directory_sizes(db)
+        db.commit()
+        print(f"reconciled directory sizes for {count} directories")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
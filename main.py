@@ -3,10 +3,16 @@ from fastapi import FastAPI, Request
 from fastapi.responses  import JSONResponse
 from starlette.middleware.cors import CORSMiddleware  # CORSを回避するために必要
 # from api.models import Assignment
-from routers import auth, directory,company,file,favorite,user,department,region,industry
+from routers import auth, directory,company,file,favorite,user,department,region,industry,sync,search,system
 from fastapi_csrf_protect import CsrfProtect
 from fastapi_csrf_protect.exceptions import CsrfProtectError
 from schemas.auth import CsrfSettings
+from storage import get_storage
+from db import ENGINE, ASYNC_ENGINE, READ_ENGINE, ASYNC_READ_ENGINE, PRIMARY_PIN_COOKIE, DB_PRIMARY_PIN_SECONDS, track_primary_writes
+from storage_usage import run_reservation_reaper
+from change_log import run_change_log_compactor
+from migrations import apply_migrations
+import asyncio
 import os
 
 app = FastAPI()
@@ -19,7 +25,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"]
+    expose_headers=["Content-Disposition", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified"]
 )
 
 @app.middleware("http")
@@ -30,6 +36,57 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
+# プライマリに書き込んだクライアントには、一定時間は読み取りもプライマリで行うようCookieを設定する
+@app.middleware("http")
+async def pin_primary_after_write(request: Request, call_next):
+    writes = track_primary_writes()
+    response = await call_next(request)
+    if writes[0] and READ_ENGINE is not ENGINE:
+        response.set_cookie(
+            key=PRIMARY_PIN_COOKIE,
+            value=str(time.time() + DB_PRIMARY_PIN_SECONDS),
+            max_age=int(DB_PRIMARY_PIN_SECONDS) + 1,
+            httponly=True,
+            samesite="none",
+            secure=True
+        )
+    return response
+
+# 未適用のスキーマの変更（テーブル・列・インデックス）を適用する
+@app.on_event("startup")
+async def prepare_database():
+    await asyncio.to_thread(apply_migrations)
+
+# 期限切れになったストレージ容量の予約をバックグラウンドで解放する
+@app.on_event("startup")
+async def start_reservation_reaper():
+    app.state.reservation_reaper = asyncio.create_task(run_reservation_reaper())
+
+@app.on_event("shutdown")
+async def stop_reservation_reaper():
+    app.state.reservation_reaper.cancel()
+
+# 保存期間を過ぎた変更履歴をバックグラウンドで削除する
+@app.on_event("startup")
+async def start_change_log_compactor():
+    app.state.change_log_compactor = asyncio.create_task(run_change_log_compactor())
+
+@app.on_event("shutdown")
+async def stop_change_log_compactor():
+    app.state.change_log_compactor.cancel()
+
+# 終了時にストレージの接続（AzureのHTTPセッションなど）を閉じる
+@app.on_event("shutdown")
+async def shutdown_storage():
+    await get_storage().close()
+
+# 終了時に非同期のDB接続を閉じる
+@app.on_event("shutdown")
+async def shutdown_async_db():
+    await ASYNC_ENGINE.dispose()
+    if ASYNC_READ_ENGINE is not ASYNC_ENGINE:
+        await ASYNC_READ_ENGINE.dispose()
+
 @CsrfProtect.load_config
 def get_csrf_config():
   return CsrfSettings()
@@ -52,6 +109,9 @@ app.include_router(department.router)
 # app.include_router(permission.router)
 app.include_router(region.router)
 app.include_router(industry.router)
+app.include_router(sync.router)
+app.include_router(search.router)
+app.include_router(system.router)
 
 
 
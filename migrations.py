@@ -0,0 +1,225 @@
+# DBのスキーマの変更（テーブル・列・インデックスの追加と、それに伴うデータの作成）をバージョン順に適用する
+# 適用したバージョンはschema_migrationsに記録し、アプリケーションの起動時に未適用のものだけを適用する
+# models.pyから作成したDBや、以前の起動時の処理で一部が作成済みのDBでも実行できるよう、各変更は存在を確認してから行う
+# MySQLのCREATE TABLE・ALTER TABLEは即時にコミットされ、データの作成が失敗してもテーブル・列は残るため、
+# データの作成はテーブル・列が既にあっても、バージョンが記録されていなければ毎回やり直す
+from datetime import datetime
+from typing import Callable, List, NamedTuple
+from sqlalchemy import func, inspect, text
+from sqlalchemy.orm import Session
+from models import Directory, DirectoryClosure, Permission, File, Favorite, User, StorageUsage, StorageReservation, \
+    Change, ChangeLock, SearchEntry, SearchGram, SchemaMigration
+from db import ENGINE
+from directory_tree import backfill_directory_tree, reconcile_directory_sizes
+from search_index import rebuild_search_index
+from storage_usage import reconcile_storage_usage
+
+# 複数のワーカーが同時に起動した場合に、1つのワーカーだけが適用するためのロック（MySQLのGET_LOCK）
+SCHEMA_MIGRATION_LOCK = 'schema_migrations'
+SCHEMA_MIGRATION_LOCK_TIMEOUT = 600
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Session], None]
+
+# マイグレーションを適用できない状態の場合の例外（重複データなど、手作業での確認が必要なもの）
+class MigrationError(Exception):
+    pass
+
+def _has_table(db: Session, table_name: str) -> bool:
+    return inspect(db.connection()).has_table(table_name)
+
+def _column_names(db: Session, table_name: str) -> set:
+    return {column['name'] for column in inspect(db.connection()).get_columns(table_name)}
+
+def _index_names(db: Session, table_name: str) -> set:
+    inspector = inspect(db.connection())
+    return {index['name'] for index in inspector.get_indexes(table_name)} | \
+        {constraint['name'] for constraint in inspector.get_unique_constraints(table_name)}
+
+# テーブルがなければ作成する
+def _create_table(db: Session, model):
+    if not _has_table(db, model.__tablename__):
+        model.__table__.create(bind=db.connection())
+
+# models.pyで宣言したインデックスのうち、まだないものを作成する
+def _create_indexes(db: Session, model, *index_names: str):
+    existing = _index_names(db, model.__tablename__)
+    for index in model.__table__.indexes:
+        if index.name in index_names and index.name not in existing:
+            index.create(bind=db.connection())
+
+# 1: ユーザー・部署・会社ごとの使用量と、アップロード中の予約
+# 既存のファイルの使用量は7で集計する
+def _storage_usage(db: Session):
+    _create_table(db, StorageUsage)
+    _create_table(db, StorageReservation)
+    if 'reserved_size' not in _column_names(db, StorageUsage.__tablename__):
+        db.execute(text('ALTER TABLE cd_storage_usages ADD COLUMN reserved_size BIGINT NOT NULL DEFAULT 0'))
+
+# 2: ディレクトリの階層（parent_idとクロージャテーブル）を作成し、既存のpathから作成する
+def _directory_tree(db: Session):
+    _create_table(db, DirectoryClosure)
+    if 'parent_id' not in _column_names(db, Directory.__tablename__):
+        db.execute(text(
+            'ALTER TABLE cd_directories '
+            'ADD COLUMN parent_id INTEGER NULL, '
+            'ADD INDEX ix_cd_directories_parent_id (parent_id), '
+            'ADD FOREIGN KEY (parent_id) REFERENCES cd_directories (id)'
+        ))
+
+    count = backfill_directory_tree(db)
+    print(f"backfilled directory tree for {count} directories")
+
+# 3: ディレクトリ・ファイルの変更履歴
+def _change_log(db: Session):
+    _create_table(db, Change)
+
+# 4: 検索用の索引を作成し、既存のディレクトリ・ファイルを登録する
+def _search_index(db: Session):
+    _create_table(db, SearchEntry)
+    _create_table(db, SearchGram)
+    count = rebuild_search_index(db)
+    print(f"built search index for {count} entries")
+
+# 5: ディレクトリごとの配下を含む合計サイズ・ファイル数を作成し、ファイルから集計する
+def _directory_sizes(db: Session):
+    if 'total_size' not in _column_names(db, Directory.__tablename__):
+        db.execute(text(
+            'ALTER TABLE cd_directories '
+            'ADD COLUMN total_size BIGINT NOT NULL DEFAULT 0, '
+            'ADD COLUMN total_files INTEGER NOT NULL DEFAULT 0'
+        ))
+    count = reconcile_directory_sizes(db)
+    print(f"reconciled directory sizes for {count} directories")
+
+# 6: 一覧・ログイン・アクセス権の確認などで使用する条件のインデックスと一意制約
+def _hot_query_indexes(db: Session):
+    # 同じディレクトリ・ユーザーのアクセス権が重複している場合は、最初の行を残して削除する（権限は変わらない）
+    duplicated_permissions = db.query(Permission.directory_id, Permission.user_id, func.min(Permission.id).label('keep_id'))\
+        .group_by(Permission.directory_id, Permission.user_id)\
+        .having(func.count(Permission.id) > 1)\
+        .all()
+    for row in duplicated_permissions:
+        db.query(Permission)\
+            .filter(
+                Permission.directory_id == row.directory_id,
+                Permission.user_id == row.user_id,
+                Permission.id != row.keep_id
+            )\
+            .delete(synchronize_session=False)
+
+    # お気に入り名の重複はどちらを残すか決められないため、適用を中止する
+    duplicated_favorites = db.query(Favorite.user_id, Favorite.favorite_name)\
+        .group_by(Favorite.user_id, Favorite.favorite_name)\
+        .having(func.count(Favorite.id) > 1)\
+        .all()
+    if duplicated_favorites:
+        raise MigrationError(
+            "duplicated favorite names must be renamed before adding uq_cd_favorites_user_name: " +
+            ", ".join(f"user_id={row.user_id} name={row.favorite_name!r}" for row in duplicated_favorites)
+        )
+
+    _create_indexes(db, File, 'ix_cd_files_directory_listing', 'ix_cd_files_user_id_delete_flg')
+    _create_indexes(db, Directory, 'ix_cd_directories_company_path')
+    _create_indexes(db, Permission, 'uq_cd_permissions_directory_user')
+    _create_indexes(db, Favorite, 'uq_cd_favorites_user_name')
+    _create_indexes(db, User, 'ix_users_personal_id')
+
+# 7: 既存のファイルから使用量の集計値を作成する
+# 集計値の行はアップロード・削除の時にしか作成されないため、それまでの会社の使用量が一覧・レポートで0にならないようにする
+def _storage_usage_counters(db: Session):
+    usage = reconcile_storage_usage(db)
+    print(f"reconciled {len(usage)} storage usage rows")
+
+# 8: 変更履歴のidをコミット順にするための会社ごとのロック
+def _change_log_locks(db: Session):
+    _create_table(db, ChangeLock)
+
+# 9: 部分一致検索の2文字の組を、文字を区別する照合順序にする
+# 以前の照合順序で同じとみなされてまとめられた組を登録し直すため、索引は作成し直す
+def _search_gram_collation(db: Session):
+    collation = db.execute(text(
+        "SELECT COLLATION_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cd_search_grams' AND COLUMN_NAME = 'gram'"
+    )).scalar()
+    if collation != 'utf8mb4_bin':
+        db.execute(text('ALTER TABLE cd_search_grams MODIFY gram VARCHAR(2) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL'))
+    count = rebuild_search_index(db)
+    print(f"rebuilt search index for {count} entries")
+
+# 10: ファイルの更新日時をマイクロ秒まで保持する
+# ダウンロードのキャッシュのキーに使用するため、同じ秒内に上書きされたファイルが古い内容のまま配信されないようにする
+def _file_update_at_precision(db: Session):
+    precision = db.execute(text(
+        "SELECT DATETIME_PRECISION FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cd_files' AND COLUMN_NAME = 'file_update_at'"
+    )).scalar()
+    if precision != 6:
+        db.execute(text('ALTER TABLE cd_files MODIFY file_update_at DATETIME(6) NULL'))
+
+# 適用するマイグレーション（追加する場合は末尾に次のバージョンで追加し、適用済みのものは変更しない）
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'storage_usage', _storage_usage),
+    Migration(2, 'directory_tree', _directory_tree),
+    Migration(3, 'change_log', _change_log),
+    Migration(4, 'search_index', _search_index),
+    Migration(5, 'directory_sizes', _directory_sizes),
+    Migration(6, 'hot_query_indexes', _hot_query_indexes),
+    Migration(7, 'storage_usage_counters', _storage_usage_counters),
+    Migration(8, 'change_log_locks', _change_log_locks),
+    Migration(9, 'search_gram_collation', _search_gram_collation),
+    Migration(10, 'file_update_at_precision', _file_update_at_precision),
+]
+
+# 未適用のマイグレーションを順に適用し、適用したバージョンを返す（アプリケーションの起動時に実行）
+def apply_migrations(engine=ENGINE) -> List[int]:
+    applied = []
+    with engine.connect() as connection:
+        use_lock = connection.dialect.name == 'mysql'
+        if use_lock:
+            locked = connection.execute(
+                text('SELECT GET_LOCK(:name, :timeout)'),
+                {"name": SCHEMA_MIGRATION_LOCK, "timeout": SCHEMA_MIGRATION_LOCK_TIMEOUT}
+            ).scalar()
+            if locked != 1:
+                raise MigrationError("timed out waiting for another process to finish applying migrations")
+
+        try:
+            db = Session(bind=connection)
+            try:
+                _create_table(db, SchemaMigration)
+                db.commit()
+                done = {row.version for row in db.query(SchemaMigration.version).all()}
+                db.commit()
+
+                for migration in MIGRATIONS:
+                    if migration.version in done:
+                        continue
+                    print(f"applying migration {migration.version} {migration.name}")
+                    try:
+                        migration.apply(db)
+                        db.add(SchemaMigration(version=migration.version, name=migration.name, applied_at=datetime.now()))
+                        db.commit()
+                    except BaseException:
+                        db.rollback()
+                        raise
+                    applied.append(migration.version)
+            finally:
+                db.close()
+        finally:
+            if use_lock:
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), {"name": SCHEMA_MIGRATION_LOCK})
+
+    return applied
+
+def main():
+    applied = apply_migrations()
+    if applied:
+        print(f"applied migrations {applied}")
+    else:
+        print("database schema is up to date")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Boolean, UniqueConstraint, Index
 from sqlalchemy.types import Date, DateTime
+from sqlalchemy.dialects.mysql import DATETIME
 from db import Base
 from db import ENGINE
 
@@ -19,6 +20,8 @@ class Company(Base):
 
 class User(Base):
     __tablename__ = 'users'
+    # ログイン時の検索用（削除済みのユーザーと同じIDを使えるよう一意にはしない）
+    __table_args__ = (Index('ix_users_personal_id', 'personal_id'),)
     id = Column(Integer, primary_key=True)
     company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
     department_id = Column(Integer, ForeignKey('departments.id'), nullable=False)
@@ -41,8 +44,13 @@ class User(Base):
 
 class Directory(Base):
     __tablename__ = 'cd_directories'
+    # 会社・パスでの検索用（pathは長いため先頭255文字をインデックスにする）
+    __table_args__ = (
+        Index('ix_cd_directories_company_path', 'company_id', 'path', 'delete_flg', 'open_flg', mysql_length={'path': 255}),
+    )
     id = Column(Integer, primary_key=True)
     company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    parent_id = Column(Integer, ForeignKey('cd_directories.id'), index=True)  # ルートディレクトリはnull
     path = Column(String(1000), nullable=False)
     directory_name = Column(String(100), nullable=False)
     directory_class = Column(Integer, nullable=False)
@@ -52,6 +60,17 @@ class Directory(Base):
     create_acc = Column(Integer, ForeignKey('users.id'), nullable=False)
     update_at = Column(DateTime)
     update_acc = Column(Integer)
+    total_size = Column(BigInteger, nullable=False, default=0)  # 配下のディレクトリを含むファイルの合計サイズ（KB）
+    total_files = Column(Integer, nullable=False, default=0)  # 配下のディレクトリを含むファイル数
+
+# ディレクトリの祖先と子孫の組み合わせ（自分自身もdepth=0で含む）
+# 配下のディレクトリをパスの文字列検索ではなく、インデックスで取得するために使用する
+class DirectoryClosure(Base):
+    __tablename__ = 'cd_directory_closures'
+    __table_args__ = (Index('ix_cd_directory_closures_descendant', 'descendant_id', 'depth'),)
+    ancestor_id = Column(Integer, ForeignKey('cd_directories.id'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey('cd_directories.id'), primary_key=True)
+    depth = Column(Integer, nullable=False)
 
 class Department(Base):
     __tablename__ = 'departments'
@@ -78,6 +97,7 @@ class Assignment(Base):
 
 class Permission(Base):
     __tablename__ = 'cd_permissions'
+    __table_args__ = (Index('uq_cd_permissions_directory_user', 'directory_id', 'user_id', unique=True),)
     id = Column(Integer, primary_key=True)
     directory_id = Column(Integer, ForeignKey('cd_directories.id'), nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -88,6 +108,11 @@ class Permission(Base):
 
 class File(Base):
     __tablename__ = 'cd_files'
+    # ディレクトリ内の一覧（名前順）と、ユーザーごとの使用量の集計用
+    __table_args__ = (
+        Index('ix_cd_files_directory_listing', 'directory_id', 'delete_flg', 'file_name'),
+        Index('ix_cd_files_user_id_delete_flg', 'user_id', 'delete_flg'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     directory_id = Column(Integer, ForeignKey('cd_directories.id'), nullable=False)
@@ -95,7 +120,8 @@ class File(Base):
     file_name = Column(String(100), nullable=False)
     file_size = Column(Integer, nullable=False)
     delete_flg = Column(Boolean, nullable=False)
-    file_update_at = Column(DateTime)
+    # ダウンロードのキャッシュのキーに使用するため、同じ秒内の更新も区別できるようマイクロ秒まで保持する
+    file_update_at = Column(DateTime().with_variant(DATETIME(fsp=6), 'mysql'))
     create_at = Column(DateTime)
     create_acc = Column(Integer, ForeignKey('users.id'), nullable=False)
     update_at = Column(DateTime)
@@ -103,6 +129,7 @@ class File(Base):
 
 class Favorite(Base):
     __tablename__ = 'cd_favorites'
+    __table_args__ = (Index('uq_cd_favorites_user_name', 'user_id', 'favorite_name', unique=True),)
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     directory_id = Column(Integer, ForeignKey('cd_directories.id'), nullable=False)
@@ -117,6 +144,75 @@ class FileType(Base):
     extension_name = Column(String(50), nullable=False)
     icon = Column(Integer)
 
+# ユーザー・部署・会社ごとのストレージ使用量（KB）
+# アップロード・削除のたびに増減させ、容量チェック時にファイルを集計しなくて済むようにする
+class StorageUsage(Base):
+    __tablename__ = 'cd_storage_usages'
+    __table_args__ = (UniqueConstraint('owner_type', 'owner_id'),)
+    id = Column(Integer, primary_key=True)
+    owner_type = Column(String(20), nullable=False)  # user / department / company
+    owner_id = Column(Integer, nullable=False)
+    used_size = Column(BigInteger, nullable=False, default=0)
+    reserved_size = Column(BigInteger, nullable=False, default=0)  # アップロード中の予約分
+    update_at = Column(DateTime)
+
+# アップロード中のファイルのために確保した容量（KB）
+# アップロードが終わればused_sizeへ振り替え、失敗・期限切れの場合は解放する
+class StorageReservation(Base):
+    __tablename__ = 'cd_storage_reservations'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    department_id = Column(Integer, nullable=False)
+    company_id = Column(Integer, nullable=False)
+    reserved_size = Column(BigInteger, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    create_at = Column(DateTime)
+
+# ディレクトリ・ファイルの変更履歴（idの順に並べたものがクライアントの同期用の変更フィード）
+class Change(Base):
+    __tablename__ = 'cd_changes'
+    __table_args__ = (Index('ix_cd_changes_company_id_id', 'company_id', 'id'),)
+    id = Column(BigInteger, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    entity_type = Column(String(20), nullable=False)  # directory / file
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(20), nullable=False)  # create / update / rename / delete
+    directory_id = Column(Integer)  # 変更があったディレクトリ・ファイルの親ディレクトリ
+    name = Column(String(255))
+    create_at = Column(DateTime, nullable=False, index=True)
+    create_acc = Column(Integer)
+
+# 会社ごとの変更履歴の書き込みロック（change_log.record_changeでロックし、コミットまで保持する）
+# 同じ会社の変更履歴はこの行の順番待ちで1つずつコミットされるため、idの順とコミットの順が一致する
+class ChangeLock(Base):
+    __tablename__ = 'cd_change_locks'
+    company_id = Column(Integer, primary_key=True, autoincrement=False)
+    update_at = Column(DateTime)
+
+# ファイル名・ディレクトリ名の検索用の索引（名前は正規化して保持する）
+class SearchEntry(Base):
+    __tablename__ = 'cd_search_entries'
+    __table_args__ = (
+        UniqueConstraint('entity_type', 'entity_id'),
+        Index('ix_cd_search_entries_company_id_name', 'company_id', 'normalized_name'),
+    )
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    entity_type = Column(String(20), nullable=False)  # directory / file
+    entity_id = Column(Integer, nullable=False)
+    directory_id = Column(Integer)  # ファイルの場合は格納先、ディレクトリの場合は親ディレクトリ
+    name = Column(String(255), nullable=False)
+    normalized_name = Column(String(255), nullable=False)
+    update_at = Column(DateTime)
+
+# 部分一致検索用に、正規化した名前を2文字ずつに分割したもの
+# gramは文字を区別する照合順序にし、検索時に数える2文字の組の数をPython側の数と一致させる
+class SearchGram(Base):
+    __tablename__ = 'cd_search_grams'
+    company_id = Column(Integer, primary_key=True)
+    gram = Column(String(2, collation='utf8mb4_bin'), primary_key=True)
+    entry_id = Column(Integer, ForeignKey('cd_search_entries.id'), primary_key=True, index=True)
+
 class Region(Base):
     __tablename__ = 'regions'
     id = Column(Integer, primary_key=True)
@@ -131,6 +227,13 @@ class Industry(Base):
     industry_code = Column(String(2), nullable=False)
     industry_name = Column(String(30), nullable=False)
 
+# 適用済みのスキーマの変更（migrations.pyのバージョン）
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
 def main():
     # テーブルが存在しなければ、テーブルを作成
     Base.metadata.create_all(bind=ENGINE)
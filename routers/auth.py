@@ -2,17 +2,19 @@ from datetime import timedelta
 from typing import Annotated
 from fastapi import Response, Request, APIRouter, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette import status
 from schemas.users import UserCreate,UserResponse
 from schemas.auth import Token,Csrf
-from db import get_db
+from db import get_db, get_async_db
 from models import User
 import hashlib
 import base64
 import os
 from datetime import timedelta
-from auth import create_access_token,encode_jwt,verify_jwt,verify_update_jwt,verify_csrf_update_jwt
+from auth import create_access_token,create_user_access_token,encode_jwt,verify_jwt,verify_update_jwt,verify_csrf_update_jwt
 from datetime import datetime
 from pydantic import BaseModel
 from starlette.status import HTTP_200_OK
@@ -24,6 +26,7 @@ class OAuth2PasswordRequestFormCustom(BaseModel):
     password: str
 # csrfDependency = Annotated[CsrfProtect, Depends()]
 DbDependency = Annotated[Session, Depends(get_db)]
+AsyncDbDependency = Annotated[AsyncSession, Depends(get_async_db)]
 FormDependency = Annotated[OAuth2PasswordRequestFormCustom, Depends()]
 router = APIRouter(prefix="/auth", tags=["Auth"])
 
@@ -62,13 +65,17 @@ async def create_user(db: DbDependency,user_create: UserCreate):
 
 #ログイン機能
 @router.post("/login", response_model=Token, status_code=status.HTTP_200_OK)
-async def login(db: DbDependency, response:Response, form_data: FormDependency):
-
-    user = db.query(User)\
-           .filter(User.personal_id == form_data.personal_id\
-                  ,User.delete_flg == "false"\
-                  )\
-                  .first()
+async def login(db: AsyncDbDependency, response:Response, form_data: FormDependency):
+
+    user = (
+        await db.execute(
+            select(User)
+            .where(User.personal_id == form_data.personal_id
+                  ,User.delete_flg == "false"
+                  )
+            .limit(1)
+        )
+    ).scalars().first()
     # #ユーザー存在チェック
     if not user:
         raise HTTPException(status_code=401, detail="Incorrect personal_id")
@@ -80,8 +87,9 @@ async def login(db: DbDependency, response:Response, form_data: FormDependency):
     if user.password != hashed_password:
         raise HTTPException(status_code=401, detail="Incorrect password")
 
-    token = create_access_token(
-        db, user.personal_id, timedelta(days=30)
+    # 取得したユーザー情報からトークンを作成（ユーザーを取得し直さない）
+    token = create_user_access_token(
+        user, timedelta(days=30)
         # user.username, user.id, timedelta(minutes=5)        
     )
     response.status_code = HTTP_200_OK
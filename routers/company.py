@@ -7,7 +7,8 @@ from db import get_db
 from sqlalchemy.orm import Session
 from schemas.auth import DecodedToken
 from auth import get_current_user
-from azure_access import add_azure_share_client, delete_azure_share_client
+from storage import get_storage
+from directory_tree import add_directory_to_tree
 from schemas.companies import CompanyCreate,CompanyResponse,CompanyUpdate,CompanyDirectoryCreate
 from datetime import datetime
 from pydantic import BaseModel
@@ -122,7 +123,7 @@ async def create(db: DbDependency, user: UserDependency, user_create: CompanyCre
     #     raise HTTPException(status_code=409, detail="Storage name already exists")
 
     # Azureのストレージを作成
-    add_azure_share_client(user_create.storage_name)
+    await get_storage().create_share(user_create.storage_name)
 
     new_company = Company(
         industry_id = user_create.industry_id,
@@ -167,6 +168,8 @@ async def create(db: DbDependency, user: UserDependency, user_create: CompanyCre
     )
 
     db.add(new_directory)
+    db.flush()
+    add_directory_to_tree(db, new_directory.id, None)
     db.commit()
     db.refresh(new_directory)
 
@@ -244,7 +247,7 @@ async def delete(db: DbDependency, user: UserDependency, company_id: int):
         raise HTTPException(status_code=404, detail="Company not found")
     
     # share_clientの削除
-    delete_azure_share_client(company_query.storage_name)
+    await get_storage().delete_share(company_query.storage_name)
 
     db.delete(company_query)
     db.commit()
@@ -1,18 +1,27 @@
 from fastapi import Depends, APIRouter, status, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import Annotated, List
-from schemas.directories import DirectoryResponse, DirectoryCreate, DirectoryRename, DirectoryDelete
+from schemas.directories import DirectoryResponse, DirectoryCreate, DirectoryRename, DirectoryDelete, DirectoryArchive, DirectoryCascadeResponse
 from schemas.auth import DecodedToken
 from auth import get_current_user
-from db import get_db
-from models import Company, Directory, Permission, File
-from sqlalchemy import or_, and_
+from db import get_db, get_async_db, get_async_read_db
+from models import Company, Directory, DirectoryClosure, Permission, File
+from sqlalchemy import or_, and_, func, select
 from datetime import datetime
-from azure_access import create_azure_folder, rename_azure_folder, delete_azure_folder_recursive, get_azure_directory_list
+from storage import get_storage
+from storage.archive import ArchiveEntry, stream_zip
+from storage_usage import release_directory_files_usage
+from change_log import CHANGE_ENTITY_DIRECTORY, CHANGE_ACTION_CREATE, CHANGE_ACTION_RENAME, CHANGE_ACTION_DELETE, record_change
+from search_index import index_entry, remove_directories
+from directory_tree import directory_storage_path, child_directory_path, descendant_ids, add_directory_to_tree, remove_subtree_size, get_directory_tree_cache
+from urllib.parse import quote
 import os
 
 DbDependency = Annotated[Session, Depends(get_db)]
+AsyncDbDependency = Annotated[AsyncSession, Depends(get_async_db)]
+AsyncReadDbDependency = Annotated[AsyncSession, Depends(get_async_read_db)]
 UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
 router = APIRouter(prefix="/directory", tags=["directory"])
 
@@ -28,54 +37,37 @@ def get_user_storage_name(db: Session, user_id: int) -> str:
     return storage_name_query.storage_name
 
 @router.get('/get_all_directory', response_model=List[DirectoryResponse], status_code=status.HTTP_200_OK)
-async def get_all_directories(db: DbDependency, user: UserDependency):
-    query_result = (
-        db.query(
-            Directory.id,
-            Directory.directory_name,
-            Directory.path,
-            Directory.directory_class
-        )
-        .outerjoin(
-            Permission,
-            and_(
-                Directory.id == Permission.directory_id,
-                Permission.user_id == user.user_id
-            )
-        )
-        .filter(
-            Directory.company_id == user.company_id,
-            Directory.directory_class != 0,
-            Directory.delete_flg == False,
-            or_(
-                Directory.open_flg == 0,  # 公開ディレクトリ
-                Permission.id.isnot(None)  # ユーザーがアクセス権を持つディレクトリ
-            )
-        )
-        .order_by(Directory.directory_name)
-        .all()
-    )
+async def get_all_directories(db: AsyncReadDbDependency, user: UserDependency):
+    # 会社のディレクトリツリーはキャッシュから取得し、公開ディレクトリとアクセス権を持つディレクトリのみ返す
+    tree = await get_directory_tree_cache().get_async(db, user.company_id)
 
     get_result = [
         DirectoryResponse(
             directory_id=dir.id,
             directory_name=dir.directory_name,
             path=dir.path,
-            directory_class=dir.directory_class
-        ) for dir in query_result
+            directory_class=dir.directory_class,
+            parent_id=dir.parent_id,
+            total_size=dir.total_size,
+            total_files=dir.total_files
+        ) for dir in tree.visible_directories(user.user_id)
     ]
 
     return get_result
 
 @router.get('/get_root_directory',status_code=status.HTTP_200_OK)
-async def get_root_directory(db: DbDependency, user: UserDependency):
-    query_result = db.query(Directory)\
-        .filter(
-            Directory.company_id == user.company_id,
-            Directory.directory_class == 0,
-            Directory.delete_flg == False
-        )\
-        .first()
+async def get_root_directory(db: AsyncDbDependency, user: UserDependency):
+    query_result = (
+        await db.execute(
+            select(Directory)
+            .where(
+                Directory.company_id == user.company_id,
+                Directory.directory_class == 0,
+                Directory.delete_flg == False
+            )
+            .limit(1)
+        )
+    ).scalars().first()
 
     if not query_result:
         raise HTTPException(status_code=404, detail="Directory not found")
@@ -100,22 +92,14 @@ async def create_directory(db: DbDependency, user: UserDependency, directory_cre
     if not directory_query:
         raise HTTPException(status_code=404, detail="Directory not found")
 
-    # ディレクトリのパスを設定
-    if directory_query.directory_class == 0:
-        directory_path = None  
-    else:
-        # directory_pathがnullの場合、ディレクトリのパスはtarget_directory_query.directory_name + / に設定
-        if directory_query.path is None:
-            directory_path = directory_query.directory_name + '/'
-        else:
-            directory_path = directory_query.path + directory_query.directory_name + '/'
+    # ディレクトリのパスを設定（ルート直下の場合はnull）
+    directory_path = child_directory_path(directory_query)
 
-    # Directory.directory_nameとdirectory_create.nameの重複チェック
+    # 同じ親ディレクトリ内での名前の重複チェック
     directory_name_query = db.query(Directory)\
         .filter(
-            Directory.company_id == user.company_id,
+            Directory.parent_id == directory_query.id,
             Directory.directory_name == directory_create.directory_name,
-            Directory.path == directory_path,
             Directory.delete_flg == False
         )\
         .first()
@@ -125,16 +109,14 @@ async def create_directory(db: DbDependency, user: UserDependency, directory_cre
 
 
     # ディレクトリの作成
-    create_azure_folder(directory_create.directory_name, directory_path, storage_name)
+    await get_storage().create_directory(storage_name, directory_path, directory_create.directory_name)
 
-    # ディレクトリクラスをカウント
-    directory_class_count = 1 if directory_path is None else directory_path.count('/') + 1
-
-    # ディレクトリ情報をデータベースに追加
+    # ディレクトリ情報をデータベースに追加し、階層に登録
     new_directory = Directory(
         directory_name=directory_create.directory_name,
         path=directory_path,
-        directory_class = directory_class_count,
+        parent_id=directory_query.id,
+        directory_class=directory_query.directory_class + 1,
         company_id=user.company_id,
         open_flg=directory_create.open_flg,
         delete_flg=False,
@@ -144,19 +126,26 @@ async def create_directory(db: DbDependency, user: UserDependency, directory_cre
         update_at=datetime.now()
     )
     db.add(new_directory)
+    db.flush()
+    add_directory_to_tree(db, new_directory.id, directory_query.id)
+    record_change(db, user.company_id, CHANGE_ENTITY_DIRECTORY, new_directory.id, CHANGE_ACTION_CREATE,
+                  directory_query.id, new_directory.directory_name, user.user_id)
+    index_entry(db, user.company_id, CHANGE_ENTITY_DIRECTORY, new_directory.id, directory_query.id, new_directory.directory_name)
     db.commit()
+    get_directory_tree_cache().invalidate(user.company_id)
     db.refresh(new_directory)
 
     add_result = DirectoryResponse(
         directory_id=new_directory.id,
         directory_name=new_directory.directory_name,
         path=new_directory.path,
-        directory_class=new_directory.directory_class
+        directory_class=new_directory.directory_class,
+        parent_id=new_directory.parent_id
     )
 
     return add_result
 
-@router.post("/rename_directory", response_model=DirectoryResponse, status_code=status.HTTP_200_OK)
+@router.post("/rename_directory", response_model=DirectoryCascadeResponse, status_code=status.HTTP_200_OK)
 async def rename_directory(db: DbDependency, user: UserDependency, directory_rename: DirectoryRename):
 
     # ユーザーの会社ストレージ名の取得
@@ -173,12 +162,12 @@ async def rename_directory(db: DbDependency, user: UserDependency, directory_ren
     if not target_directory_query:
         raise HTTPException(status_code=404, detail="Directory not found")
 
-    # Directory.directory_nameとdirectory_rename.new_directory_nameの重複チェック
+    # 同じ親ディレクトリ内での名前の重複チェック
     directory_name_query = db.query(Directory)\
         .filter(
-            Directory.company_id == user.company_id,
+            Directory.parent_id == target_directory_query.parent_id,
+            Directory.id != target_directory_query.id,
             Directory.directory_name == directory_rename.new_directory_name,
-            Directory.directory_class == target_directory_query.directory_class,
             Directory.delete_flg == False
         )\
         .first()
@@ -193,42 +182,51 @@ async def rename_directory(db: DbDependency, user: UserDependency, directory_ren
         old_directory_path = os.path.join(target_directory_query.path, target_directory_query.directory_name)
         new_directory_path = os.path.join(target_directory_query.path, directory_rename.new_directory_name)
 
-    rename_azure_folder(old_directory_path, new_directory_path, storage_name)
+    await get_storage().rename_directory(storage_name, old_directory_path, new_directory_path)
 
     # ディレクトリ名を変更
     target_directory_query.directory_name = directory_rename.new_directory_name
     target_directory_query.update_acc = user.user_id
     target_directory_query.update_at = datetime.now()
 
-    # 子ディレクトリのパスを更新
+    # 子ディレクトリのパスの先頭（旧パスプレフィックス）を新パスプレフィックスに1回のUPDATEで置換
     old_path_prefix = old_directory_path + "/"
     new_path_prefix = new_directory_path + "/"
-    child_directories = db.query(Directory).filter(
-        Directory.path.like(old_path_prefix + "%"),
-        Directory.company_id == user.company_id,
-        Directory.delete_flg == False
-    ).all()
-
-    for child_directory in child_directories:
-        # 正確な階層の部分を置換するために、旧パスプレフィックスを新パスプレフィックスに置換
-        relative_path = child_directory.path[len(old_path_prefix):]
-        child_directory.path = new_path_prefix + relative_path
-        child_directory.update_acc = user.user_id
-        child_directory.update_at = datetime.now()
+    affected_directories = db.query(Directory)\
+        .filter(
+            Directory.id.in_(descendant_ids(target_directory_query.id, include_self=False)),
+            Directory.delete_flg == False
+        )\
+        .update(
+            {
+                Directory.path: func.concat(new_path_prefix, func.substring(Directory.path, len(old_path_prefix) + 1)),
+                Directory.update_acc: user.user_id,
+                Directory.update_at: datetime.now()
+            },
+            synchronize_session=False
+        )
 
+    record_change(db, user.company_id, CHANGE_ENTITY_DIRECTORY, target_directory_query.id, CHANGE_ACTION_RENAME,
+                  target_directory_query.parent_id, directory_rename.new_directory_name, user.user_id)
+    index_entry(db, user.company_id, CHANGE_ENTITY_DIRECTORY, target_directory_query.id,
+                target_directory_query.parent_id, directory_rename.new_directory_name)
     db.commit()
+    get_directory_tree_cache().invalidate(user.company_id)
     db.refresh(target_directory_query)
 
-    rename_result = DirectoryResponse(
+    rename_result = DirectoryCascadeResponse(
         directory_id=target_directory_query.id,
         directory_name=target_directory_query.directory_name,
         path=target_directory_query.path,
-        directory_class=target_directory_query.directory_class
+        directory_class=target_directory_query.directory_class,
+        parent_id=target_directory_query.parent_id,
+        affected_directories=affected_directories + 1,
+        affected_files=0
     )
 
     return rename_result
 
-@router.post("/delete_directory", response_model=DirectoryResponse, status_code=status.HTTP_200_OK)
+@router.post("/delete_directory", response_model=DirectoryCascadeResponse, status_code=status.HTTP_200_OK)
 async def delete_directory(db: DbDependency, user: UserDependency, directory_delete: DirectoryDelete):
 
     # ユーザーの会社ストレージ名の取得
@@ -243,58 +241,64 @@ async def delete_directory(db: DbDependency, user: UserDependency, directory_del
         )\
         .first()
 
-    # 削除対象のdirectory_classが0の場合、directory_pathはnull
-    if target_directory_query.directory_class == 0:
-        directory_path = None  
-    else:
-        # directory_pathがnullの場合、ディレクトリのパスはtarget_directory_query.directory_nameに設定
-        if target_directory_query.path is None:
-            directory_path = target_directory_query.directory_name + '/'
-        else:
-            directory_path = target_directory_query.path + target_directory_query.directory_name + '/'
-
-    delete_azure_folder_recursive(directory_path, storage_name)
-
-    # 親ディレクトリ情報に削除フラグを立てる
-    target_directory_query.delete_flg = True
-    target_directory_query.update_acc = user.user_id
-    target_directory_query.update_at = datetime.now()
+    if not target_directory_query:
+        raise HTTPException(status_code=404, detail="Directory not found")
 
-    child_directories = db.query(Directory).filter(
-        Directory.path.like(directory_path + "%"),
-        Directory.company_id == user.company_id,
-        Directory.delete_flg == False
-    ).all()
+    # 削除対象のディレクトリのパス（ルートの場合は共有全体）
+    directory_path = directory_storage_path(target_directory_query)
 
-    # 子ディレクトリ情報に削除フラグを立てる
-    for child_directory in child_directories:
-        child_directory.delete_flg = True
-        child_directory.update_acc = user.user_id
-        child_directory.update_at = datetime.now()
+    await get_storage().delete_directory(storage_name, directory_path)
 
-    # 親ディレクトリと子ディレクトリに含まれるファイルに削除フラグを立てる
-    directories_to_update = [target_directory_query.id] + [child_directory.id for child_directory in child_directories]
+    # 削除するファイルの分だけ使用量と親より上のディレクトリの合計サイズを減らす
+    subtree_ids = descendant_ids(target_directory_query.id)
+    release_directory_files_usage(db, subtree_ids)
+    remove_subtree_size(db, target_directory_query.parent_id, subtree_ids)
 
-    files_to_update = db.query(File)\
+    # 対象ディレクトリと配下のディレクトリに含まれるファイルに削除フラグを立てる
+    affected_files = db.query(File)\
         .filter(
-            File.directory_id.in_(directories_to_update),
+            File.directory_id.in_(subtree_ids),
             File.delete_flg == False
         )\
-        .all()
+        .update(
+            {
+                File.delete_flg: True,
+                File.update_acc: user.user_id,
+                File.update_at: datetime.now()
+            },
+            synchronize_session=False
+        )
 
-    for file in files_to_update:
-        file.delete_flg = True
-        file.update_acc = user.user_id
-        file.update_at = datetime.now()
+    # 対象ディレクトリと配下のディレクトリに削除フラグを立てる
+    affected_directories = db.query(Directory)\
+        .filter(
+            Directory.id.in_(subtree_ids),
+            Directory.delete_flg == False
+        )\
+        .update(
+            {
+                Directory.delete_flg: True,
+                Directory.update_acc: user.user_id,
+                Directory.update_at: datetime.now()
+            },
+            synchronize_session=False
+        )
 
+    record_change(db, user.company_id, CHANGE_ENTITY_DIRECTORY, target_directory_query.id, CHANGE_ACTION_DELETE,
+                  target_directory_query.parent_id, target_directory_query.directory_name, user.user_id)
+    remove_directories(db, subtree_ids)
     db.commit()
+    get_directory_tree_cache().invalidate(user.company_id)
     db.refresh(target_directory_query)
 
-    delete_result = DirectoryResponse(
+    delete_result = DirectoryCascadeResponse(
         directory_id=target_directory_query.id,
         directory_name=target_directory_query.directory_name,
         path=target_directory_query.path,
-        directory_class=target_directory_query.directory_class
+        directory_class=target_directory_query.directory_class,
+        parent_id=target_directory_query.parent_id,
+        affected_directories=affected_directories,
+        affected_files=affected_files
     )
 
     return delete_result
@@ -307,7 +311,121 @@ async def get_azure_all_directories(db: DbDependency, user: UserDependency):
     storage_name = get_user_storage_name(db, user.company_id)
 
     # ディレクトリリストを取得
-    directories = get_azure_directory_list(storage_name)
+    directories = await get_storage().list_directory(storage_name)
 
     # ディレクトリ情報を返す
-    return JSONResponse(content={"directories": directories})
\ No newline at end of file
+    return JSONResponse(content={"directories": directories})
+
+# ディレクトリ配下をZIPでまとめてダウンロード
+@router.post("/download_directory", status_code=status.HTTP_200_OK)
+async def download_directory(db: DbDependency, user: UserDependency, directory_archive: DirectoryArchive):
+
+    # ユーザーの会社ストレージ名の取得
+    storage_name = get_user_storage_name(db, user.company_id)
+
+    # ダウンロード対象のdirectory情報を取得
+    target_directory_query = db.query(Directory)\
+        .filter(
+            Directory.company_id == user.company_id,
+            Directory.id == directory_archive.directory_id,
+            Directory.delete_flg == False
+        )\
+        .first()
+
+    if not target_directory_query:
+        raise HTTPException(status_code=404, detail="Directory not found")
+
+    # 非公開ディレクトリはアクセス権がある場合のみ
+    if target_directory_query.open_flg and target_directory_query.directory_class != 0:
+        has_permission = db.query(Permission)\
+            .filter(
+                Permission.directory_id == target_directory_query.id,
+                Permission.user_id == user.user_id
+            )\
+            .first()
+        if not has_permission:
+            raise HTTPException(status_code=403, detail="No authority")
+
+    # 対象ディレクトリのパスとZIP内のフォルダ名を設定（ルートの場合は会社の全ディレクトリが対象）
+    directory_path = directory_storage_path(target_directory_query)
+    archive_name = target_directory_query.directory_name if directory_path else storage_name
+
+    # 配下のディレクトリを浅い順に取得（非公開ディレクトリはアクセス権がある場合のみ）
+    query_directory_result = (
+        db.query(
+            Directory.id,
+            Directory.parent_id,
+            Directory.directory_name,
+            Directory.path,
+            Directory.open_flg,
+            Permission.id.label('permission_id')
+        )
+        .join(
+            DirectoryClosure,
+            and_(
+                DirectoryClosure.descendant_id == Directory.id,
+                DirectoryClosure.ancestor_id == target_directory_query.id,
+                DirectoryClosure.depth > 0
+            )
+        )
+        .outerjoin(
+            Permission,
+            and_(
+                Directory.id == Permission.directory_id,
+                Permission.user_id == user.user_id
+            )
+        )
+        .filter(Directory.delete_flg == False)
+        .order_by(DirectoryClosure.depth)
+        .all()
+    )
+
+    # アクセス権のないディレクトリとその配下は除外する（親は子より先に処理される）
+    directory_paths = {target_directory_query.id: directory_path}
+    for dir in query_directory_result:
+        if dir.parent_id not in directory_paths:
+            continue
+        if dir.open_flg and dir.permission_id is None:
+            continue
+        directory_paths[dir.id] = (dir.path or '') + dir.directory_name + '/'
+
+    query_file_result = db.query(
+            File.file_name,
+            File.directory_id,
+            File.file_update_at
+        )\
+        .filter(
+            File.directory_id.in_(list(directory_paths.keys())),
+            File.delete_flg == False
+        )\
+        .all()
+
+    def fetch_file(file_directory_path: str, file_name: str):
+        async def fetch():
+            # 先読みはstream_zipで行うため、ストレージ側では先読みしない
+            _, _, chunks = await get_storage().download_file(storage_name, file_directory_path, file_name, read_ahead=0)
+            return chunks
+        return fetch
+
+    # ZIPに格納する項目を作成（ディレクトリの後にその直下のファイルを並べる）
+    files_by_directory = {}
+    for file in query_file_result:
+        files_by_directory.setdefault(file.directory_id, []).append(file)
+
+    entries = []
+    for directory_id, full_path in sorted(directory_paths.items(), key=lambda item: item[1]):
+        archive_path = archive_name + '/' + full_path[len(directory_path):]
+        entries.append(ArchiveEntry(archive_path, None, None))
+        for file in sorted(files_by_directory.get(directory_id, []), key=lambda file: file.file_name):
+            entries.append(ArchiveEntry(
+                archive_path + file.file_name,
+                fetch_file(full_path, file.file_name),
+                file.file_update_at
+            ))
+
+    encoded_file_name = quote(archive_name + '.zip')
+    return StreamingResponse(
+        stream_zip(entries),
+        media_type='application/zip',
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{encoded_file_name}"}
+    )
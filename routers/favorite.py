@@ -2,22 +2,25 @@ from fastapi import Depends, APIRouter, HTTPException,status
 from models import Directory, Permission,Favorite
 from typing import Annotated
 from schemas.favorites import FavoriteResponse,FavoriteCreate,FavoriteUpdate,FavoriteDelete
-from db import get_db
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from db import get_async_db, get_async_read_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, union_all
+from sqlalchemy.exc import IntegrityError
 from schemas.auth import DecodedToken
 from auth import get_current_user
 from datetime import datetime
 
-DbDependency = Annotated[Session, Depends(get_db)]
+# DBの応答を待つ間もイベントループを止めないよう、非同期のセッションを使用する
+DbDependency = Annotated[AsyncSession, Depends(get_async_db)]
+ReadDbDependency = Annotated[AsyncSession, Depends(get_async_read_db)]
 UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
 router = APIRouter(prefix="/favorite",tags=["favorite"])
 
 # お気に入り一覧取得
 @router.get('/get_all', response_model=list[FavoriteResponse], status_code=status.HTTP_200_OK)
-async def queryParam(db: DbDependency, user: UserDependency):
+async def queryParam(db: ReadDbDependency, user: UserDependency):
     # 権限あり
-    query1 = db.query(Favorite.id,
+    query1 = select(Favorite.id,
                       Directory.id.label('directory_id'),
                       Favorite.favorite_name,
                       func.concat(func.coalesce(Directory.path, ''), Directory.directory_name).label('directory_path'),
@@ -30,14 +33,14 @@ async def queryParam(db: DbDependency, user: UserDependency):
                 .outerjoin(Permission, 
                       Favorite.directory_id == Permission.directory_id
                       )\
-                .filter(Favorite.user_id == user.user_id,
+                .where(Favorite.user_id == user.user_id,
                         Directory.company_id == user.company_id,
                         Directory.delete_flg == False,
                         Directory.open_flg == False
                         )
                      
     # 非公開 権限あり
-    query2 = db.query(Favorite.id,
+    query2 = select(Favorite.id,
                       Directory.id.label('directory_id'),
                       Favorite.favorite_name,
                       func.concat(func.coalesce(Directory.path, ''), Directory.directory_name).label('directory_path'),
@@ -50,14 +53,14 @@ async def queryParam(db: DbDependency, user: UserDependency):
                 .join(Permission, 
                       Favorite.directory_id == Permission.directory_id
                       )\
-                .filter(Favorite.user_id == user.user_id,
+                .where(Favorite.user_id == user.user_id,
                         Directory.company_id == user.company_id,
                         Permission.user_id == user.user_id,
                         Directory.delete_flg == False,
                         Directory.open_flg == True
                         )
     
-    result = query1.union_all(query2).all()
+    result = (await db.execute(union_all(query1, query2))).all()
     
     return result
 
@@ -66,20 +69,28 @@ async def queryParam(db: DbDependency, user: UserDependency):
 async def queryParam(db: DbDependency, user: UserDependency, favorite_create: FavoriteCreate):
 
     # お気に入り名が重複しているか確認
-    favorite_query = db.query(Favorite)\
-        .filter(
-            Favorite.user_id == user.user_id,
-            Favorite.favorite_name == favorite_create.favorite_name
-            )\
-        .first()
+    favorite_query = (
+        await db.execute(
+            select(Favorite)
+            .where(
+                Favorite.user_id == user.user_id,
+                Favorite.favorite_name == favorite_create.favorite_name
+                )
+            .limit(1)
+        )
+    ).scalars().first()
     
     if favorite_query:
         raise HTTPException(status_code=400, detail="Favorite name already exists")
 
     # ディレクトリ存在確認
-    directory_query = db.query(Directory)\
-        .filter(Directory.id == favorite_create.directory_id)\
-        .first()
+    directory_query = (
+        await db.execute(
+            select(Directory)
+            .where(Directory.id == favorite_create.directory_id)
+            .limit(1)
+        )
+    ).scalars().first()
 
     if not directory_query:
         raise HTTPException(status_code=404, detail="Directory not found")
@@ -93,8 +104,13 @@ async def queryParam(db: DbDependency, user: UserDependency, favorite_create: Fa
     )
 
     db.add(new_favorite)
-    db.commit()
-    db.refresh(new_favorite)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # 同時に同じ名前で追加された場合（一意制約で重複を防ぐ）
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Favorite name already exists")
+    await db.refresh(new_favorite)
 
     return new_favorite
 
@@ -103,22 +119,30 @@ async def queryParam(db: DbDependency, user: UserDependency, favorite_create: Fa
 async def queryParam(db: DbDependency, user: UserDependency, favorite_update: FavoriteUpdate):
 
     # お気に入り名が重複しているか確認
-    favorite_query = db.query(Favorite)\
-        .filter(
-            Favorite.user_id == user.user_id,
-            Favorite.favorite_name == favorite_update.favorite_name
-            )\
-        .first()
+    favorite_query = (
+        await db.execute(
+            select(Favorite)
+            .where(
+                Favorite.user_id == user.user_id,
+                Favorite.favorite_name == favorite_update.favorite_name
+                )
+            .limit(1)
+        )
+    ).scalars().first()
     
     if favorite_query:
         raise HTTPException(status_code=400, detail="Favorite name already exists")
 
     # お気に入り存在確認
-    favorite = db.query(Favorite)\
-        .filter(
-            Favorite.id == favorite_update.id,
-            Favorite.user_id == user.user_id
-        ).first()
+    favorite = (
+        await db.execute(
+            select(Favorite)
+            .where(
+                Favorite.id == favorite_update.id,
+                Favorite.user_id == user.user_id
+            )
+        )
+    ).scalars().first()
     
     if not favorite:
         raise HTTPException(status_code=404, detail="Favorite not found")
@@ -126,8 +150,13 @@ async def queryParam(db: DbDependency, user: UserDependency, favorite_update: Fa
     favorite.favorite_name = favorite_update.favorite_name
     favorite.update_at = datetime.now()
 
-    db.commit()
-    db.refresh(favorite)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # 同時に同じ名前へ変更された場合（一意制約で重複を防ぐ）
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Favorite name already exists")
+    await db.refresh(favorite)
     
     return favorite
 
@@ -136,20 +165,24 @@ async def queryParam(db: DbDependency, user: UserDependency, favorite_update: Fa
 async def queryParam(db: DbDependency, user: UserDependency, favorite_delete: FavoriteDelete):
 
     # 削除対象お気に入り存在確認
-    favorite = db.query(Favorite)\
-        .filter(Favorite.id == favorite_delete.id,
-                Favorite.user_id == user.user_id
-                ).first()
+    favorite = (
+        await db.execute(
+            select(Favorite)
+            .where(Favorite.id == favorite_delete.id,
+                   Favorite.user_id == user.user_id
+                   )
+        )
+    ).scalars().first()
     
     if not favorite:
         raise HTTPException(status_code=404, detail="Favorite not found")
     
-    db.delete(favorite)
-    db.commit()
+    await db.delete(favorite)
+    await db.commit()
 
     return favorite
 
 @router.get("/all", status_code=status.HTTP_200_OK)
 async def create(db: DbDependency, user: UserDependency):
-    item = db.query(Favorite).all()
+    item = (await db.execute(select(Favorite))).scalars().all()
     return item
\ No newline at end of file
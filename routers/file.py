@@ -1,25 +1,46 @@
-from fastapi import Depends, APIRouter, HTTPException, status, UploadFile, File as FastAPIFile, Form
-from fastapi.responses import FileResponse
-from typing import List, Annotated, Union
-from models import Directory, User, File, FileType, Company, Department
-from schemas.files import FileGet, FileGetResponse, FileUploadData, FileUploadResponse, FileRenameResponse, FileRename, FileDelete, FileDownload, FileDeleteResponse
+from fastapi import Depends, APIRouter, HTTPException, Request, status, UploadFile, File as FastAPIFile, Form
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import List, Annotated, Optional, Union
+from models import Directory, User, File, FileType, Company, Department, StorageUsage
+from schemas.files import FileGet, FileGetResponse, FileUploadData, FileUploadResponse, FileRenameResponse, FileRename, FileDelete, FileDownload, FileDeleteResponse, FileStorageReport, CompanyStorageReport, \
+    FileGetPage, FilePageResponse
 from schemas.directories import DirectoryGetResponse
-from db import get_db
+from db import get_db, get_async_db, get_async_read_db, SessionLocal
+from sqlalchemy import and_, or_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from schemas.auth import DecodedToken
 from auth import get_current_user
-from azure_access import upload_file_to_azure, rename_azure_file, delete_azure_file, download_file_from_azure_to_stream
+from storage import get_storage as get_storage_backend
+from storage.cache import FileCache, get_file_cache
+from directory_tree import add_directory_size, get_directory_tree_cache
+from search_index import index_entry, remove_entry
+from change_log import CHANGE_ENTITY_FILE, CHANGE_ACTION_CREATE, CHANGE_ACTION_UPDATE, CHANGE_ACTION_RENAME, CHANGE_ACTION_DELETE, record_change
+from storage_usage import USAGE_USER, USAGE_DEPARTMENT, USAGE_COMPANY, StorageQuotaExceeded, usage_owners, add_usage, \
+    release_files_usage, reserve_usage, commit_reservation, release_reservation, iter_storage_report
 import mimetypes
-from datetime import datetime
+import asyncio
+import base64
+import json
+from datetime import datetime, timezone
 from urllib.parse import quote
-from fastapi import BackgroundTasks
-import shutil
+from email.utils import format_datetime
 import os
 
 DbDependency = Annotated[Session, Depends(get_db)]
+AsyncDbDependency = Annotated[AsyncSession, Depends(get_async_db)]
+AsyncReadDbDependency = Annotated[AsyncSession, Depends(get_async_read_db)]
 UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
 router = APIRouter(prefix="/file", tags=["file"])
 
+# 容量を超えた場合のエラーメッセージ
+QUOTA_EXCEEDED_MESSAGES = {
+    USAGE_USER: "ファイルサイズがユーザーのストレージ容量を超えています",
+    USAGE_DEPARTMENT: "ファイルサイズが所属のストレージ容量を超えています",
+    USAGE_COMPANY: "ファイルサイズが会社のストレージ容量を超えています",
+}
+
 # ファイルサイズをKB,MB,GBに変換
 def convert_file_size(size_in_kb: int) -> str:
     if size_in_kb < 1:
@@ -27,7 +48,7 @@ def convert_file_size(size_in_kb: int) -> str:
 
     units = ["KB", "MB", "GB", "TB"]
     index = 0
-    size = size_in_kb
+    size = float(size_in_kb)
     
     while size >= 1024 and index < len(units) - 1:
         size /= 1024
@@ -62,130 +83,363 @@ def get_user_storage_name(db: Session, user_id: int) -> str:
     
     return storage_name_query.storage_name
 
+# Rangeヘッダー(bytes=開始-終了)を解析して(開始位置, 長さ)を返す
+# 解析できない・複数範囲の場合はNoneを返し、ファイル全体を返却する
+def parse_range_header(range_header: str, file_size: int):
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+
+    range_spec = range_header[len('bytes='):].strip()
+    if ',' in range_spec:
+        return None
+
+    start_str, separator, end_str = range_spec.partition('-')
+    if not separator:
+        return None
+
+    try:
+        if start_str == '':
+            # 末尾からnバイト
+            suffix_length = int(end_str)
+            if suffix_length <= 0:
+                raise ValueError
+            start = max(file_size - suffix_length, 0)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+
+    if start >= file_size or end < start:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+
+    end = min(end, file_size - 1)
+    return start, end - start + 1
+
+# If-Rangeヘッダーがファイルの現在のETagまたは更新日時と一致するか確認
+def is_if_range_matched(if_range: str, etag: str, last_modified: datetime) -> bool:
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # 弱いETagは範囲リクエストに使用できない
+        return not if_range.startswith('W/') and if_range == etag
+    return last_modified is not None and if_range == format_datetime(last_modified, usegmt=True)
+
+# キャッシュファイルの指定範囲を読み込む（配信が終わったらキャッシュの参照を解放する）
+async def iter_cached_file(file_cache: FileCache, cache_key: str, offset: int, length: int):
+    try:
+        with open(file_cache.path(cache_key), 'rb') as source:
+            source.seek(offset)
+            remaining = length
+            while remaining > 0:
+                chunk = await asyncio.to_thread(source.read, min(1024 * 1024, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    finally:
+        file_cache.release(cache_key)
+
+# ローカルキャッシュからファイルを配信（キャッシュにない場合はストレージから配信しながら登録する）
+# キャッシュにない範囲リクエストはNoneを返し、ストレージから直接配信させる
+async def cached_file_response(file_cache: FileCache, storage_name: str, directory_path: str, file_query, request: Request, headers: dict):
+    cache_key = FileCache.cache_key(file_query.id, file_query.file_update_at)
+    cache_path = file_cache.acquire(cache_key)
+    if cache_path is None:
+        if request.headers.get('range'):
+            return None
+
+        # 同じファイルを他のリクエストが取得中の場合は、その取得を共有する
+        file_size, chunks = await file_cache.fetch(
+            cache_key,
+            lambda: get_storage_backend().download_file(storage_name, directory_path, file_query.file_name)
+        )
+        headers["Content-Length"] = str(file_size)
+        headers["ETag"] = f'"{cache_key}"'
+        if file_query.file_update_at is not None:
+            headers["Last-Modified"] = format_datetime(file_query.file_update_at.astimezone(timezone.utc), usegmt=True)
+        return StreamingResponse(
+            chunks,
+            media_type='application/octet-stream',
+            headers=headers
+        )
+
+    try:
+        file_size = os.path.getsize(cache_path)
+        etag = f'"{cache_key}"'
+        last_modified = file_query.file_update_at.astimezone(timezone.utc) if file_query.file_update_at else None
+
+        headers["ETag"] = etag
+        if last_modified is not None:
+            headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+        file_range = parse_range_header(request.headers.get('range'), file_size)
+        if file_range and not is_if_range_matched(request.headers.get('if-range'), etag, last_modified):
+            file_range = None
+    except BaseException:
+        file_cache.release(cache_key)
+        raise
+
+    if file_range:
+        offset, length = file_range
+        headers["Content-Length"] = str(length)
+        headers["Content-Range"] = f"bytes {offset}-{offset + length - 1}/{file_size}"
+        return StreamingResponse(
+            iter_cached_file(file_cache, cache_key, offset, length),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type='application/octet-stream',
+            headers=headers
+        )
+
+    # 全体を返す場合はFileResponseで配信する（サーバーが対応していればpathsendでゼロコピー転送される）
+    return FileResponse(
+        cache_path,
+        media_type='application/octet-stream',
+        headers=headers,
+        background=BackgroundTask(file_cache.release, cache_key)
+    )
+
+# 一覧の日時の表示形式
+def format_list_datetime(value: Optional[datetime]) -> Optional[str]:
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+# ファイル一覧の項目を作成（拡張子が登録されていない場合はファイル名から拡張子を取得）
+def file_list_item(file) -> FileGetResponse:
+    if file.extension_name is None:
+        file_extension = os.path.splitext(file.file_name)[1].lstrip('.')
+        filetype_name = f"{file_extension}ファイル"
+    else:
+        filetype_name = file.extension_name
+
+    return FileGetResponse(
+        id=file.id,
+        file_name=file.file_name,
+        file_size=convert_file_size(file.file_size),
+        file_update_at=format_list_datetime(file.file_update_at),
+        filetype_name=filetype_name,
+        icon_id=file.icon
+    )
+
+# ファイル一覧のフォルダの項目を作成（サイズは配下を含む合計、ファイルがない場合は表示しない）
+def directory_list_item(dir) -> FileGetResponse:
+    return FileGetResponse(
+        id=dir.id,
+        file_name=dir.directory_name,
+        file_size=convert_file_size(dir.total_size) if dir.total_files else None,
+        file_update_at=format_list_datetime(dir.update_at),
+        filetype_name="ファイルフォルダー",
+        icon_id=99,
+    )
+
 # ファイル一覧取得
 @router.post('/get_all_file', response_model=List[Union[FileGetResponse, DirectoryGetResponse]], status_code=status.HTTP_200_OK)
-async def file_get_all(db: DbDependency, user: UserDependency, file_get: FileGet):
+async def file_get_all(db: AsyncReadDbDependency, user: UserDependency, file_get: FileGet):
 
+    # 取得先ディレクトリと直下のディレクトリはキャッシュしたディレクトリツリーから取得
+    tree = await get_directory_tree_cache().get_async(db, user.company_id)
+    query_first_result = tree.get(file_get.directory_id)
+    
+    if query_first_result is None or query_first_result.open_flg:
+        raise HTTPException(status_code=404, detail="Directory not found")
+    
+    query_directory_result = [dir for dir in tree.get_children(query_first_result.id) if not dir.open_flg]
+
+    # 取得先ディレクトリは会社のディレクトリであることを確認済みのため、ディレクトリとの結合は不要
     query_file_result = (
-        db.query(
-            File.id,
-            File.directory_id,
-            File.file_name,
-            File.file_size,
-            File.filetype_id,
-            File.file_update_at,
-            FileType.extension_name,
-            FileType.icon,
-            Directory.company_id,
-        )
-        .select_from(File)
-        .outerjoin(
-            FileType,
-            File.filetype_id == FileType.id
+        await db.execute(
+            select(
+                File.id,
+                File.directory_id,
+                File.file_name,
+                File.file_size,
+                File.filetype_id,
+                File.file_update_at,
+                FileType.extension_name,
+                FileType.icon
             )
-        .outerjoin(
-            Directory,
-            File.directory_id == Directory.id
+            .select_from(File)
+            .outerjoin(
+                FileType,
+                File.filetype_id == FileType.id
+                )
+            .where(
+                File.directory_id == query_first_result.id,
+                File.delete_flg == False
             )
-        .filter(
-            Directory.company_id == user.company_id,
-            File.directory_id == file_get.directory_id,
-            File.delete_flg == False
+            .order_by(File.file_name)
         )
-        .order_by(File.file_name)
-        .all()
-    )
+    ).all()
 
-    # 取得先ディレクトリの情報を取得
-    query_first_result = db.query(Directory)\
-        .filter(
-            Directory.company_id == user.company_id,
-            Directory.id == file_get.directory_id,
-            Directory.open_flg == False,
-            Directory.delete_flg == False
-        )\
-        .order_by(Directory.directory_name)\
-        .first()
-    
-    if query_first_result is None:
+    get_file_result = [file_list_item(file) for file in query_file_result]
+    get_directory_result = [directory_list_item(dir) for dir in query_directory_result]
+
+    combined_result = get_directory_result + get_file_result
+
+    return combined_result
+
+# 一覧のページ位置を表すカーソル（最後に返した項目の種類・並び替えの値・ID）をURLセーフなBase64に変換
+def encode_page_cursor(is_directory: bool, sort: str, descending: bool, key, item_id: int) -> str:
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    payload = {"d": is_directory, "s": sort, "desc": descending, "k": key, "i": item_id}
+    return base64.urlsafe_b64encode(json.dumps(payload, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+# 並び替えごとのカーソルの値の型
+PAGE_CURSOR_KEY_TYPES = {'name': str, 'update_at': str, 'size': int}
+
+# カーソルを復元し、並び替えが変わった場合や、値の型が一致しない（改変された）場合は400を返す
+def decode_page_cursor(cursor: str, sort: str, descending: bool) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if payload["s"] != sort or payload["desc"] != descending:
+            raise ValueError("sort order changed")
+        if not isinstance(payload["d"], bool):
+            raise TypeError("invalid kind")
+        if payload["i"] is None:
+            # ファイルの先頭から取得するカーソル
+            if payload["d"] or payload["k"] is not None:
+                raise ValueError("invalid position")
+        elif type(payload["i"]) is not int or type(payload["k"]) is not PAGE_CURSOR_KEY_TYPES[sort]:
+            raise TypeError("invalid position")
+        if sort == 'update_at' and payload["k"] is not None:
+            payload["k"] = datetime.fromisoformat(payload["k"])
+        return payload
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+# 並び替えの値が同じ項目はIDで順序を決め、カーソルより後の項目だけを取得する条件
+def after_page_cursor(sort_column, id_column, key, item_id: int, descending: bool):
+    if descending:
+        return or_(sort_column < key, and_(sort_column == key, id_column < item_id))
+    return or_(sort_column > key, and_(sort_column == key, id_column > item_id))
+
+# 更新日時がない項目は最も古い日時として並べる
+LIST_MIN_DATETIME = datetime(1970, 1, 1)
+
+# ファイル一覧をページ単位で取得（フォルダ → ファイルの順に、sortの値とIDで並べる）
+# OFFSETを使わず、前のページの最後の項目より後を取得するため、何ページ目でもlimit件分の処理で済む
+@router.post('/get_file_page', response_model=FilePageResponse, status_code=status.HTTP_200_OK)
+async def file_get_page(db: AsyncReadDbDependency, user: UserDependency, file_get_page: FileGetPage):
+
+    # 取得先ディレクトリの情報をキャッシュしたディレクトリツリーから取得
+    tree = await get_directory_tree_cache().get_async(db, user.company_id)
+    query_first_result = tree.get(file_get_page.directory_id)
+
+    if query_first_result is None or query_first_result.open_flg:
         raise HTTPException(status_code=404, detail="Directory not found")
-    
-    # query_first_result.directory_classが0の場合、Directory.directory_class == 1のみ取得
-    if query_first_result.directory_class == 0:
-        query_directory_result = db.query(Directory)\
-            .filter(
-                Directory.company_id == user.company_id,
-                Directory.id != query_first_result.id,
-                Directory.path == None,
-                Directory.directory_class == 1,
+
+    sort = file_get_page.sort
+    descending = file_get_page.descending
+    limit = file_get_page.limit
+    cursor = decode_page_cursor(file_get_page.cursor, sort, descending) if file_get_page.cursor else None
+
+    def ordered(query, sort_column, id_column):
+        if descending:
+            return query.order_by(sort_column.desc(), id_column.desc())
+        return query.order_by(sort_column, id_column)
+
+    items = []
+    next_cursor = None
+
+    # フォルダ（サイズ順の場合は配下を含む合計サイズで並べる）
+    if cursor is None or cursor["d"]:
+        directory_sort_column = {
+            'name': Directory.directory_name,
+            'update_at': func.coalesce(Directory.update_at, LIST_MIN_DATETIME),
+            'size': Directory.total_size,
+        }[sort]
+
+        directory_query = select(
+                Directory.id,
+                Directory.directory_name,
+                Directory.update_at,
+                Directory.total_size,
+                Directory.total_files,
+                directory_sort_column.label('sort_key')
+            )\
+            .where(
+                Directory.parent_id == query_first_result.id,
                 Directory.open_flg == False,
                 Directory.delete_flg == False
-            )\
-        .order_by(Directory.directory_name)\
-        .all()
+            )
+        if cursor is not None:
+            directory_query = directory_query.where(
+                after_page_cursor(directory_sort_column, Directory.id, cursor["k"], cursor["i"], descending)
+            )
 
-    else:
-        # directory_pathがnullの場合、Directory.path == query_directory_path.directory_name + '/'の場合のみ取得
-        if query_first_result.path is None:
-            query_directory_result = db.query(Directory)\
-                .filter(
-                    Directory.id != query_first_result.id,
-                    Directory.company_id == user.company_id,
-                    Directory.path == query_first_result.directory_name + '/',
-                    Directory.open_flg == False,
-                    Directory.delete_flg == False
-                    )\
-                .order_by(Directory.directory_name)\
-                .all()
-        else:
-            query_directory_result = db.query(Directory)\
-                .filter(
-                    Directory.id != query_first_result.id,
-                    Directory.company_id == user.company_id,
-                    Directory.path == query_first_result.path + query_first_result.directory_name + '/',
-                    Directory.open_flg == False,
-                    Directory.delete_flg == False
-                    )\
-                .order_by(Directory.directory_name)\
-                .all()
-            
-    # 拡張子がない場合はファイル名から拡張子を取得
-    get_file_result = []
-    for file in query_file_result:
-        if file.extension_name is None:
-            file_extension = os.path.splitext(file.file_name)[1].lstrip('.')
-            filetype_name = f"{file_extension}ファイル"
-        else:
-            filetype_name = file.extension_name
-
-        get_file_result.append(
-            FileGetResponse(
-            id=file.id,
-            file_name=file.file_name,
-            file_size=convert_file_size(file.file_size),
-            file_update_at=file.file_update_at.strftime('%Y-%m-%d %H:%M:%S'),
-            filetype_name=filetype_name,
-            icon_id=file.icon
-        ))
-
-    get_directory_result = [
-        FileGetResponse(
-            id=dir.id,
-            file_name=dir.directory_name,
-            file_size=None,
-            file_update_at=dir.update_at.strftime('%Y-%m-%d %H:%M:%S'),
-            filetype_name="ファイルフォルダー",
-            icon_id=99,
-        ) for dir in query_directory_result
-    ]
+        # 次のページの有無を判定するため1件多く取得
+        query_directory_result = (
+            await db.execute(ordered(directory_query, directory_sort_column, Directory.id).limit(limit + 1))
+        ).all()
+        for dir in query_directory_result[:limit]:
+            items.append(directory_list_item(dir))
+        if len(query_directory_result) > limit:
+            last = query_directory_result[limit - 1]
+            next_cursor = encode_page_cursor(True, sort, descending, last.sort_key, last.id)
+        elif len(items) == limit:
+            # フォルダでページが埋まった場合、ファイルがあれば次のページはファイルの先頭から
+            has_file = (
+                await db.execute(
+                    select(File.id)
+                    .where(
+                        File.directory_id == query_first_result.id,
+                        File.delete_flg == False
+                    )
+                    .limit(1)
+                )
+            ).first()
+            if has_file:
+                next_cursor = encode_page_cursor(False, sort, descending, None, None)
+        cursor = None
+
+    # ファイル
+    if next_cursor is None and len(items) < limit:
+        file_sort_column = {
+            'name': File.file_name,
+            'update_at': func.coalesce(File.file_update_at, LIST_MIN_DATETIME),
+            'size': File.file_size,
+        }[sort]
+
+        file_query = select(
+                File.id,
+                File.file_name,
+                File.file_size,
+                File.file_update_at,
+                FileType.extension_name,
+                FileType.icon,
+                file_sort_column.label('sort_key')
+            )\
+            .select_from(File)\
+            .outerjoin(FileType, File.filetype_id == FileType.id)\
+            .where(
+                File.directory_id == query_first_result.id,
+                File.delete_flg == False
+            )
+        if cursor is not None and cursor["i"] is not None:
+            file_query = file_query.where(
+                after_page_cursor(file_sort_column, File.id, cursor["k"], cursor["i"], descending)
+            )
 
-    combined_result = get_directory_result + get_file_result
+        remaining = limit - len(items)
+        query_file_result = (
+            await db.execute(ordered(file_query, file_sort_column, File.id).limit(remaining + 1))
+        ).all()
+        for file in query_file_result[:remaining]:
+            items.append(file_list_item(file))
+        if len(query_file_result) > remaining:
+            last = query_file_result[remaining - 1]
+            next_cursor = encode_page_cursor(False, sort, descending, last.sort_key, last.id)
 
-    return combined_result
+    return FilePageResponse(items=items, next_cursor=next_cursor)
 
 # ファイルダウンロード
 @router.post("/download_file", status_code=status.HTTP_200_OK)
-async def download_file(db: DbDependency, user: UserDependency, file_download: FileDownload, background_tasks: BackgroundTasks):
+async def download_file(db: DbDependency, user: UserDependency, file_download: FileDownload, request: Request):
     # ファイル情報の取得
     file_query = (
         db.query(
@@ -223,102 +477,117 @@ async def download_file(db: DbDependency, user: UserDependency, file_download: F
         else:
             directory_path = file_query.path + file_query.directory_name + '/'
 
-    file_chunks = download_file_from_azure_to_stream(storage_name, directory_path, file_query.file_name)
-
     # ファイル名をRFC 5987形式でエンコード
     encoded_file_name = quote(file_query.file_name)
-    print(encoded_file_name)
 
     # encoded_file_nameからMINEタイプを取得
     mime_type = mimetypes.guess_type(encoded_file_name)[0]
     if mime_type is None:
         mime_type = 'application/octet-stream'
 
-    # バックグラウンドタスクとして一時ファイルを削除する
-    background_tasks.add_task(remove_file, file_chunks)
-
-    # フロントへファイルを渡す
-    response = FileResponse(file_chunks, media_type='application/octet-stream', headers={"Content-Disposition": f"attachment; filename*=UTF-8''{encoded_file_name}"})
-    # response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{encoded_file_name}"
-
-
-    # print('receponse_body:',response.file_chunks)
-    print('receponse_body:',response.media_type)
-    print('receponse_body:',response.headers)
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_file_name}",
+        "Accept-Ranges": "bytes"
+    }
+
+    # ローカルキャッシュが有効な場合はキャッシュから配信する
+    file_cache = get_file_cache()
+    if file_cache is not None:
+        response = await cached_file_response(file_cache, storage_name, directory_path, file_query, request, headers)
+        if response is not None:
+            return response
+
+    # Rangeヘッダーがある場合は指定範囲のみストレージから取得する
+    file_range = None
+    range_header = request.headers.get('range')
+    if range_header:
+        properties = await get_storage_backend().get_file_properties(storage_name, directory_path, file_query.file_name)
+        file_range = parse_range_header(range_header, properties.size)
+        if file_range and not is_if_range_matched(request.headers.get('if-range'), properties.etag, properties.last_modified):
+            file_range = None
+
+    if file_range:
+        offset, length = file_range
+        total_size = properties.size
+        file_size, properties, file_chunks = await get_storage_backend().download_file(storage_name, directory_path, file_query.file_name, offset, length)
+    else:
+        file_size, properties, file_chunks = await get_storage_backend().download_file(storage_name, directory_path, file_query.file_name)
+
+    headers["Content-Length"] = str(file_size)
+    headers["ETag"] = properties.etag
+    if properties.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(properties.last_modified, usegmt=True)
+
+    if file_range:
+        headers["Content-Range"] = f"bytes {offset}-{offset + file_size - 1}/{total_size}"
+
+    # フロントへファイルをストリームで渡す
+    response = StreamingResponse(
+        file_chunks,
+        status_code=status.HTTP_206_PARTIAL_CONTENT if file_range else status.HTTP_200_OK,
+        media_type='application/octet-stream',
+        headers=headers
+    )
     return response
 
-def remove_file(file_path: str):
-    os.remove(file_path)
-
 # ファイルアップロード
 @router.post("/upload_file", response_model=FileUploadResponse, status_code=status.HTTP_201_CREATED)
 async def upload_file(db: DbDependency,user: UserDependency, directory_id: int = Form(...), file: UploadFile = FastAPIFile(...)):
     upload_file = FileUploadData(directory_id=directory_id)
 
     # ファイルサイズの特定（バイトからKBへ変換。）
-    file_size_bytes = len(await file.read())
-    print(file_size_bytes)
-    file_size_kb = file_size_bytes / 1024
+    # アップロードファイルは一時領域にスプールされているため、読み込まずに末尾位置からサイズを取得する
+    file.file.seek(0, os.SEEK_END)
+    file_size_bytes = file.file.tell()
+    file.file.seek(0)
+    # file_sizeはINTEGER列のため、保存される値と使用量の増減が一致するよう整数（四捨五入）にしておく
+    file_size_kb = int(file_size_bytes / 1024 + 0.5)
     if file_size_kb < 1:
         file_size_kb = 1
-    await file.seek(0)
 
     # ファイル名の長さチェック
     if len(file.filename) > 255:
         raise HTTPException(status_code=400, detail="ファイル名は255文字以内で指定してください")
 
+    # 上書きの場合は既存ファイルのサイズとの差分だけ使用量が増える
+    existing_file = db.query(File)\
+    .filter(
+        File.directory_id == upload_file.directory_id,
+        File.file_name == file.filename,
+        File.delete_flg == False
+    ).first()
+
+    size_delta_kb = file_size_kb - (existing_file.file_size if existing_file else 0)
+
     # アップロード対象のストレージ容量をチェック
+    # 上書きの場合は最初にアップロードしたユーザー（所有者）の使用量として数えるため、容量も所有者の上限で確認する
+    owner_user_id = existing_file.user_id if existing_file else user.user_id
     storage_query = db.query(
+        User.department_id,
+        User.company_id,
+        User.storage.label('user_storage'),
         Company.storage.label('company_storage'),
         Department.storage.label('department_storage'))\
-    .select_from(Department)\
+    .select_from(User)\
     .join(
-        Company, Company.id == Department.company_id)\
+        Department, Department.id == User.department_id)\
+    .join(
+        Company, Company.id == User.company_id)\
     .filter(
-        Department.id == user.department_id)\
+        User.id == owner_user_id)\
     .first()
 
     if storage_query is None:
         raise HTTPException(status_code=404, detail="ストレージ情報が見つかりません")
 
-    # ユーザーが保存した全ファイルのサイズを取得
-    user_files_query = db.query(File)\
-    .filter(
-        File.user_id == user.user_id
-    )\
-    .all()
-
-    total_user_file_size_kb = sum(file.file_size for file in user_files_query)
-    total_user_file_size_kb += file_size_kb
-
-    if total_user_file_size_kb > user.storage:
-        raise HTTPException(status_code=400, detail="ファイルサイズがユーザーのストレージ容量を超えています")
-
-    # 部署の全てのファイルサイズを取得
-    department_files_query = db.query(File).join(
-        User, User.id == File.user_id
-    ).filter(
-        user.department_id == Department.id
-    ).all()
-
-    total_department_file_size_kb = sum(file.file_size for file in department_files_query)
-    total_department_file_size_kb += file_size_kb
-
-    if total_department_file_size_kb > storage_query.department_storage:
-        raise HTTPException(status_code=400, detail="ファイルサイズが所属のストレージ容量を超えています")
-
-    # 会社の全てのファイルサイズを取得
-    company_files_query = db.query(File).join(
-        User, User.id == File.user_id
-    ).filter(
-        user.company_id == Company.id
-    ).all()
-
-    total_company_file_size_kb = sum(file.file_size for file in company_files_query)
-    total_company_file_size_kb += file_size_kb
-
-    if total_company_file_size_kb > storage_query.company_storage:
-        raise HTTPException(status_code=400, detail="ファイルサイズが会社のストレージ容量を超えています")
+    # ユーザー・部署・会社ごとの容量の上限
+    owners = usage_owners(owner_user_id, storage_query.department_id, storage_query.company_id)
+    user_owner, department_owner, company_owner = owners
+    storage_limits = {
+        user_owner: storage_query.user_storage,
+        department_owner: storage_query.department_storage,
+        company_owner: storage_query.company_storage,
+    }
 
     # ユーザーの会社ストレージ名の取得
     storage_name = get_user_storage_name(db, user.user_id)
@@ -356,56 +625,58 @@ async def upload_file(db: DbDependency,user: UserDependency, directory_id: int =
     # ファイルタイプが見つからない場合はNoneを設定
     filetype_id = filetype_query.id if filetype_query else None
 
-    # ファイル情報の更新または追加
-    existing_file = db.query(File)\
-    .filter(
-        File.directory_id == upload_file.directory_id,
-        File.file_name == file.filename,
-        File.delete_flg == False
-    ).first()
+    # アップロードするサイズ分の容量を予約（並列にアップロードしても上限を超えないようにする）
+    reservation_id = None
+    if size_delta_kb > 0:
+        try:
+            reservation_id = reserve_usage(db, owners, storage_limits, size_delta_kb)
+        except StorageQuotaExceeded as e:
+            raise HTTPException(status_code=400, detail=QUOTA_EXCEEDED_MESSAGES[e.owner_type])
+
+    # ストレージにファイルをチャンク単位でアップロード（失敗した場合は予約を解放）
+    try:
+        await get_storage_backend().upload_file(storage_name, azure_directory_path, file.filename, file, file_size_bytes)
+    except BaseException:
+        release_reservation(db, reservation_id)
+        raise
 
+    # ファイル情報の更新または追加（予約は使用量に振り替える）
+    commit_reservation(db, reservation_id)
     if existing_file:
         # 既存ファイルの場合
-        # 一時ファイルに保存
-        temp_file_path = f"/tmp/{file.filename}"
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Azureにファイルをアップロード
-        upload_file_to_azure(temp_file_path, azure_directory_path, storage_name)
 
         # ファイルの更新日時を取得
-        file_update_time = datetime.fromtimestamp(os.path.getmtime(temp_file_path))
+        file_update_time = datetime.now()
 
         # ファイル情報をデータベースに反映
-        existing_file.filetype_id = filetype_id,
-        existing_file.file_size = file_size_kb,        
+        # ファイルの所有者は変わらないため、容量を予約した所有者の使用量をサイズの差分だけ増減させる
+        add_usage(db, owners, size_delta_kb)
+        add_directory_size(db, existing_file.directory_id, size_delta_kb)
+
+        existing_file.filetype_id = filetype_id
+        existing_file.file_size = file_size_kb
         existing_file.file_update_at = file_update_time
-        existing_file.update_acc = user.user_id,
+        existing_file.update_acc = user.user_id
         existing_file.update_at = datetime.now()
 
+        record_change(db, user.company_id, CHANGE_ENTITY_FILE, existing_file.id, CHANGE_ACTION_UPDATE,
+                      existing_file.directory_id, existing_file.file_name, user.user_id)
         db.commit()
+        get_directory_tree_cache().add_size(user.company_id, upload_file.directory_id, size_delta_kb)
         db.refresh(existing_file)
 
         # ファイル情報を返す
         return FileUploadResponse(
             directory_id=existing_file.directory_id,
+            file_id=existing_file.id,
             file_name=existing_file.file_name,
             file_size=existing_file.file_size,
         )
 
     else:
         # 新規ファイルの場合
-        # 一時ファイルに保存
-        temp_file_path = f"/tmp/{file.filename}"
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Azureにファイルをアップロード
-        upload_file_to_azure(temp_file_path, azure_directory_path, storage_name)
-
         # ファイルの更新日時を取得
-        file_update_time = datetime.fromtimestamp(os.path.getmtime(temp_file_path))
+        file_update_time = datetime.now()
 
         # ファイル情報をデータベースに追加
         new_file = File(
@@ -422,7 +693,14 @@ async def upload_file(db: DbDependency,user: UserDependency, directory_id: int =
             update_at=datetime.now()
         )
         db.add(new_file)
+        add_usage(db, owners, file_size_kb)
+        add_directory_size(db, new_file.directory_id, file_size_kb, 1)
+        db.flush()
+        record_change(db, user.company_id, CHANGE_ENTITY_FILE, new_file.id, CHANGE_ACTION_CREATE,
+                      new_file.directory_id, new_file.file_name, user.user_id)
+        index_entry(db, user.company_id, CHANGE_ENTITY_FILE, new_file.id, new_file.directory_id, new_file.file_name)
         db.commit()
+        get_directory_tree_cache().add_size(user.company_id, upload_file.directory_id, file_size_kb, 1)
         db.refresh(new_file)
 
         return FileUploadResponse(
@@ -468,9 +746,9 @@ async def rename_file(db: DbDependency, user: UserDependency, file_rename: FileR
         else:
             path = old_name_query.path + old_name_query.directory_name + '/'
 
-    # Azureでのファイル名変更処理
+    # ストレージでのファイル名変更処理
     try:
-        rename_azure_file(storage_name, path, old_name_query.file_name, file_rename.new_file_name)
+        await get_storage_backend().rename_file(storage_name, path, old_name_query.file_name, file_rename.new_file_name)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
         
@@ -486,6 +764,9 @@ async def rename_file(db: DbDependency, user: UserDependency, file_rename: FileR
     file.update_acc = user.user_id
     file.update_at = datetime.now()
 
+    record_change(db, user.company_id, CHANGE_ENTITY_FILE, file.id, CHANGE_ACTION_RENAME,
+                  file.directory_id, file.file_name, user.user_id)
+    index_entry(db, user.company_id, CHANGE_ENTITY_FILE, file.id, file.directory_id, file.file_name)
     db.commit()
     db.refresh(file)
     
@@ -534,7 +815,7 @@ async def delete_file(db: DbDependency, user: UserDependency, file_delete: FileD
         else:
             directory_path = file_name_query.path + file_name_query.directory_name + '/'
 
-    delete_azure_file(storage_name, directory_path, file_name_query.file_name)
+    await get_storage_backend().delete_file(storage_name, directory_path, file_name_query.file_name)
 
     # ファイル情報を取得
     target_file = db.query(File)\
@@ -547,13 +828,21 @@ async def delete_file(db: DbDependency, user: UserDependency, file_delete: FileD
     if not target_file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # ファイル情報を削除フラグを立てる
+    # ファイル情報を削除フラグを立て、使用量とディレクトリの合計サイズから減らす
+    deleted_size = target_file.file_size or 0
+    release_files_usage(db, [target_file])
+    add_directory_size(db, target_file.directory_id, -deleted_size, -1)
     target_file.delete_flg = True
     target_file.update_acc = user.user_id
     target_file.update_at = datetime.now()
 
+    record_change(db, user.company_id, CHANGE_ENTITY_FILE, target_file.id, CHANGE_ACTION_DELETE,
+                  target_file.directory_id, target_file.file_name, user.user_id)
+    remove_entry(db, CHANGE_ENTITY_FILE, target_file.id)
+
     # データベースにコミット
     db.commit()
+    get_directory_tree_cache().add_size(user.company_id, file_name_query.directory_id, -deleted_size, -1)
     db.refresh(target_file)
 
     delete_result = FileDeleteResponse(
@@ -572,35 +861,60 @@ async def get_storage(db: DbDependency, user: UserDependency):
         if not user.admin:
             raise HTTPException(status_code=403, detail="Forbidden")
     
-        # 会社のファイル容量を取得
+        # 各会社のファイル容量を使用量の集計値から1回のクエリで取得
         company_storage_query = db.query(
             Company.id,
             Company.company_name,
-            Company.storage_name,
-            Company.storage
-        ).all()
+            func.coalesce(StorageUsage.used_size, 0).label('used_size')
+        )\
+        .outerjoin(
+            StorageUsage,
+            and_(
+                StorageUsage.owner_type == USAGE_COMPANY,
+                StorageUsage.owner_id == Company.id
+            )
+        )\
+        .order_by(Company.id)\
+        .all()
     
-        # 各会社のファイル容量を取得
         company_storage_result = []
         for company in company_storage_query:
-            # 会社のファイル容量を取得
-            company_files_query = db.query(File)\
-            .join(User, User.id == File.user_id)\
-            .join(Department, Department.id == User.department_id)\
-            .filter(
-                Department.company_id == company.id
-            )\
-            .all()
-
-            total_company_file_size_kb = sum(file.file_size for file in company_files_query)
-
             company_storage_result.append(
                 FileGetResponse(
                     id=company.id,
                     file_name=company.company_name,
-                    file_size=convert_file_size(total_company_file_size_kb),
+                    file_size=convert_file_size(company.used_size),
                     file_update_at=None,
                     filetype_name=None,
                     icon_id=None
                 )
-            )
\ No newline at end of file
+            )
+
+        return company_storage_result
+
+# 会社ごとのストレージ使用量を部署別・ユーザー別の内訳とともに取得(管理者用)
+# Acceptにapplication/x-ndjsonを指定した場合は1社を1行として逐次返す
+@router.post("/get_storage_report", response_model=List[CompanyStorageReport], status_code=status.HTTP_200_OK)
+async def get_storage_report(db: DbDependency, user: UserDependency, request: Request, storage_report: FileStorageReport):
+
+    # ユーザーが管理者でない場合はエラーを返す
+    if not user.admin:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    def to_report(company: dict) -> dict:
+        company["file_size"] = convert_file_size(company["used_size"])
+        return company
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        # レスポンスの送信中にリクエストのセッションは閉じられるため、専用のセッションで読み出す
+        def iter_lines():
+            report_db = SessionLocal()
+            try:
+                for company in iter_storage_report(report_db, storage_report.company_id):
+                    yield json.dumps(to_report(company), ensure_ascii=False) + "\n"
+            finally:
+                report_db.close()
+
+        return StreamingResponse(iter_lines(), media_type="application/x-ndjson")
+
+    return [to_report(company) for company in iter_storage_report(db, storage_report.company_id)]
@@ -1,7 +1,7 @@
 from fastapi import Depends, APIRouter, status,HTTPException
 from models import Company,Region
 from typing import Annotated
-from db import get_db
+from db import get_db, get_read_db
 from sqlalchemy.orm import Session
 from schemas.auth import DecodedToken
 from auth import get_current_user
@@ -9,10 +9,11 @@ from schemas.companies import CompanyCreate,CompanyResponse,CompanyUpdate
 from datetime import datetime
 
 DbDependency = Annotated[Session, Depends(get_db)]
+ReadDbDependency = Annotated[Session, Depends(get_read_db)]
 UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
 
 router = APIRouter(prefix="/region",tags=["region"])
 @router.get('/get_all',status_code=status.HTTP_200_OK)
-async def queryParam(db: DbDependency):
+async def queryParam(db: ReadDbDependency):
     item = db.query(Region).all()
     return item
@@ -0,0 +1,44 @@
+from fastapi import Depends, APIRouter, Query, status
+from sqlalchemy.orm import Session
+from typing import Annotated
+from schemas.search import SearchResultResponse, SearchResponse
+from schemas.auth import DecodedToken
+from auth import get_current_user
+from db import get_db
+from search_index import search_entries
+from directory_tree import directory_storage_path, get_directory_tree_cache
+
+DbDependency = Annotated[Session, Depends(get_db)]
+UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
+router = APIRouter(prefix="/search", tags=["search"])
+
+# 会社内のファイル名・ディレクトリ名を検索（アクセス権のない非公開ディレクトリとその中のファイルは除く）
+@router.get('/', response_model=SearchResponse, status_code=status.HTTP_200_OK)
+async def search(db: DbDependency, user: UserDependency, q: str = Query(min_length=1, max_length=255),
+                 limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0, le=10000)):
+
+    tree = get_directory_tree_cache().get(db, user.company_id)
+    hidden_directory_ids = [
+        node.id for node in tree.nodes.values()
+        if not tree.is_visible(node, user.user_id)
+    ]
+
+    # 次のページの有無を判定するため1件多く取得
+    entries = search_entries(db, user.company_id, q, hidden_directory_ids, limit + 1, offset)
+
+    # 格納先のパスはキャッシュしたディレクトリツリーから取得
+    def directory_path(directory_id):
+        node = tree.get(directory_id) if directory_id is not None else None
+        return directory_storage_path(node) if node else None
+
+    search_result = [
+        SearchResultResponse(
+            entity_type=entry.entity_type,
+            id=entry.entity_id,
+            name=entry.name,
+            directory_id=entry.directory_id,
+            path=directory_path(entry.directory_id)
+        ) for entry in entries[:limit]
+    ]
+
+    return SearchResponse(items=search_result, has_more=len(entries) > limit)
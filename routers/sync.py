@@ -0,0 +1,80 @@
+from fastapi import Depends, APIRouter, Query, status
+from sqlalchemy.orm import Session
+from typing import Annotated
+from schemas.changes import ChangeResponse, ChangesResponse
+from schemas.auth import DecodedToken
+from auth import get_current_user
+from db import get_db
+from models import Directory, Permission
+from change_log import CHANGE_ENTITY_DIRECTORY, get_changes, get_latest_change_id
+from directory_tree import get_directory_tree_cache
+
+DbDependency = Annotated[Session, Depends(get_db)]
+UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
+router = APIRouter(prefix="/sync", tags=["sync"])
+
+# 前回のカーソルより後のディレクトリ・ファイルの変更を取得
+# reset_requiredがTrueの場合は、返したカーソルを保存してから一覧を全件取得し直す
+@router.get('/changes', response_model=ChangesResponse, status_code=status.HTTP_200_OK)
+async def get_sync_changes(db: DbDependency, user: UserDependency,
+                           cursor: int = Query(0, ge=0), limit: int = Query(500, ge=1, le=5000)):
+
+    changes, reset_required = get_changes(db, user.company_id, cursor, limit + 1)
+    if reset_required:
+        return ChangesResponse(changes=[], cursor=get_latest_change_id(db), has_more=False, reset_required=True)
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    # ユーザーがアクセス権を持たない非公開ディレクトリとその中の変更は返さない
+    tree = get_directory_tree_cache().get(db, user.company_id)
+
+    # 削除済みのディレクトリ（と作成直後でツリーにまだないディレクトリ）は、DBから公開設定とアクセス権を確認する
+    # DBにもないディレクトリは返さない
+    missing_ids = set()
+    for change in changes:
+        for directory_id in (change.directory_id, change.entity_id if change.entity_type == CHANGE_ENTITY_DIRECTORY else None):
+            if directory_id is not None and tree.get(directory_id) is None:
+                missing_ids.add(directory_id)
+
+    visible_missing_ids = set()
+    if missing_ids:
+        permitted_ids = {
+            row.directory_id for row in db.query(Permission.directory_id)
+                .filter(Permission.directory_id.in_(missing_ids), Permission.user_id == user.user_id)
+                .all()
+        }
+        visible_missing_ids = {
+            row.id for row in db.query(Directory.id, Directory.open_flg)
+                .filter(Directory.id.in_(missing_ids), Directory.company_id == user.company_id)
+                .all()
+            if not row.open_flg or row.id in permitted_ids
+        }
+
+    def is_visible(directory_id) -> bool:
+        if directory_id is None:
+            return True
+        node = tree.get(directory_id)
+        if node is None:
+            return directory_id in visible_missing_ids
+        return tree.is_visible(node, user.user_id)
+
+    change_result = [
+        ChangeResponse(
+            change_id=change.id,
+            entity_type=change.entity_type,
+            entity_id=change.entity_id,
+            action=change.action,
+            directory_id=change.directory_id,
+            name=change.name,
+            changed_at=change.create_at.strftime('%Y-%m-%d %H:%M:%S')
+        )
+        for change in changes
+        if is_visible(change.directory_id)
+        and (change.entity_type != CHANGE_ENTITY_DIRECTORY or is_visible(change.entity_id))
+    ]
+
+    # 返さなかった変更も含め、取得した最後の変更の次から続ける
+    next_cursor = changes[-1].id if changes else cursor
+
+    return ChangesResponse(changes=change_result, cursor=next_cursor, has_more=has_more, reset_required=False)
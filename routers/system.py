@@ -0,0 +1,19 @@
+from fastapi import Depends, APIRouter, HTTPException, status
+from typing import Annotated
+from schemas.auth import DecodedToken
+from auth import get_current_user
+from db_pool import pool_metrics_snapshot
+
+UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
+router = APIRouter(prefix="/system", tags=["system"])
+
+# このワーカープロセスのDB接続プールの集計値を取得(管理者用)
+# ワーカーごとの値のため、複数回取得してpidごとに比較する
+@router.get('/db_pool', status_code=status.HTTP_200_OK)
+async def get_db_pool_metrics(user: UserDependency):
+
+    # ユーザーが管理者でない場合はエラーを返す
+    if not user.admin:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return pool_metrics_snapshot()
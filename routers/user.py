@@ -5,7 +5,7 @@ from sqlalchemy.orm import Session
 from starlette import status
 from schemas.users import UserCreate,UserResponse, UserGetResponse, UserAdminGetResponse, UserSignup, UserUpdateResponse, UserUpdate, UserAdminUpdate, UserPasswordUpdate
 from schemas.auth import Token
-from db import get_db
+from db import get_db, get_read_db
 from models import User, Department, Company, Department
 import hashlib
 import base64
@@ -24,6 +24,7 @@ class OAuth2PasswordRequestFormCustom(BaseModel):
     personal_id: str
     password: str
 DbDependency = Annotated[Session, Depends(get_db)]
+ReadDbDependency = Annotated[Session, Depends(get_read_db)]
 UserDependency = Annotated[DecodedToken, Depends(get_current_user)]
 FormDependency = Annotated[OAuth2PasswordRequestFormCustom, Depends()]
 router = APIRouter(prefix="/user", tags=["User"])
@@ -181,7 +182,7 @@ async def get_user(db: DbDependency, user: UserDependency):
 
 #全てのユーザー情報取得機能(Admin権限)
 @router.get("/get_all_user", status_code=status.HTTP_200_OK)
-async def get_all_user(db: DbDependency, user: UserDependency):
+async def get_all_user(db: ReadDbDependency, user: UserDependency):
     if not user.admin:
         raise HTTPException(status_code=403, detail="No authority")
     
@@ -0,0 +1,17 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+class ChangeResponse(BaseModel):
+    change_id: int = Field(gt=0, examples=[1])
+    entity_type: str = Field(examples=["file"])
+    entity_id: int = Field(gt=0, examples=[1])
+    action: str = Field(examples=["create"])
+    directory_id: Optional[int] = Field(None, examples=[1])
+    name: Optional[str] = Field(None, examples=["ファイル名"])
+    changed_at: str = Field(examples=["2022-01-01 00:00:00"])
+
+class ChangesResponse(BaseModel):
+    changes: List[ChangeResponse]
+    cursor: int = Field(ge=0, examples=[1])
+    has_more: bool = Field(examples=[False])
+    reset_required: bool = Field(examples=[False])
@@ -18,6 +18,13 @@ class DirectoryResponse(BaseModel):
     directory_name: str = Field(min_length=1, examples=["フォルダ名"])
     path: Optional[str] = Field(None)
     directory_class: int = Field(gt=0, examples=[1])
+    parent_id: Optional[int] = Field(None, examples=[1])
+    total_size: Optional[int] = Field(None, examples=[1024])  # 配下のディレクトリを含むファイルの合計サイズ（KB）
+    total_files: Optional[int] = Field(None, examples=[10])
+
+class DirectoryCascadeResponse(DirectoryResponse):
+    affected_directories: int = Field(ge=0, examples=[1])
+    affected_files: int = Field(ge=0, examples=[0])
 
 class DirectoryGetResponse(BaseModel):
     directory_id: int = Field(gt=0, examples=[1])
@@ -30,3 +37,6 @@ class DirectoryGetResponse(BaseModel):
 class DirectoryDownload(BaseModel):
     directory_id: int = Field(gt=0, examples=[1])
     local_download_path: str = Field(min_length=1, examples=["ダウンロードパス"])
+
+class DirectoryArchive(BaseModel):
+    directory_id: int = Field(gt=0, examples=[1])
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 
 class FileGetResponse(BaseModel):
@@ -29,6 +29,17 @@ class FileDeleteResponse(BaseModel):
 class FileGet(BaseModel):
     directory_id: Optional[int] = Field(None, gt=0, examples=[1])
 
+class FileGetPage(BaseModel):
+    directory_id: int = Field(gt=0, examples=[1])
+    limit: int = Field(100, ge=1, le=1000, examples=[100])
+    cursor: Optional[str] = Field(None, examples=[None])
+    sort: Literal['name', 'update_at', 'size'] = Field('name', examples=['name'])
+    descending: bool = Field(False, examples=[False])
+
+class FilePageResponse(BaseModel):
+    items: List[FileGetResponse]
+    next_cursor: Optional[str] = Field(None)
+
 class FileDownload(BaseModel):
     file_id: int = Field(gt=0, examples=[1])
 
@@ -43,4 +54,29 @@ class FileDelete(BaseModel):
     file_id: int = Field(gt=0, examples=[1])
 
 class FileGetStorage(BaseModel):
-    company_id: int = Field(gt=0, examples=[1])
\ No newline at end of file
+    company_id: int = Field(gt=0, examples=[1])
+
+class FileStorageReport(BaseModel):
+    company_id: Optional[int] = Field(None, gt=0, examples=[1])
+
+class UserStorageReport(BaseModel):
+    user_id: int = Field(gt=0, examples=[1])
+    user_name: str = Field(examples=["ユーザー名"])
+    department_id: Optional[int] = Field(None, examples=[1])
+    storage: int = Field(examples=[1048576])
+    used_size: int = Field(ge=0, examples=[1024])
+
+class DepartmentStorageReport(BaseModel):
+    department_id: int = Field(gt=0, examples=[1])
+    department_name: str = Field(examples=["部署名"])
+    storage: int = Field(examples=[10485760])
+    used_size: int = Field(ge=0, examples=[1024])
+
+class CompanyStorageReport(BaseModel):
+    company_id: int = Field(gt=0, examples=[1])
+    company_name: str = Field(examples=["会社名"])
+    storage: int = Field(examples=[104857600])
+    used_size: int = Field(ge=0, examples=[1024])
+    file_size: str = Field(examples=["1MB"])
+    departments: List[DepartmentStorageReport]
+    users: List[UserStorageReport]
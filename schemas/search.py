@@ -0,0 +1,13 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+class SearchResultResponse(BaseModel):
+    entity_type: str = Field(examples=["file"])
+    id: int = Field(gt=0, examples=[1])
+    name: str = Field(examples=["ファイル名"])
+    directory_id: Optional[int] = Field(None, examples=[1])
+    path: Optional[str] = Field(None, examples=["フォルダ名/"])
+
+class SearchResponse(BaseModel):
+    items: List[SearchResultResponse]
+    has_more: bool = Field(examples=[False])
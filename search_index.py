@@ -0,0 +1,190 @@
+# ファイル名・ディレクトリ名の検索用の索引（cd_search_entries / cd_search_grams）を管理する
+# 名前はNFKC正規化・小文字化して保持し、前方一致は名前の索引、部分一致は2文字単位の索引で候補を絞り込む
+# 索引はディレクトリ・ファイルの更新と同じトランザクションで更新し、コミットは呼び出し側で行う
+from datetime import datetime
+from typing import Iterable, List, Optional, Set
+from sqlalchemy import and_, case, func, insert, or_, select
+from sqlalchemy.orm import Session
+from models import SearchEntry, SearchGram, Directory, File
+from db import SessionLocal
+from change_log import CHANGE_ENTITY_DIRECTORY, CHANGE_ENTITY_FILE
+import unicodedata
+
+# 部分一致検索の分割単位（文字数）
+SEARCH_GRAM_SIZE = 2
+
+# 一括登録する行数
+SEARCH_INDEX_BATCH_SIZE = 1000
+
+# 大文字・小文字や全角・半角の違いを無視するため、名前を正規化
+def normalize_search_text(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).lower()
+
+# 正規化した名前を2文字ずつに分割（1文字の名前はそのまま）
+def search_grams(normalized: str) -> Set[str]:
+    if len(normalized) < SEARCH_GRAM_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[index:index + SEARCH_GRAM_SIZE] for index in range(len(normalized) - SEARCH_GRAM_SIZE + 1)}
+
+# LIKEの特殊文字をエスケープ
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _insert_grams(db: Session, rows: List[dict]):
+    for start in range(0, len(rows), SEARCH_INDEX_BATCH_SIZE):
+        db.execute(insert(SearchGram).values(rows[start:start + SEARCH_INDEX_BATCH_SIZE]))
+
+# ディレクトリ・ファイルを索引に登録（登録済みの場合は名前と格納先を更新）
+def index_entry(db: Session, company_id: int, entity_type: str, entity_id: int, directory_id: Optional[int], name: str):
+    normalized = normalize_search_text(name)
+    entry = db.query(SearchEntry)\
+        .filter(
+            SearchEntry.entity_type == entity_type,
+            SearchEntry.entity_id == entity_id
+        )\
+        .first()
+
+    if entry is None:
+        entry = SearchEntry(company_id=company_id, entity_type=entity_type, entity_id=entity_id)
+        db.add(entry)
+    elif entry.normalized_name == normalized and entry.directory_id == directory_id:
+        entry.name = name
+        entry.update_at = datetime.now()
+        return
+
+    entry.directory_id = directory_id
+    entry.name = name
+    entry.normalized_name = normalized
+    entry.update_at = datetime.now()
+    db.flush()
+
+    db.query(SearchGram).filter(SearchGram.entry_id == entry.id).delete(synchronize_session=False)
+    _insert_grams(db, [
+        {"company_id": company_id, "gram": gram, "entry_id": entry.id}
+        for gram in search_grams(normalized)
+    ])
+
+# 索引から削除（entry_idsは削除する索引IDのサブクエリ）
+def _remove_entries(db: Session, entry_ids):
+    entry_ids = [row[0] for row in db.execute(entry_ids).all()]
+    for start in range(0, len(entry_ids), SEARCH_INDEX_BATCH_SIZE):
+        batch = entry_ids[start:start + SEARCH_INDEX_BATCH_SIZE]
+        db.query(SearchGram).filter(SearchGram.entry_id.in_(batch)).delete(synchronize_session=False)
+        db.query(SearchEntry).filter(SearchEntry.id.in_(batch)).delete(synchronize_session=False)
+
+def remove_entry(db: Session, entity_type: str, entity_id: int):
+    _remove_entries(db, select(SearchEntry.id).where(
+        SearchEntry.entity_type == entity_type,
+        SearchEntry.entity_id == entity_id
+    ))
+
+# 削除するディレクトリとその中のファイルを索引から削除（directory_idsは対象ディレクトリIDのサブクエリ）
+def remove_directories(db: Session, directory_ids):
+    _remove_entries(db, select(SearchEntry.id).where(
+        or_(
+            and_(SearchEntry.entity_type == CHANGE_ENTITY_DIRECTORY, SearchEntry.entity_id.in_(directory_ids)),
+            and_(SearchEntry.entity_type == CHANGE_ENTITY_FILE, SearchEntry.directory_id.in_(directory_ids))
+        )
+    ))
+
+# 名前で検索し、完全一致 → 前方一致 → 部分一致、短い名前の順に返す
+# hidden_directory_idsに含まれるディレクトリと、その中のファイルは除外する
+def search_entries(db: Session, company_id: int, query: str, hidden_directory_ids: Iterable[int],
+                   limit: int, offset: int = 0) -> List[SearchEntry]:
+    normalized = normalize_search_text(query.strip())
+    if not normalized:
+        return []
+
+    escaped = _escape_like(normalized)
+    search_query = db.query(SearchEntry).filter(SearchEntry.company_id == company_id)
+
+    grams = search_grams(normalized)
+    if len(normalized) < SEARCH_GRAM_SIZE:
+        # 1文字の場合は前方一致のみ（名前の索引を使用）
+        search_query = search_query.filter(SearchEntry.normalized_name.like(escaped + '%', escape='\\'))
+    else:
+        # 全ての2文字の組を含む名前を候補とし、実際に部分一致するものに絞り込む
+        # gramは文字を区別する照合順序のため、一致した組の数はPython側で数えた組の数と比較できる
+        candidate_ids = select(SearchGram.entry_id)\
+            .where(
+                SearchGram.company_id == company_id,
+                SearchGram.gram.in_(grams)
+            )\
+            .group_by(SearchGram.entry_id)\
+            .having(func.count(func.distinct(SearchGram.gram)) == len(grams))
+        search_query = search_query.filter(
+            SearchEntry.id.in_(candidate_ids),
+            SearchEntry.normalized_name.like('%' + escaped + '%', escape='\\')
+        )
+
+    hidden_directory_ids = list(hidden_directory_ids)
+    if hidden_directory_ids:
+        search_query = search_query.filter(
+            or_(SearchEntry.directory_id.is_(None), SearchEntry.directory_id.notin_(hidden_directory_ids)),
+            or_(SearchEntry.entity_type != CHANGE_ENTITY_DIRECTORY, SearchEntry.entity_id.notin_(hidden_directory_ids))
+        )
+
+    rank = case(
+        (SearchEntry.normalized_name == normalized, 0),
+        (SearchEntry.normalized_name.like(escaped + '%', escape='\\'), 1),
+        else_=2
+    )
+    return search_query\
+        .order_by(rank, func.char_length(SearchEntry.normalized_name), SearchEntry.normalized_name, SearchEntry.id)\
+        .offset(offset)\
+        .limit(limit)\
+        .all()
+
+# 削除されていないディレクトリ・ファイルから索引を作成し直す（company_idを指定した場合はその会社のみ）
+def rebuild_search_index(db: Session, company_id: Optional[int] = None) -> int:
+    entry_query = select(SearchEntry.id)
+    directory_query = db.query(Directory.id, Directory.company_id, Directory.parent_id, Directory.directory_name)\
+        .filter(Directory.delete_flg == False, Directory.directory_class != 0)
+    file_query = db.query(File.id, Directory.company_id, File.directory_id, File.file_name)\
+        .join(Directory, Directory.id == File.directory_id)\
+        .filter(File.delete_flg == False, Directory.delete_flg == False)
+    if company_id is not None:
+        entry_query = entry_query.where(SearchEntry.company_id == company_id)
+        directory_query = directory_query.filter(Directory.company_id == company_id)
+        file_query = file_query.filter(Directory.company_id == company_id)
+    _remove_entries(db, entry_query)
+
+    count = 0
+    for entity_type, query in ((CHANGE_ENTITY_DIRECTORY, directory_query), (CHANGE_ENTITY_FILE, file_query)):
+        rows = query.all()
+        for start in range(0, len(rows), SEARCH_INDEX_BATCH_SIZE):
+            batch = rows[start:start + SEARCH_INDEX_BATCH_SIZE]
+            entries = [
+                SearchEntry(
+                    company_id=row[1],
+                    entity_type=entity_type,
+                    entity_id=row[0],
+                    directory_id=row[2],
+                    name=row[3],
+                    normalized_name=normalize_search_text(row[3]),
+                    update_at=datetime.now()
+                )
+                for row in batch
+            ]
+            db.add_all(entries)
+            db.flush()
+            _insert_grams(db, [
+                {"company_id": entry.company_id, "gram": gram, "entry_id": entry.id}
+                for entry in entries
+                for gram in search_grams(entry.normalized_name)
+            ])
+            count += len(entries)
+    return count
+
+def main():
+    # 全ての索引を作成し直す
+    db = SessionLocal()
+    try:
+        count = rebuild_search_index(db)
+        db.commit()
+        print(f"rebuilt search index for {count} entries")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# ストレージバックエンドの選択
+# STORAGE_BACKEND: azure（既定）/ local（LOCAL_STORAGE_ROOT配下に保存）/ memory
+from dotenv import load_dotenv
+from storage.base import StorageBackend, StorageFileProperties, join_storage_path
+import os
+
+# .envファイルを読み込む
+load_dotenv()
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'azure')
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', './local_storage')
+
+_storage = None
+
+# 設定に応じたストレージバックエンドを作成
+def create_storage(backend: str = STORAGE_BACKEND) -> StorageBackend:
+    if backend == 'azure':
+        from storage.azure import AzureStorageBackend
+        return AzureStorageBackend()
+    if backend == 'local':
+        from storage.local import LocalStorageBackend
+        return LocalStorageBackend(LOCAL_STORAGE_ROOT)
+    if backend == 'memory':
+        from storage.memory import MemoryStorageBackend
+        return MemoryStorageBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+# プロセスで共有するストレージバックエンドを取得
+def get_storage() -> StorageBackend:
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
@@ -0,0 +1,134 @@
+# ストレージ上のファイルをZIP形式でストリーム配信する
+# ディスクに一時ファイルを作らず、ストレージから取得したチャンクをそのままZIPのエントリとして書き出す
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+import asyncio
+import io
+import logging
+import os
+import zipfile
+
+# .envファイルを読み込む
+load_dotenv()
+
+# 先行して取得を開始するファイル数と、ファイルごとに先読みするチャンク数
+# 1件のZIPで保持するのは最大でファイル数 ×（チャンク数 + 1）チャンクのため、fetchはストレージ側で先読みしないこと
+ARCHIVE_PREFETCH_FILES = int(os.getenv('ARCHIVE_PREFETCH_FILES', '4'))
+ARCHIVE_PREFETCH_CHUNKS = int(os.getenv('ARCHIVE_PREFETCH_CHUNKS', '2'))
+
+archive_logger = logging.getLogger('storage.archive')
+
+# ZIPに格納する項目（fetchがNoneの場合はディレクトリ）
+# fetchはチャンクの非同期イテレータを返すコルーチン関数
+class ArchiveEntry(NamedTuple):
+    name: str
+    fetch: Optional[Callable]
+    modified: Optional[datetime]
+
+_END = object()
+
+# zipfileの書き込み先（シークできないストリームとして扱われ、データディスクリプタ付きで書き出される）
+class _ZipOutput(io.RawIOBase):
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+# ZIPの日時はDOS形式のため1980年より前は扱えない
+def _zip_date_time(modified: Optional[datetime]):
+    if modified is None or modified.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return modified.timetuple()[:6]
+
+# 別タスクでファイルの取得を開始し、最大depth個のチャンクをキューに先読みする
+def _start_prefetch(fetch, depth: int):
+    queue = asyncio.Queue(maxsize=depth)
+
+    async def fill():
+        try:
+            async for chunk in await fetch():
+                await queue.put(chunk)
+            await queue.put(_END)
+        except Exception as e:
+            await queue.put(e)
+
+    return queue, asyncio.create_task(fill())
+
+# 取得を開始した時点でファイルが存在しない（一覧の取得後に削除された）場合
+def _is_missing(error: Exception) -> bool:
+    return isinstance(error, HTTPException) and error.status_code == status.HTTP_404_NOT_FOUND
+
+# 項目をZIP64形式でストリーム出力する
+# 後続のファイルはprefetch_files件まで並列に取得を開始しておき、前のファイルの書き出し中に待ち時間を重ねる
+# 一覧の取得後に削除されたファイルは、ZIPが途中で切れないようログに記録して格納しない
+async def stream_zip(entries: List[ArchiveEntry], prefetch_files: int = ARCHIVE_PREFETCH_FILES, prefetch_chunks: int = ARCHIVE_PREFETCH_CHUNKS):
+    output = _ZipOutput()
+    archive = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    file_indexes = [index for index, entry in enumerate(entries) if entry.fetch is not None]
+    prefetched = {}
+    next_prefetch = 0
+    current_task = None
+
+    try:
+        for index, entry in enumerate(entries):
+            info = zipfile.ZipInfo(entry.name, date_time=_zip_date_time(entry.modified))
+
+            if entry.fetch is None:
+                archive.writestr(info, b'')
+                continue
+
+            # このファイルを含め、prefetch_files件先までの取得を開始
+            while next_prefetch < len(file_indexes) and len(prefetched) < max(prefetch_files, 1):
+                file_index = file_indexes[next_prefetch]
+                prefetched[file_index] = _start_prefetch(entries[file_index].fetch, prefetch_chunks)
+                next_prefetch += 1
+
+            queue, current_task = prefetched.pop(index)
+            # エントリのヘッダーを書き出す前に、ファイルを取得できるか確認する
+            chunk = await queue.get()
+            if isinstance(chunk, Exception) and _is_missing(chunk):
+                archive_logger.warning("skipped missing file in archive: %s", entry.name)
+                current_task = None
+                continue
+
+            with archive.open(info, 'w', force_zip64=True) as destination:
+                while True:
+                    if chunk is _END:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    destination.write(chunk)
+                    data = output.drain()
+                    if data:
+                        yield data
+                    chunk = await queue.get()
+            await current_task
+            current_task = None
+
+        archive.close()
+        data = output.drain()
+        if data:
+            yield data
+    finally:
+        # 中断した場合もZipFileを閉じておく（出力済みのデータは使わないため、書き出されたデータは破棄する）
+        archive.close()
+        output.drain()
+        # クライアントが切断した場合も取得中のタスクを停止する
+        if current_task is not None:
+            current_task.cancel()
+        for _, task in prefetched.values():
+            task.cancel()
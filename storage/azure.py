@@ -0,0 +1,64 @@
+# Azure Files（azure_access_aio）を使用するストレージバックエンド
+from typing import Optional
+from storage.base import StorageBackend, StorageFileProperties
+from azure_access import AZURE_DOWNLOAD_READ_AHEAD
+import azure_access_aio
+
+# AzureのFilePropertiesを共通のプロパティに変換
+def _to_storage_properties(properties, size: Optional[int] = None) -> StorageFileProperties:
+    return StorageFileProperties(
+        size=properties.size if size is None else size,
+        etag=properties.etag,
+        last_modified=properties.last_modified
+    )
+
+# 範囲取得時のContent-Range（bytes 開始-終了/全体）からファイル全体のサイズを取得
+def _parse_total_size(content_range: Optional[str]) -> Optional[int]:
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1]
+    return int(total) if total.isdigit() else None
+
+class AzureStorageBackend(StorageBackend):
+
+    async def create_share(self, storage_name: str):
+        await azure_access_aio.add_azure_share_client(storage_name)
+
+    async def delete_share(self, storage_name: str):
+        await azure_access_aio.delete_azure_share_client(storage_name)
+
+    async def create_directory(self, storage_name: str, parent_path: Optional[str], directory_name: str):
+        await azure_access_aio.create_azure_folder(directory_name, parent_path, storage_name)
+
+    async def delete_directory(self, storage_name: str, directory_path: str) -> dict:
+        return await azure_access_aio.delete_azure_folder_recursive(directory_path, storage_name)
+
+    async def rename_directory(self, storage_name: str, old_directory_path: str, new_directory_path: str):
+        await azure_access_aio.rename_azure_folder(old_directory_path, new_directory_path, storage_name)
+
+    async def upload_file(self, storage_name: str, directory_path: Optional[str], file_name: str, source, file_size: int, progress=None):
+        await azure_access_aio.upload_stream_to_azure(source, file_size, file_name, directory_path, storage_name, progress=progress)
+
+    async def get_file_properties(self, storage_name: str, directory_path: Optional[str], file_name: str) -> StorageFileProperties:
+        properties = await azure_access_aio.get_azure_file_properties(storage_name, directory_path, file_name)
+        return _to_storage_properties(properties)
+
+    async def download_file(self, storage_name: str, directory_path: Optional[str], file_name: str,
+                            offset: Optional[int] = None, length: Optional[int] = None, read_ahead: Optional[int] = None):
+        size, properties, chunks = await azure_access_aio.download_file_from_azure_to_stream(
+            storage_name, directory_path, file_name, offset, length,
+            AZURE_DOWNLOAD_READ_AHEAD if read_ahead is None else read_ahead
+        )
+        return size, _to_storage_properties(properties, _parse_total_size(properties.content_range)), chunks
+
+    async def rename_file(self, storage_name: str, directory_path: Optional[str], old_file_name: str, new_file_name: str):
+        await azure_access_aio.rename_azure_file(storage_name, directory_path, old_file_name, new_file_name)
+
+    async def delete_file(self, storage_name: str, directory_path: Optional[str], file_name: str):
+        await azure_access_aio.delete_azure_file(storage_name, directory_path, file_name)
+
+    async def list_directory(self, storage_name: str, directory_path: Optional[str] = None):
+        return await azure_access_aio.list_azure_directory(storage_name, directory_path)
+
+    async def close(self):
+        await azure_access_aio.close_azure_clients()
@@ -0,0 +1,82 @@
+# ストレージバックエンドの共通インターフェース
+# ルーターはこのインターフェースのみを使用し、実装は環境変数STORAGE_BACKENDで切り替える
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AsyncIterator, List, NamedTuple, Optional, Tuple
+
+# ダウンロード・範囲取得で使用するファイルのプロパティ（sizeはファイル全体のバイト数）
+class StorageFileProperties(NamedTuple):
+    size: int
+    etag: str
+    last_modified: Optional[datetime]
+
+# ディレクトリパスとファイル名を、先頭・末尾のスラッシュを除いたストレージ内のパスに変換
+def join_storage_path(directory_path: Optional[str], name: Optional[str] = None) -> str:
+    parts = [part for part in (directory_path or '').split('/') if part]
+    if name:
+        parts.append(name)
+    return '/'.join(parts)
+
+class StorageBackend(ABC):
+
+    # 共有（会社ごとのストレージ）を作成
+    @abstractmethod
+    async def create_share(self, storage_name: str):
+        ...
+
+    # 共有を削除
+    @abstractmethod
+    async def delete_share(self, storage_name: str):
+        ...
+
+    # parent_path配下にディレクトリを作成
+    @abstractmethod
+    async def create_directory(self, storage_name: str, parent_path: Optional[str], directory_name: str):
+        ...
+
+    # ディレクトリを配下ごと削除し、削除件数と失敗した項目の一覧を返す
+    @abstractmethod
+    async def delete_directory(self, storage_name: str, directory_path: str) -> dict:
+        ...
+
+    # ディレクトリをリネーム（移動）
+    @abstractmethod
+    async def rename_directory(self, storage_name: str, old_directory_path: str, new_directory_path: str):
+        ...
+
+    # await source.read(size)で読み込めるソースからファイルをアップロード
+    @abstractmethod
+    async def upload_file(self, storage_name: str, directory_path: Optional[str], file_name: str, source, file_size: int, progress=None):
+        ...
+
+    # ファイルのプロパティを取得
+    @abstractmethod
+    async def get_file_properties(self, storage_name: str, directory_path: Optional[str], file_name: str) -> StorageFileProperties:
+        ...
+
+    # ファイルをダウンロードし、(取得サイズ, プロパティ, チャンクの非同期イテレータ)を返す
+    # read_aheadは先読みするチャンク数（Noneの場合はバックエンドの既定値、0の場合は先読みしない）
+    @abstractmethod
+    async def download_file(self, storage_name: str, directory_path: Optional[str], file_name: str,
+                            offset: Optional[int] = None, length: Optional[int] = None,
+                            read_ahead: Optional[int] = None) -> Tuple[int, StorageFileProperties, AsyncIterator[bytes]]:
+        ...
+
+    # ファイルをリネーム
+    @abstractmethod
+    async def rename_file(self, storage_name: str, directory_path: Optional[str], old_file_name: str, new_file_name: str):
+        ...
+
+    # ファイルを削除
+    @abstractmethod
+    async def delete_file(self, storage_name: str, directory_path: Optional[str], file_name: str):
+        ...
+
+    # ディレクトリ直下の項目名の一覧を取得
+    @abstractmethod
+    async def list_directory(self, storage_name: str, directory_path: Optional[str] = None) -> List[str]:
+        ...
+
+    # アプリケーション終了時に接続などを解放
+    async def close(self):
+        pass
@@ -0,0 +1,205 @@
+# ダウンロード頻度の高いファイルをローカルディスクに保持するリードスルーキャッシュ
+# キーは(File.id, file_update_at)のため、ファイルが更新されると古いキャッシュは参照されずLRUで削除される
+# 同じファイルへの同時のキャッシュミスは1回のストレージからの取得を共有し、書き込み中の一時ファイルを読み進めて配信する
+# FILE_CACHE_DIRが設定されている場合のみ有効
+# 削除・配信中の管理はプロセス内でのみ行うため、ワーカープロセスごとにFILE_CACHE_DIR配下の専用のディレクトリを使用する
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Optional, Tuple
+from dotenv import load_dotenv
+import asyncio
+import fcntl
+import os
+import uuid
+
+# .envファイルを読み込む
+load_dotenv()
+
+FILE_CACHE_DIR = os.getenv('FILE_CACHE_DIR')
+FILE_CACHE_MAX_BYTES = int(os.getenv('FILE_CACHE_MAX_BYTES', str(10 * 1024 * 1024 * 1024)))  # ワーカープロセスごとの上限
+
+# FILE_CACHE_DIR配下のworker-0, worker-1, ...の順にロックファイルの排他ロック（flock）を試み、取得できたディレクトリを使用する
+# ロックはプロセスの終了時に解放されるため、再起動したワーカーは終了したワーカーのキャッシュを引き継ぐ
+def _claim_worker_directory(root: str):
+    index = 0
+    while True:
+        directory = os.path.join(root, f"worker-{index}")
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, '.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            index += 1
+            continue
+        return directory, lock_file
+
+# ストレージから取得して一時ファイルに書き込み中のキャッシュ
+class _CacheFill:
+
+    def __init__(self, temp_path: str):
+        self.temp_path = temp_path
+        self.file_size = asyncio.get_running_loop().create_future()  # 取得を開始したらファイルサイズを設定する
+        self.written = 0  # 一時ファイルに書き込み済みのバイト数
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+class FileCache:
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory, self._lock_file = _claim_worker_directory(os.path.abspath(directory))
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # キー -> ファイルサイズ（先頭ほど古い）
+        self.total_size = 0
+        self._pins = {}  # 配信中のため削除できないキー -> 参照数
+        self._inflight = {}  # 書き込み中のキー -> _CacheFill
+        self._load()
+
+    # 再起動時に既存のキャッシュファイルを更新日時の古い順に登録し、書き込み途中のファイルは削除する
+    # ディレクトリはこのプロセスのみが使用するため、書き込み途中のファイルは終了したプロセスが残したもの
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name == '.lock':
+                continue
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_size += size
+        self._evict()
+
+    # ファイルIDと更新日時からキャッシュのキーを作成
+    @staticmethod
+    def cache_key(file_id: int, file_update_at: Optional[datetime]) -> str:
+        version = file_update_at.strftime('%Y%m%d%H%M%S%f') if file_update_at else '0'
+        return f"{file_id}-{version}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    # キャッシュ済みならそのパスを、未登録ならNoneを返す
+    # 返したキーは配信が終わるまで削除されないため、使用後に必ずrelease()を呼ぶこと
+    def acquire(self, key: str) -> Optional[str]:
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        return self.path(key)
+
+    def release(self, key: str):
+        count = self._pins.get(key, 0) - 1
+        if count > 0:
+            self._pins[key] = count
+        else:
+            self._pins.pop(key, None)
+            self._evict()
+
+    # キャッシュにないファイルを取得し、(ファイルサイズ, チャンクの非同期イテレータ)を返す
+    # downloadは(ファイルサイズ, プロパティ, チャンク)を返すストレージからの取得で、同じキーを書き込み中の場合は呼び出さない
+    # 取得はリクエストとは別のタスクで一時ファイルに書き込み、各リクエストは書き込み済みの範囲を読み進める
+    # クライアントが切断しても取得は続け、最後まで書き込めたらキャッシュに登録する
+    async def fetch(self, key: str, download: Callable[[], Awaitable[tuple]]) -> Tuple[int, AsyncIterator[bytes]]:
+        fill = self._inflight.get(key)
+        if fill is None:
+            fill = self._start_fill(key, download)
+        # 書き込みが終わって一時ファイルが置き換えられる前に開いておく
+        source = open(fill.temp_path, 'rb')
+        try:
+            file_size = await asyncio.shield(fill.file_size)
+        except BaseException:
+            source.close()
+            raise
+        return file_size, self._tail(fill, source)
+
+    def _start_fill(self, key: str, download) -> _CacheFill:
+        fill = _CacheFill(os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp"))
+        output = open(fill.temp_path, 'wb')
+        self._inflight[key] = fill
+        fill.task = asyncio.create_task(self._run_fill(key, fill, output, download))
+        return fill
+
+    async def _run_fill(self, key: str, fill: _CacheFill, output, download):
+        def write(chunk: bytes):
+            output.write(chunk)
+            output.flush()
+
+        try:
+            with output:
+                file_size, _, chunks = await download()
+                fill.file_size.set_result(file_size)
+                async for chunk in chunks:
+                    await asyncio.to_thread(write, chunk)
+                    fill.written += len(chunk)
+                    await fill.notify()
+            # 以降のリクエストはキャッシュから配信する（置き換え中に来たリクエストは取得し直す）
+            self._inflight.pop(key, None)
+            await asyncio.to_thread(os.replace, fill.temp_path, self.path(key))
+            self.entries[key] = fill.written
+            self.total_size += fill.written
+            self._evict()
+        except BaseException as e:
+            fill.error = e
+            if not fill.file_size.done():
+                fill.file_size.set_exception(e)
+                fill.file_size.exception()  # 待っているリクエストがない場合に警告を出さない
+        finally:
+            self._inflight.pop(key, None)
+            if os.path.exists(fill.temp_path):
+                os.remove(fill.temp_path)
+            fill.done = True
+            await fill.notify()
+
+    # 一時ファイルの書き込み済みの範囲を読み、追いついたら書き込みを待つ
+    async def _tail(self, fill: _CacheFill, source) -> AsyncIterator[bytes]:
+        position = 0
+        with source:
+            while True:
+                if position < fill.written:
+                    chunk = await asyncio.to_thread(source.read, min(1024 * 1024, fill.written - position))
+                    position += len(chunk)
+                    yield chunk
+                    continue
+                if fill.done:
+                    if fill.error is not None:
+                        raise fill.error
+                    return
+                async with fill.changed:
+                    await fill.changed.wait_for(lambda: fill.written > position or fill.done)
+
+    # 上限を超えている間、配信中でない古いキャッシュから削除する
+    def _evict(self):
+        if self.total_size <= self.max_bytes:
+            return
+        for key in list(self.entries):
+            if self.total_size <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            self.total_size -= self.entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+_file_cache = None
+
+# キャッシュが有効な場合はプロセスで共有するFileCacheを、無効な場合はNoneを返す
+def get_file_cache() -> Optional[FileCache]:
+    global _file_cache
+    if FILE_CACHE_DIR is None:
+        return None
+    if _file_cache is None:
+        _file_cache = FileCache(FILE_CACHE_DIR, FILE_CACHE_MAX_BYTES)
+    return _file_cache
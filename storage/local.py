@@ -0,0 +1,159 @@
+# ローカルファイルシステムを使用するストレージバックエンド
+# Azureのストレージアカウントなしでルーターの動作確認・負荷試験を行うために使用する
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import HTTPException, status
+from storage.base import StorageBackend, StorageFileProperties, join_storage_path
+import asyncio
+import os
+import shutil
+import uuid
+
+# 読み書き時のチャンクサイズ
+LOCAL_STORAGE_CHUNK_SIZE = 1024 * 1024
+
+class LocalStorageBackend(StorageBackend):
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    # ストレージ内のパスを実際のパスに変換（ルート外へのアクセスは拒否）
+    def _resolve(self, storage_name: str, path: str = '') -> str:
+        share_root = os.path.join(self.root, storage_name)
+        full_path = os.path.abspath(os.path.join(share_root, path))
+        if full_path != share_root and not full_path.startswith(share_root + os.sep):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid path")
+        return full_path
+
+    def _file_path(self, storage_name: str, directory_path: Optional[str], file_name: str) -> str:
+        return self._resolve(storage_name, join_storage_path(directory_path, file_name))
+
+    @staticmethod
+    def _properties(file_path: str) -> StorageFileProperties:
+        stat = os.stat(file_path)
+        return StorageFileProperties(
+            size=stat.st_size,
+            etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            last_modified=datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+        )
+
+    async def create_share(self, storage_name: str):
+        await asyncio.to_thread(os.makedirs, self._resolve(storage_name), exist_ok=True)
+
+    async def delete_share(self, storage_name: str):
+        share_root = self._resolve(storage_name)
+        if not os.path.isdir(share_root):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Share client '{storage_name}' not found")
+        await asyncio.to_thread(shutil.rmtree, share_root)
+
+    async def create_directory(self, storage_name: str, parent_path: Optional[str], directory_name: str):
+        directory_path = self._resolve(storage_name, join_storage_path(parent_path, directory_name))
+        try:
+            await asyncio.to_thread(os.makedirs, directory_path)
+        except FileExistsError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のフォルダが存在しています")
+
+    async def delete_directory(self, storage_name: str, directory_path: str) -> dict:
+        full_path = self._resolve(storage_name, join_storage_path(directory_path))
+        if not os.path.isdir(full_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+
+        def delete_tree():
+            deleted_files = 0
+            deleted_directories = 0
+            for current, directories, files in os.walk(full_path, topdown=False):
+                for name in files:
+                    os.remove(os.path.join(current, name))
+                    deleted_files += 1
+                if current != self._resolve(storage_name):
+                    os.rmdir(current)
+                    deleted_directories += 1
+            return {"deleted_files": deleted_files, "deleted_directories": deleted_directories, "errors": []}
+
+        return await asyncio.to_thread(delete_tree)
+
+    async def rename_directory(self, storage_name: str, old_directory_path: str, new_directory_path: str):
+        old_path = self._resolve(storage_name, join_storage_path(old_directory_path))
+        new_path = self._resolve(storage_name, join_storage_path(new_directory_path))
+        if not os.path.isdir(old_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+        if os.path.exists(new_path):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+        await asyncio.to_thread(os.rename, old_path, new_path)
+
+    async def upload_file(self, storage_name: str, directory_path: Optional[str], file_name: str, source, file_size: int, progress=None):
+        file_path = self._file_path(storage_name, directory_path, file_name)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+
+        # 一時ファイルに書き込んでから置き換え、書き込み途中のファイルを見せない
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.uploading"
+        uploaded_size = 0
+        try:
+            with open(temp_path, 'wb') as output:
+                while True:
+                    chunk = await source.read(LOCAL_STORAGE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    uploaded_size += len(chunk)
+                    if uploaded_size > file_size:
+                        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズを超えています")
+                    await asyncio.to_thread(output.write, chunk)
+                    if progress:
+                        progress(uploaded_size, file_size)
+            if uploaded_size != file_size:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズと一致しません")
+            await asyncio.to_thread(os.replace, temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                await asyncio.to_thread(os.remove, temp_path)
+
+    async def get_file_properties(self, storage_name: str, directory_path: Optional[str], file_name: str) -> StorageFileProperties:
+        file_path = self._file_path(storage_name, directory_path, file_name)
+        if not os.path.isfile(file_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"File '{file_name}' not found")
+        return self._properties(file_path)
+
+    async def download_file(self, storage_name: str, directory_path: Optional[str], file_name: str,
+                            offset: Optional[int] = None, length: Optional[int] = None, read_ahead: Optional[int] = None):
+        properties = await self.get_file_properties(storage_name, directory_path, file_name)
+        file_path = self._file_path(storage_name, directory_path, file_name)
+
+        start = offset or 0
+        end = properties.size if length is None else min(start + length, properties.size)
+
+        async def read_chunks():
+            with open(file_path, 'rb') as source:
+                source.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = await asyncio.to_thread(source.read, min(LOCAL_STORAGE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return max(end - start, 0), properties, read_chunks()
+
+    async def rename_file(self, storage_name: str, directory_path: Optional[str], old_file_name: str, new_file_name: str):
+        old_path = self._file_path(storage_name, directory_path, old_file_name)
+        new_path = self._file_path(storage_name, directory_path, new_file_name)
+        if not os.path.isfile(old_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Old file '{old_file_name}' does not exist")
+        if os.path.exists(new_path):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のファイルが存在しています")
+        await asyncio.to_thread(os.rename, old_path, new_path)
+
+    async def delete_file(self, storage_name: str, directory_path: Optional[str], file_name: str):
+        file_path = self._file_path(storage_name, directory_path, file_name)
+        try:
+            await asyncio.to_thread(os.remove, file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"File '{file_name}' not found")
+
+    async def list_directory(self, storage_name: str, directory_path: Optional[str] = None):
+        full_path = self._resolve(storage_name, join_storage_path(directory_path))
+        if not os.path.isdir(full_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+        return sorted(name for name in os.listdir(full_path) if not name.endswith('.uploading'))
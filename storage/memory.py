@@ -0,0 +1,145 @@
+# メモリ上にデータを保持するストレージバックエンド
+# ストレージのI/Oを除いたアプリケーション自体の処理時間を計測するために使用する
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import HTTPException, status
+from storage.base import StorageBackend, StorageFileProperties, join_storage_path
+import itertools
+
+# ダウンロード時のチャンクサイズ
+MEMORY_STORAGE_CHUNK_SIZE = 1024 * 1024
+
+class MemoryStorageBackend(StorageBackend):
+
+    def __init__(self):
+        # storage_name -> {"directories": ディレクトリパスの集合, "files": ファイルパス -> (データ, プロパティ)}
+        self.shares = {}
+        self._etags = itertools.count(1)
+
+    def _share(self, storage_name: str) -> dict:
+        share = self.shares.get(storage_name)
+        if share is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Share client '{storage_name}' not found")
+        return share
+
+    def _require_directory(self, share: dict, directory_path: str):
+        if directory_path and directory_path not in share["directories"]:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+
+    def _get_file(self, storage_name: str, directory_path: Optional[str], file_name: str):
+        file = self._share(storage_name)["files"].get(join_storage_path(directory_path, file_name))
+        if file is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"File '{file_name}' not found")
+        return file
+
+    @staticmethod
+    def _is_under(path: str, directory_path: str) -> bool:
+        return path == directory_path or path.startswith(directory_path + '/')
+
+    async def create_share(self, storage_name: str):
+        self.shares.setdefault(storage_name, {"directories": set(), "files": {}})
+
+    async def delete_share(self, storage_name: str):
+        self._share(storage_name)
+        del self.shares[storage_name]
+
+    async def create_directory(self, storage_name: str, parent_path: Optional[str], directory_name: str):
+        share = self._share(storage_name)
+        parent = join_storage_path(parent_path)
+        self._require_directory(share, parent)
+        directory_path = join_storage_path(parent, directory_name)
+        if directory_path in share["directories"]:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のフォルダが存在しています")
+        share["directories"].add(directory_path)
+
+    async def delete_directory(self, storage_name: str, directory_path: str) -> dict:
+        share = self._share(storage_name)
+        target = join_storage_path(directory_path)
+        self._require_directory(share, target)
+
+        files = [path for path in share["files"] if not target or self._is_under(path, target)]
+        directories = [path for path in share["directories"] if not target or self._is_under(path, target)]
+        for path in files:
+            del share["files"][path]
+        share["directories"].difference_update(directories)
+        return {"deleted_files": len(files), "deleted_directories": len(directories), "errors": []}
+
+    async def rename_directory(self, storage_name: str, old_directory_path: str, new_directory_path: str):
+        share = self._share(storage_name)
+        old_path = join_storage_path(old_directory_path)
+        new_path = join_storage_path(new_directory_path)
+        if old_path not in share["directories"]:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+        if new_path in share["directories"]:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新しいディレクトリが既に存在しています")
+
+        def move(path: str) -> str:
+            return new_path + path[len(old_path):] if self._is_under(path, old_path) else path
+
+        share["directories"] = {move(path) for path in share["directories"]}
+        share["files"] = {move(path): file for path, file in share["files"].items()}
+
+    async def upload_file(self, storage_name: str, directory_path: Optional[str], file_name: str, source, file_size: int, progress=None):
+        share = self._share(storage_name)
+        self._require_directory(share, join_storage_path(directory_path))
+
+        data = bytearray()
+        while True:
+            chunk = await source.read(MEMORY_STORAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            data.extend(chunk)
+            if len(data) > file_size:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズを超えています")
+            if progress:
+                progress(len(data), file_size)
+        if len(data) != file_size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ファイルサイズが申告されたサイズと一致しません")
+
+        properties = StorageFileProperties(
+            size=len(data),
+            etag=f'"{next(self._etags):x}"',
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0)
+        )
+        share["files"][join_storage_path(directory_path, file_name)] = (bytes(data), properties)
+
+    async def get_file_properties(self, storage_name: str, directory_path: Optional[str], file_name: str) -> StorageFileProperties:
+        return self._get_file(storage_name, directory_path, file_name)[1]
+
+    async def download_file(self, storage_name: str, directory_path: Optional[str], file_name: str,
+                            offset: Optional[int] = None, length: Optional[int] = None, read_ahead: Optional[int] = None):
+        data, properties = self._get_file(storage_name, directory_path, file_name)
+        start = offset or 0
+        end = len(data) if length is None else min(start + length, len(data))
+
+        async def read_chunks():
+            for position in range(start, end, MEMORY_STORAGE_CHUNK_SIZE):
+                yield data[position:min(position + MEMORY_STORAGE_CHUNK_SIZE, end)]
+
+        return max(end - start, 0), properties, read_chunks()
+
+    async def rename_file(self, storage_name: str, directory_path: Optional[str], old_file_name: str, new_file_name: str):
+        files = self._share(storage_name)["files"]
+        old_path = join_storage_path(directory_path, old_file_name)
+        new_path = join_storage_path(directory_path, new_file_name)
+        if old_path not in files:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Old file '{old_file_name}' does not exist")
+        if new_path in files:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="同名のファイルが存在しています")
+        files[new_path] = files.pop(old_path)
+
+    async def delete_file(self, storage_name: str, directory_path: Optional[str], file_name: str):
+        self._get_file(storage_name, directory_path, file_name)
+        del self._share(storage_name)["files"][join_storage_path(directory_path, file_name)]
+
+    async def list_directory(self, storage_name: str, directory_path: Optional[str] = None):
+        share = self._share(storage_name)
+        target = join_storage_path(directory_path)
+        self._require_directory(share, target)
+        prefix = target + '/' if target else ''
+
+        names = set()
+        for path in list(share["directories"]) + list(share["files"]):
+            if path.startswith(prefix) and path != target:
+                names.add(path[len(prefix):].split('/', 1)[0])
+        return sorted(names)
@@ -0,0 +1,378 @@
+# ユーザー・部署・会社ごとのストレージ使用量（KB）の集計値を管理する
+# 容量チェックはcd_storage_usagesの行を読むだけで済むため、ファイル数に関係なく一定の時間で終わる
+# 集計値はファイルの追加・上書き・削除と同じトランザクションで増減させ、コミットは呼び出し側で行う
+# ファイルはアップロードしたユーザーと、そのユーザーの部署・会社の使用量として数える
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+import asyncio
+import os
+from sqlalchemy import and_, func, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+from models import StorageUsage, StorageReservation, File, User, Department, Company
+from db import SessionLocal
+
+# .envファイルを読み込む
+load_dotenv()
+
+# 予約の有効期間と、期限切れの予約を解放する間隔（秒）
+STORAGE_RESERVATION_TTL = int(os.getenv('STORAGE_RESERVATION_TTL', str(2 * 60 * 60)))
+STORAGE_RESERVATION_REAP_INTERVAL = int(os.getenv('STORAGE_RESERVATION_REAP_INTERVAL', '60'))
+
+USAGE_USER = 'user'
+USAGE_DEPARTMENT = 'department'
+USAGE_COMPANY = 'company'
+
+# 使用量を数える単位（owner_type, owner_id）
+UsageOwner = Tuple[str, int]
+
+def usage_owners(user_id: int, department_id: int, company_id: int) -> List[UsageOwner]:
+    return [(USAGE_USER, user_id), (USAGE_DEPARTMENT, department_id), (USAGE_COMPANY, company_id)]
+
+# ファイルをアップロードしたユーザーの使用量の単位を取得
+def get_file_owners(db: Session, user_id: int) -> List[UsageOwner]:
+    owner = db.query(User.department_id, User.company_id).filter(User.id == user_id).first()
+    if owner is None:
+        return [(USAGE_USER, user_id)]
+    return usage_owners(user_id, owner.department_id, owner.company_id)
+
+# 削除されていないファイルのサイズをowner_type単位で集計するクエリ
+def _file_size_query(db: Session, owner_type: str):
+    owner_column = {
+        USAGE_USER: File.user_id,
+        USAGE_DEPARTMENT: User.department_id,
+        USAGE_COMPANY: User.company_id,
+    }[owner_type]
+
+    query = db.query(owner_column.label('owner_id'), func.coalesce(func.sum(File.file_size), 0).label('used_size'))\
+        .select_from(File)
+    if owner_type != USAGE_USER:
+        query = query.join(User, User.id == File.user_id)
+    return query.filter(File.delete_flg == False).group_by(owner_column), owner_column
+
+# 集計値の行がない単位はファイルから集計して作成する（導入前のデータや新しいユーザー・部署の場合）
+def _ensure_usage(db: Session, owners: List[UsageOwner]):
+    existing = {
+        (row.owner_type, row.owner_id)
+        for row in db.query(StorageUsage.owner_type, StorageUsage.owner_id)
+            .filter(tuple_(StorageUsage.owner_type, StorageUsage.owner_id).in_(owners))
+            .all()
+    }
+
+    missing = [owner for owner in owners if owner not in existing]
+    if not missing:
+        return
+
+    rows = []
+    for owner_type, owner_id in missing:
+        query, owner_column = _file_size_query(db, owner_type)
+        result = query.filter(owner_column == owner_id).first()
+        rows.append({
+            "owner_type": owner_type,
+            "owner_id": owner_id,
+            "used_size": result.used_size if result else 0,
+            "update_at": datetime.now()
+        })
+
+    # 同時に作成された場合は先に作成された行を残す
+    statement = mysql_insert(StorageUsage).values(rows)
+    statement = statement.on_duplicate_key_update(owner_type=statement.inserted.owner_type)
+    db.execute(statement)
+
+# 使用量を取得
+def get_usage(db: Session, owners: List[UsageOwner]) -> Dict[UsageOwner, int]:
+    _ensure_usage(db, owners)
+    rows = db.query(StorageUsage.owner_type, StorageUsage.owner_id, StorageUsage.used_size)\
+        .filter(tuple_(StorageUsage.owner_type, StorageUsage.owner_id).in_(owners))\
+        .all()
+    return {(row.owner_type, row.owner_id): row.used_size for row in rows}
+
+# 使用量を増減（UPDATE ... SET used_size = used_size + deltaのため同時に実行しても値が失われない）
+def add_usage(db: Session, owners: List[UsageOwner], delta: int):
+    if not delta:
+        return
+    _ensure_usage(db, owners)
+    db.query(StorageUsage)\
+        .filter(tuple_(StorageUsage.owner_type, StorageUsage.owner_id).in_(owners))\
+        .update(
+            {
+                StorageUsage.used_size: StorageUsage.used_size + delta,
+                StorageUsage.update_at: datetime.now()
+            },
+            synchronize_session=False
+        )
+
+# 削除するファイルの分だけ、アップロードしたユーザーごとに使用量を減らす
+def release_files_usage(db: Session, files: List[File]):
+    size_by_user = {}
+    for file in files:
+        size_by_user[file.user_id] = size_by_user.get(file.user_id, 0) + (file.file_size or 0)
+
+    for user_id, size in size_by_user.items():
+        add_usage(db, get_file_owners(db, user_id), -size)
+
+# 容量を超えたため予約できなかった場合の例外（owner_typeで超えた単位を示す）
+class StorageQuotaExceeded(Exception):
+
+    def __init__(self, owner_type: str):
+        super().__init__(owner_type)
+        self.owner_type = owner_type
+
+# アップロードするサイズ分の容量を予約し、予約IDを返す
+# 単位ごとに「used_size + reserved_size + size <= 上限」を条件にしたUPDATEで確保するため、
+# 並列にアップロードしても上限を超えず、ロックは予約のトランザクションの間しか保持しない
+# 予約はここでコミットし、アップロード中の他のリクエストから見えるようにする
+def reserve_usage(db: Session, owners: List[UsageOwner], limits: Dict[UsageOwner, int], size: int) -> int:
+    user_owner, department_owner, company_owner = owners
+    try:
+        _ensure_usage(db, owners)
+        # 他の更新とデッドロックしないよう、一意キーの順に行をロックする
+        for owner in sorted(owners):
+            owner_type, owner_id = owner
+            result = db.query(StorageUsage)\
+                .filter(
+                    StorageUsage.owner_type == owner_type,
+                    StorageUsage.owner_id == owner_id,
+                    StorageUsage.used_size + StorageUsage.reserved_size + size <= limits[owner]
+                )\
+                .update(
+                    {
+                        StorageUsage.reserved_size: StorageUsage.reserved_size + size,
+                        StorageUsage.update_at: datetime.now()
+                    },
+                    synchronize_session=False
+                )
+            if result == 0:
+                raise StorageQuotaExceeded(owner_type)
+
+        reservation = StorageReservation(
+            user_id=user_owner[1],
+            department_id=department_owner[1],
+            company_id=company_owner[1],
+            reserved_size=size,
+            expires_at=datetime.now() + timedelta(seconds=STORAGE_RESERVATION_TTL),
+            create_at=datetime.now()
+        )
+        db.add(reservation)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return reservation.id
+
+# 予約を削除し、確保していた容量を戻す（既に期限切れで解放されていた場合は何もしない）
+# コミットは呼び出し側で行う
+def _remove_reservation(db: Session, reservation_id: int) -> bool:
+    reservation = db.query(StorageReservation)\
+        .filter(StorageReservation.id == reservation_id)\
+        .with_for_update()\
+        .first()
+    if reservation is None:
+        return False
+
+    owners = usage_owners(reservation.user_id, reservation.department_id, reservation.company_id)
+    db.query(StorageUsage)\
+        .filter(tuple_(StorageUsage.owner_type, StorageUsage.owner_id).in_(owners))\
+        .update(
+            {
+                StorageUsage.reserved_size: StorageUsage.reserved_size - reservation.reserved_size,
+                StorageUsage.update_at: datetime.now()
+            },
+            synchronize_session=False
+        )
+    db.delete(reservation)
+    return True
+
+# アップロードの完了時に予約を外す（ファイル情報・使用量の更新と同じトランザクションで呼ぶ）
+def commit_reservation(db: Session, reservation_id: Optional[int]):
+    if reservation_id is not None:
+        _remove_reservation(db, reservation_id)
+
+# アップロードの失敗時に予約を解放する
+def release_reservation(db: Session, reservation_id: Optional[int]):
+    if reservation_id is None:
+        return
+    try:
+        _remove_reservation(db, reservation_id)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+# 期限切れの予約を解放し、解放した件数を返す（プロセスが途中で終了したアップロードの分）
+def reap_expired_reservations(db: Session) -> int:
+    expired_ids = [
+        row.id for row in db.query(StorageReservation.id)
+            .filter(StorageReservation.expires_at < datetime.now())
+            .limit(1000)
+            .all()
+    ]
+    reaped = 0
+    for reservation_id in expired_ids:
+        if _remove_reservation(db, reservation_id):
+            reaped += 1
+    db.commit()
+    return reaped
+
+# 期限切れの予約を定期的に解放する（アプリケーションの起動時にタスクとして開始する）
+async def run_reservation_reaper(interval: int = STORAGE_RESERVATION_REAP_INTERVAL):
+    def reap():
+        db = SessionLocal()
+        try:
+            return reap_expired_reservations(db)
+        finally:
+            db.close()
+
+    while True:
+        try:
+            reaped = await asyncio.to_thread(reap)
+            if reaped:
+                print(f"released {reaped} expired storage reservations")
+        except Exception as e:
+            print(f"Failed to release expired storage reservations: {e}")
+        await asyncio.sleep(interval)
+
+# ディレクトリ内のファイルを削除する前に、その分の使用量をアップロードしたユーザーごとに減らす
+# directory_idsは対象ディレクトリIDのサブクエリで、ファイルを読み込まずSQLで集計する
+def release_directory_files_usage(db: Session, directory_ids):
+    size_by_user = db.query(File.user_id, func.sum(File.file_size).label('file_size'))\
+        .filter(
+            File.directory_id.in_(directory_ids),
+            File.delete_flg == False
+        )\
+        .group_by(File.user_id)\
+        .all()
+
+    for row in size_by_user:
+        add_usage(db, get_file_owners(db, row.user_id), -int(row.file_size or 0))
+
+# 使用量をファイルから集計し直す（company_idを指定した場合はその会社のみ）
+# 集計値と実際のファイルがずれた場合や、ユーザーの部署が変わった場合に実行する
+def reconcile_storage_usage(db: Session, company_id: Optional[int] = None) -> Dict[UsageOwner, int]:
+    usage = {}
+
+    # 対象範囲の単位は、ファイルがなくても0に戻す
+    if company_id is None:
+        for row in db.query(StorageUsage.owner_type, StorageUsage.owner_id).all():
+            usage[(row.owner_type, row.owner_id)] = 0
+    else:
+        usage[(USAGE_COMPANY, company_id)] = 0
+        for row in db.query(User.id).filter(User.company_id == company_id).all():
+            usage[(USAGE_USER, row.id)] = 0
+        for row in db.query(Department.id).filter(Department.company_id == company_id).all():
+            usage[(USAGE_DEPARTMENT, row.id)] = 0
+
+    for owner_type in (USAGE_USER, USAGE_DEPARTMENT, USAGE_COMPANY):
+        query, _ = _file_size_query(db, owner_type)
+        if company_id is not None:
+            if owner_type == USAGE_USER:
+                query = query.join(User, User.id == File.user_id)
+            query = query.filter(User.company_id == company_id)
+        for row in query.all():
+            usage[(owner_type, row.owner_id)] = int(row.used_size)
+
+    if usage:
+        statement = mysql_insert(StorageUsage).values([
+            {"owner_type": owner_type, "owner_id": owner_id, "used_size": used_size, "update_at": datetime.now()}
+            for (owner_type, owner_id), used_size in usage.items()
+        ])
+        statement = statement.on_duplicate_key_update(
+            used_size=statement.inserted.used_size,
+            update_at=statement.inserted.update_at
+        )
+        db.execute(statement)
+
+    return usage
+
+# 会社ごとの使用量を部署別・ユーザー別の内訳とともに返す（管理者用のレポート）
+# 集計値を結合して読むだけのため、ファイル数に関係なく会社・部署・ユーザーの件数に比例した時間で終わる
+# ユーザーはサーバー側カーソルで会社順に読み進め、1社分ずつ返すため件数が多くてもメモリを使い切らない
+def iter_storage_report(db: Session, company_id: Optional[int] = None) -> Iterator[dict]:
+    def used_size_of(owner_type: str, owner_id_column):
+        return and_(StorageUsage.owner_type == owner_type, StorageUsage.owner_id == owner_id_column)
+
+    company_query = db.query(
+            Company.id,
+            Company.company_name,
+            Company.storage,
+            func.coalesce(StorageUsage.used_size, 0).label('used_size')
+        )\
+        .outerjoin(StorageUsage, used_size_of(USAGE_COMPANY, Company.id))
+    department_query = db.query(
+            Department.id,
+            Department.company_id,
+            Department.department_name,
+            Department.storage,
+            func.coalesce(StorageUsage.used_size, 0).label('used_size')
+        )\
+        .outerjoin(StorageUsage, used_size_of(USAGE_DEPARTMENT, Department.id))
+    user_query = db.query(
+            User.id,
+            User.company_id,
+            User.department_id,
+            User.user_name,
+            User.storage,
+            func.coalesce(StorageUsage.used_size, 0).label('used_size')
+        )\
+        .outerjoin(StorageUsage, used_size_of(USAGE_USER, User.id))
+
+    if company_id is not None:
+        company_query = company_query.filter(Company.id == company_id)
+        department_query = department_query.filter(Department.company_id == company_id)
+        user_query = user_query.filter(User.company_id == company_id)
+
+    companies = company_query.order_by(Company.id).all()
+
+    departments_by_company = {}
+    for department in department_query.order_by(Department.company_id, Department.id).all():
+        departments_by_company.setdefault(department.company_id, []).append({
+            "department_id": department.id,
+            "department_name": department.department_name,
+            "storage": department.storage,
+            "used_size": int(department.used_size)
+        })
+
+    users = iter(
+        user_query
+            .order_by(User.company_id, User.id)
+            .execution_options(stream_results=True)
+            .yield_per(1000)
+    )
+    pending_user = next(users, None)
+
+    for company in companies:
+        company_users = []
+        while pending_user is not None and pending_user.company_id < company.id:
+            pending_user = next(users, None)
+        while pending_user is not None and pending_user.company_id == company.id:
+            company_users.append({
+                "user_id": pending_user.id,
+                "user_name": pending_user.user_name,
+                "department_id": pending_user.department_id,
+                "storage": pending_user.storage,
+                "used_size": int(pending_user.used_size)
+            })
+            pending_user = next(users, None)
+
+        yield {
+            "company_id": company.id,
+            "company_name": company.company_name,
+            "storage": company.storage,
+            "used_size": int(company.used_size),
+            "departments": departments_by_company.get(company.id, []),
+            "users": company_users
+        }
+
+def main():
+    # 全ての使用量をファイルから集計し直す
+    db = SessionLocal()
+    try:
+        usage = reconcile_storage_usage(db)
+        db.commit()
+        print(f"reconciled {len(usage)} storage usage rows")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
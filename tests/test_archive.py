@@ -0,0 +1,71 @@
+# ZIPのストリーム出力（zipfileで開けること、格納内容、削除済みのファイルの扱い）の確認
+from datetime import datetime
+from fastapi import HTTPException
+from storage.archive import ArchiveEntry, stream_zip
+import asyncio
+import io
+import pytest
+import zipfile
+
+def _fetch(data: bytes, chunk_size: int = 7):
+    async def fetch():
+        async def chunks():
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+        return chunks()
+    return fetch
+
+def _missing():
+    async def fetch():
+        raise HTTPException(status_code=404, detail="File not found")
+    return fetch
+
+def _archive(entries, **kwargs) -> zipfile.ZipFile:
+    async def run():
+        return b''.join([chunk async for chunk in stream_zip(entries, **kwargs)])
+    return zipfile.ZipFile(io.BytesIO(asyncio.run(run())))
+
+FILES = {
+    'docs/a.txt': b'hello',
+    'docs/empty.txt': b'',
+    'docs/sub/b.bin': bytes(range(256)) * 10,
+    'docs/sub/c.txt': '日本語'.encode('utf-8'),
+}
+
+@pytest.mark.parametrize('prefetch_files', [1, 4])
+def test_entries_match(prefetch_files):
+    entries = [ArchiveEntry('docs/', None, None), ArchiveEntry('docs/sub/', None, None)]
+    entries += [ArchiveEntry(name, _fetch(data), datetime(2024, 1, 2, 3, 4, 6)) for name, data in FILES.items()]
+
+    with _archive(entries, prefetch_files=prefetch_files) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [entry.name for entry in entries]
+        for name, data in FILES.items():
+            assert archive.read(name) == data
+        assert archive.getinfo('docs/a.txt').date_time == (2024, 1, 2, 3, 4, 6)
+        assert archive.getinfo('docs/sub/').is_dir()
+
+# 一覧の取得後に削除されたファイルは格納せず、ZIPは最後まで出力される
+def test_missing_file_is_skipped():
+    entries = [
+        ArchiveEntry('docs/', None, None),
+        ArchiveEntry('docs/a.txt', _fetch(b'hello'), None),
+        ArchiveEntry('docs/gone.txt', _missing(), None),
+        ArchiveEntry('docs/b.txt', _fetch(b'world'), None),
+    ]
+
+    with _archive(entries) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['docs/', 'docs/a.txt', 'docs/b.txt']
+        assert archive.read('docs/b.txt') == b'world'
+
+def test_storage_error_aborts():
+    async def failing():
+        raise OSError('storage error')
+
+    async def run():
+        entries = [ArchiveEntry('a.txt', failing, None)]
+        return [chunk async for chunk in stream_zip(entries)]
+
+    with pytest.raises(OSError):
+        asyncio.run(run())
@@ -0,0 +1,78 @@
+# 変更履歴のidがコミット順になり、カーソルを進めても変更を取りこぼさないことの確認
+# 行ロックの動作を確認するためMySQLが必要（TEST_DATABASE_URLに使い捨てのDBを指定した場合のみ実行する）
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from models import Base, Company, Change, ChangeLock
+from change_log import CHANGE_ENTITY_FILE, CHANGE_ACTION_CREATE, record_change, get_changes
+import os
+import threading
+import pytest
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+COMPANY_ID = 1
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+@pytest.fixture
+def engine():
+    engine = create_engine(TEST_DATABASE_URL)
+    Base.metadata.create_all(engine, tables=[Company.__table__, Change.__table__, ChangeLock.__table__])
+    with Session(engine) as db:
+        db.query(Change).filter(Change.company_id == COMPANY_ID).delete(synchronize_session=False)
+        if db.get(Company, COMPANY_ID) is None:
+            db.add(Company(id=COMPANY_ID, company_name='test', storage_name='test', tell='0', storage=0, create_at=datetime.now()))
+        db.commit()
+    yield engine
+    engine.dispose()
+
+def _record(db: Session, entity_id: int, name: str):
+    record_change(db, COMPANY_ID, CHANGE_ENTITY_FILE, entity_id, CHANGE_ACTION_CREATE, None, name, None)
+
+def _read(engine, cursor: int):
+    with Session(engine) as db:
+        changes, reset_required = get_changes(db, COMPANY_ID, cursor, 100)
+    assert not reset_required
+    return changes
+
+# 先にidを採番した変更のコミットが遅れても、後の変更はそのコミットを待つため、先の変更を飛ばしてカーソルが進まない
+def test_interleaved_commits_are_returned_in_commit_order(engine):
+    with Session(engine) as db:
+        _record(db, 1, 'baseline')
+        db.commit()
+        cursor = db.query(Change.id).filter(Change.company_id == COMPANY_ID).scalar()
+
+    first = Session(engine)
+    second = Session(engine)
+    second_committed = threading.Event()
+
+    def record_second():
+        _record(second, 3, 'second')
+        second.commit()
+        second_committed.set()
+
+    try:
+        _record(first, 2, 'first')
+        first.flush()  # 1つ目のidを採番し、コミットせずに保持する
+
+        thread = threading.Thread(target=record_second)
+        thread.start()
+
+        # 1つ目がコミットするまで、2つ目はコミットできず、まだ何も見えない
+        assert not second_committed.wait(1)
+        assert _read(engine, cursor) == []
+
+        first.commit()
+        visible = _read(engine, cursor)
+        assert [change.name for change in visible][:1] == ['first']
+
+        thread.join(10)
+        assert second_committed.is_set()
+
+        # 1つ目まで読んだカーソルから続けても、2つ目を取得できる
+        changes = _read(engine, visible[0].id)
+        assert [change.name for change in changes] == ['second']
+        assert visible[0].id < changes[0].id
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,127 @@
+# ダウンロードのローカルキャッシュ（LRUでの削除・配信中の保護・登録・同時のキャッシュミス）の確認
+from storage.cache import FileCache
+import asyncio
+import os
+import pytest
+
+# fetchに渡すストレージからの取得（呼び出し回数を数え、releaseが設定されるまで最後のチャンクを返さない）
+class FakeDownload:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+
+        async def chunks():
+            yield self.data[:1]
+            await self.release.wait()
+            yield self.data[1:]
+
+        return len(self.data), None, chunks()
+
+async def _read(cache: FileCache, key: str, download):
+    size, chunks = await cache.fetch(key, download)
+    return size, b''.join([chunk async for chunk in chunks])
+
+async def _populate(cache: FileCache, key: str, data: bytes):
+    download = FakeDownload(data)
+    download.release.set()
+    return await _read(cache, key, download)
+
+def _files(cache: FileCache):
+    return sorted(name for name in os.listdir(cache.directory) if name != '.lock')
+
+def test_concurrent_misses_share_one_fetch(tmp_path):
+    async def run():
+        cache = FileCache(str(tmp_path), 1000)
+        download = FakeDownload(b'0123456789')
+        readers = [asyncio.create_task(_read(cache, 'k', download)) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        download.release.set()
+
+        assert await asyncio.gather(*readers) == [(10, b'0123456789')] * 3
+        assert download.calls == 1
+        assert cache.acquire('k') == cache.path('k')
+        cache.release('k')
+
+    asyncio.run(run())
+
+# 最後まで書き込むまではキャッシュに登録されず、失敗した場合は一時ファイルも残らない
+def test_populate_is_atomic(tmp_path):
+    async def run():
+        cache = FileCache(str(tmp_path), 1000)
+        download = FakeDownload(b'0123456789')
+        reader = asyncio.create_task(_read(cache, 'k', download))
+        await asyncio.sleep(0.1)
+        assert cache.acquire('k') is None
+        assert not os.path.exists(cache.path('k'))
+        download.release.set()
+        await reader
+
+        async def failing():
+            async def chunks():
+                yield b'x'
+                raise OSError('storage error')
+            return 2, None, chunks()
+
+        with pytest.raises(OSError):
+            await _read(cache, 'broken', failing)
+        assert cache.acquire('broken') is None
+        assert _files(cache) == ['k']
+
+    asyncio.run(run())
+
+def test_lru_eviction(tmp_path):
+    async def run():
+        cache = FileCache(str(tmp_path), 25)
+        await _populate(cache, 'a', b'a' * 10)
+        await _populate(cache, 'b', b'b' * 10)
+        # aを参照して新しくしておくと、上限を超えた時にbが削除される
+        cache.acquire('a')
+        cache.release('a')
+        await _populate(cache, 'c', b'c' * 10)
+
+        assert list(cache.entries) == ['a', 'c']
+        assert cache.total_size == 20
+        assert _files(cache) == ['a', 'c']
+
+    asyncio.run(run())
+
+# 配信中のキャッシュは古くても削除せず、配信中でないキャッシュから削除する
+def test_pinned_entries_are_not_evicted(tmp_path):
+    async def run():
+        cache = FileCache(str(tmp_path), 25)
+        await _populate(cache, 'a', b'a' * 10)
+        await _populate(cache, 'b', b'b' * 10)
+        path = cache.acquire('a')
+        cache.entries.move_to_end('b')  # aを最も古い状態に戻す
+        await _populate(cache, 'c', b'c' * 10)
+
+        assert list(cache.entries) == ['a', 'c']
+        with open(path, 'rb') as source:
+            assert source.read() == b'a' * 10
+
+        cache.release('a')
+        assert _files(cache) == ['a', 'c']
+
+    asyncio.run(run())
+
+# 再起動時は既存のキャッシュを引き継ぎ、書き込み途中のファイルは削除する
+def test_reload_existing_entries(tmp_path):
+    async def run():
+        cache = FileCache(str(tmp_path), 1000)
+        await _populate(cache, 'a', b'a' * 10)
+        with open(os.path.join(cache.directory, 'b.0.tmp'), 'wb') as output:
+            output.write(b'partial')
+        directory = cache.directory
+        cache._lock_file.close()
+
+        reloaded = FileCache(str(tmp_path), 1000)
+        assert reloaded.directory == directory
+        assert dict(reloaded.entries) == {'a': 10}
+        assert _files(reloaded) == ['a']
+
+    asyncio.run(run())
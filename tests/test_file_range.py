@@ -0,0 +1,55 @@
+# ダウンロードのRange・If-Rangeヘッダーの解析の確認
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from routers.file import parse_range_header, is_if_range_matched
+import pytest
+
+FILE_SIZE = 1000
+
+def test_closed_range():
+    assert parse_range_header('bytes=0-99', FILE_SIZE) == (0, 100)
+    assert parse_range_header('bytes=100-199', FILE_SIZE) == (100, 100)
+
+def test_open_ended_range():
+    assert parse_range_header('bytes=900-', FILE_SIZE) == (900, 100)
+
+def test_suffix_range():
+    assert parse_range_header('bytes=-100', FILE_SIZE) == (900, 100)
+    # ファイルより長い場合はファイル全体
+    assert parse_range_header('bytes=-5000', FILE_SIZE) == (0, FILE_SIZE)
+
+def test_end_beyond_file_is_clamped():
+    assert parse_range_header('bytes=990-5000', FILE_SIZE) == (990, 10)
+
+# 解析できない・複数範囲の場合はファイル全体を返す
+@pytest.mark.parametrize('range_header', [
+    None,
+    '',
+    'items=0-99',
+    'bytes=0-99,200-299',
+    'bytes=abc-def',
+    'bytes=100',
+    'bytes=-0',
+])
+def test_ignored_ranges(range_header):
+    assert parse_range_header(range_header, FILE_SIZE) is None
+
+@pytest.mark.parametrize('range_header', ['bytes=1000-', 'bytes=1000-1099', 'bytes=200-100'])
+def test_unsatisfiable_range(range_header):
+    with pytest.raises(HTTPException) as e:
+        parse_range_header(range_header, FILE_SIZE)
+    assert e.value.status_code == 416
+    assert e.value.headers["Content-Range"] == f"bytes */{FILE_SIZE}"
+
+def test_if_range():
+    etag = '"abc"'
+    last_modified = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    assert is_if_range_matched(None, etag, last_modified)
+    assert is_if_range_matched('"abc"', etag, last_modified)
+    assert not is_if_range_matched('"old"', etag, last_modified)
+    # 弱いETagは一致しても範囲リクエストに使用できない
+    assert not is_if_range_matched('W/"abc"', etag, last_modified)
+    assert is_if_range_matched('Tue, 02 Jan 2024 03:04:05 GMT', etag, last_modified)
+    assert not is_if_range_matched('Tue, 02 Jan 2024 03:04:06 GMT', etag, last_modified)
+    assert not is_if_range_matched('Tue, 02 Jan 2024 03:04:05 GMT', etag, None)
@@ -0,0 +1,52 @@
+# ファイル一覧のページのカーソルの変換と、改変されたカーソルを拒否することの確認
+from datetime import datetime
+from fastapi import HTTPException
+from routers.file import encode_page_cursor, decode_page_cursor
+import base64
+import json
+import pytest
+import string
+
+@pytest.mark.parametrize('is_directory, sort, descending, key, item_id', [
+    (True, 'name', False, '資料', 12),
+    (False, 'name', True, 'report.pdf', 34),
+    (False, 'size', False, 2048, 56),
+    (True, 'update_at', True, datetime(2024, 1, 2, 3, 4, 5, 678901), 78),
+    (False, 'update_at', False, None, None),
+])
+def test_round_trip(is_directory, sort, descending, key, item_id):
+    cursor = encode_page_cursor(is_directory, sort, descending, key, item_id)
+    assert set(cursor) <= set(string.ascii_letters + string.digits + '-_=')
+
+    payload = decode_page_cursor(cursor, sort, descending)
+    assert (payload["d"], payload["k"], payload["i"]) == (is_directory, key, item_id)
+
+def _encode(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+VALID = {"d": False, "s": "size", "desc": False, "k": 2048, "i": 56}
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor',
+    encode_page_cursor(False, 'size', False, 2048, 56)[:-4],
+    _encode([1, 2, 3]),
+    _encode({key: value for key, value in VALID.items() if key != 'i'}),
+    _encode({**VALID, "s": "name"}),
+    _encode({**VALID, "desc": True}),
+    _encode({**VALID, "d": "yes"}),
+    _encode({**VALID, "i": "56 OR 1=1"}),
+    _encode({**VALID, "i": 56.5}),
+    _encode({**VALID, "k": "2048"}),
+    _encode({**VALID, "i": None}),
+    _encode({**VALID, "d": True, "k": None, "i": None}),
+])
+def test_tampered_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as e:
+        decode_page_cursor(cursor, 'size', False)
+    assert e.value.status_code == 400
+
+def test_invalid_datetime_is_rejected():
+    cursor = _encode({"d": False, "s": "update_at", "desc": False, "k": "yesterday", "i": 1})
+    with pytest.raises(HTTPException) as e:
+        decode_page_cursor(cursor, 'update_at', False)
+    assert e.value.status_code == 400
@@ -0,0 +1,26 @@
+# 検索用の名前の正規化と2文字単位の分割の確認
+from search_index import normalize_search_text, search_grams, _escape_like
+
+def test_normalize_nfkc_and_lowercase():
+    assert normalize_search_text('Report.PDF') == 'report.pdf'
+    # 全角英数字・半角カナはNFKCで揃える
+    assert normalize_search_text('ＲＥＰＯＲＴ１２３') == 'report123'
+    assert normalize_search_text('ｶﾞｲﾄﾞ') == 'ガイド'
+    assert normalize_search_text('㈱資料') == '(株)資料'
+
+def test_two_character_grams():
+    assert search_grams('report') == {'re', 'ep', 'po', 'or', 'rt'}
+    assert search_grams('資料一覧') == {'資料', '料一', '一覧'}
+    # 同じ組は1つにまとめる
+    assert search_grams('aaaa') == {'aa'}
+
+def test_short_names():
+    assert search_grams('a') == {'a'}
+    assert search_grams('') == set()
+
+# 正規化後の名前の組で検索するため、表記の違う名前も同じ組になる
+def test_grams_of_normalized_names_match():
+    assert search_grams(normalize_search_text('ＡＢｃ')) == search_grams(normalize_search_text('abC'))
+
+def test_escape_like():
+    assert _escape_like('100%_a\\b') == '100\\%\\_a\\\\b'
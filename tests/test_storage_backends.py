@@ -0,0 +1,101 @@
+# メモリ・ローカルのストレージバックエンドのアップロード・ダウンロード・リネーム・削除の確認
+from fastapi import HTTPException
+from storage.local import LocalStorageBackend
+from storage.memory import MemoryStorageBackend
+import asyncio
+import pytest
+
+STORAGE_NAME = 'company'
+DATA = bytes(range(256)) * 4
+
+# await source.read(size)で読み込めるアップロード元（UploadFileの代わり）
+class BytesSource:
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self, size: int) -> bytes:
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+@pytest.fixture(params=['memory', 'local'])
+def backend(request, tmp_path):
+    backend = MemoryStorageBackend() if request.param == 'memory' else LocalStorageBackend(str(tmp_path))
+
+    async def prepare():
+        await backend.create_share(STORAGE_NAME)
+        await backend.create_directory(STORAGE_NAME, None, 'docs')
+
+    asyncio.run(prepare())
+    return backend
+
+async def _download(backend, file_name: str, offset=None, length=None):
+    size, properties, chunks = await backend.download_file(STORAGE_NAME, 'docs/', file_name, offset, length)
+    return size, properties, b''.join([chunk async for chunk in chunks])
+
+def test_upload_and_download(backend):
+    async def run():
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(DATA), len(DATA))
+        size, properties, data = await _download(backend, 'a.bin')
+        assert (size, properties.size, data) == (len(DATA), len(DATA), DATA)
+        assert await backend.list_directory(STORAGE_NAME, 'docs/') == ['a.bin']
+
+    asyncio.run(run())
+
+def test_download_range(backend):
+    async def run():
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(DATA), len(DATA))
+        size, properties, data = await _download(backend, 'a.bin', 100, 50)
+        assert (size, data) == (50, DATA[100:150])
+        # プロパティのサイズは範囲ではなくファイル全体
+        assert properties.size == len(DATA)
+
+        size, _, data = await _download(backend, 'a.bin', len(DATA) - 10, 100)
+        assert (size, data) == (10, DATA[-10:])
+
+    asyncio.run(run())
+
+# 申告したサイズと一致しない場合は失敗し、上書き前のファイルは残る
+@pytest.mark.parametrize('uploaded', [DATA[:10], DATA + b'x'])
+def test_upload_size_mismatch_keeps_previous_file(backend, uploaded):
+    async def run():
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(DATA), len(DATA))
+        with pytest.raises(HTTPException) as e:
+            await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(uploaded), len(DATA))
+        assert e.value.status_code == 400
+        assert (await _download(backend, 'a.bin'))[2] == DATA
+        assert await backend.list_directory(STORAGE_NAME, 'docs/') == ['a.bin']
+
+    asyncio.run(run())
+
+def test_rename(backend):
+    async def run():
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(DATA), len(DATA))
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'c.bin', BytesSource(b'c'), 1)
+        await backend.rename_file(STORAGE_NAME, 'docs/', 'a.bin', 'b.bin')
+        assert (await _download(backend, 'b.bin'))[2] == DATA
+        assert await backend.list_directory(STORAGE_NAME, 'docs/') == ['b.bin', 'c.bin']
+
+        with pytest.raises(HTTPException) as e:
+            await backend.rename_file(STORAGE_NAME, 'docs/', 'b.bin', 'c.bin')
+        assert e.value.status_code == 400
+        with pytest.raises(HTTPException) as e:
+            await backend.rename_file(STORAGE_NAME, 'docs/', 'a.bin', 'd.bin')
+        assert e.value.status_code == 404
+
+    asyncio.run(run())
+
+def test_delete(backend):
+    async def run():
+        await backend.upload_file(STORAGE_NAME, 'docs/', 'a.bin', BytesSource(DATA), len(DATA))
+        await backend.delete_file(STORAGE_NAME, 'docs/', 'a.bin')
+        assert await backend.list_directory(STORAGE_NAME, 'docs/') == []
+
+        with pytest.raises(HTTPException) as e:
+            await _download(backend, 'a.bin')
+        assert e.value.status_code == 404
+        with pytest.raises(HTTPException) as e:
+            await backend.delete_file(STORAGE_NAME, 'docs/', 'a.bin')
+        assert e.value.status_code == 404
+
+    asyncio.run(run())